@@ -58,6 +58,10 @@ class CelebVHQDataModule(FaceVideoDataModule):
             read_audio = True,
             align_images = True,
             return_mica_images = False,
+            detection_batch_size = None,
+            video_clip_cache_size_mb = None,
+            video_clip_cache_readahead = False,
+            video_clip_cache_log_every = None,
             ):
         super().__init__(root_dir, output_dir, processed_subfolder, 
             face_detector, face_detector_threshold, image_size, scale, 
@@ -74,11 +78,15 @@ class CelebVHQDataModule(FaceVideoDataModule):
             include_processed_audio = include_processed_audio,
             include_raw_audio = include_raw_audio,
             preload_videos=preload_videos,
+            video_clip_cache_size_mb=video_clip_cache_size_mb,
+            video_clip_cache_readahead=video_clip_cache_readahead,
+            video_clip_cache_log_every=video_clip_cache_log_every,
             inflate_by_video_size=inflate_by_video_size,
             read_video = read_video,
             read_audio = read_audio,
             return_mica_images = return_mica_images,
             align_images=align_images,
+            detection_batch_size = detection_batch_size,
             )
         # self.detect_landmarks_on_restored_images = landmarks_from
         self.batch_size_train = batch_size_train
@@ -177,6 +185,13 @@ class CelebVHQDataModule(FaceVideoDataModule):
         num_shards = int(np.ceil( self.num_sequences / videos_per_shard))
         return num_shards
 
+    def _get_reconstruction_methods_to_process(self):
+        # return ['emoca', 'deep3dface', 'deca']
+        return ['emoca', 'spectre',]
+
+    def _get_emotion_methods_to_process(self):
+        return ['resnet50', ]
+
     def _process_video(self, idx, extract_audio=True, 
             restore_videos=True, 
             detect_landmarks=True, 
@@ -217,7 +232,7 @@ class CelebVHQDataModule(FaceVideoDataModule):
             # self._reconstruct_faces_in_sequence(idx, 
             #     reconstruction_net=self._get_reconstruction_network('deca'))
             # rec_methods = ['emoca', 'deep3dface', 'deca']
-            rec_methods = ['emoca', 'spectre',]
+            rec_methods = self._get_reconstruction_methods_to_process()
             # for rec_method in rec_methods:
             #     self._reconstruct_faces_in_sequence(idx, reconstruction_net=None, device=None,
             #                         save_obj=False, save_mat=True, save_vis=False, save_images=False,
@@ -227,7 +242,7 @@ class CelebVHQDataModule(FaceVideoDataModule):
                         save_obj=False, save_mat=True, save_vis=False, save_images=False,
                         save_video=False, rec_methods=rec_methods, retarget_from=None, retarget_suffix=None)
         if recognize_emotions:
-            emo_methods = ['resnet50', ]
+            emo_methods = self._get_emotion_methods_to_process()
             self._extract_emotion_in_sequence(idx, emo_methods=emo_methods)
   
         if segmentations_to_hdf5:
@@ -266,13 +281,26 @@ class CelebVHQDataModule(FaceVideoDataModule):
                 detect_landmarks=detect_landmarks, 
                 segment_videos=segment_videos, 
                 detect_aligned_landmarks=detect_aligned_landmarks,
-                reconstruct_faces=reconstruct_faces, 
-                recognize_emotions=recognize_emotions,
+                reconstruct_faces=False, # the network stages run on the whole shard below (pipelined over the videos)
+                recognize_emotions=False,
                 segmentations_to_hdf5=segmentations_to_hdf5,
                 )
+
+        shard_idxs = [int(idx) for idx in idxs[start_idx:end_idx]]
+        if reconstruct_faces: 
+            self._reconstruct_faces_in_sequences_v2(shard_idxs, rec_methods=self._get_reconstruction_methods_to_process())
+        if recognize_emotions: 
+            self._extract_emotion_in_sequences(shard_idxs, emo_methods=self._get_emotion_methods_to_process())
             
         print("Done processing shard")
 
+    def _process_locally(self, stages, *args, **kwargs):
+        if "detect_aligned_landmarks" in stages: 
+            self.face_detector_type = 'fan3d'
+            if hasattr(self, 'face_detector'): # the detector is instantiated in the workers
+                del self.face_detector
+        return super()._process_locally(stages, *args, **kwargs)
+
     def _get_path_to_sequence_files(self, sequence_id, file_type, method="", suffix="", assert_=True): 
         if assert_:
             assert file_type in ['videos', 'videos_aligned', 'detections', 
@@ -384,6 +412,9 @@ class CelebVHQDataModule(FaceVideoDataModule):
                 temporal_split_start= 0 if self.temporal_split is not None else None,
                 temporal_split_end=self.temporal_split[0] if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
                 original_image_size=self.processed_video_size,
                 return_mica_images=self.return_mica_images,
@@ -405,6 +436,9 @@ class CelebVHQDataModule(FaceVideoDataModule):
                 temporal_split_start=self.temporal_split[0] if self.temporal_split is not None else None,
                 temporal_split_end= self.temporal_split[0] + self.temporal_split[1] if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
                 original_image_size=self.processed_video_size,
                 return_mica_images=self.return_mica_images,
@@ -425,6 +459,9 @@ class CelebVHQDataModule(FaceVideoDataModule):
                 temporal_split_start=self.temporal_split[0] + self.temporal_split[1] if self.temporal_split is not None else None,
                 temporal_split_end= sum(self.temporal_split) if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
                 original_image_size=self.processed_video_size,
                 return_mica_images=self.return_mica_images,
@@ -450,6 +487,9 @@ class CelebVHQDataModule(FaceVideoDataModule):
                 # temporal_split_start=self.temporal_split[0] + self.temporal_split[1] if self.temporal_split is not None else None,
                 # temporal_split_end= sum(self.temporal_split) if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=False,
                 original_image_size=self.processed_video_size,
                 return_mica_images=self.return_mica_images,
@@ -539,6 +579,9 @@ class CelebVHQDataset(VideoDatasetBase):
             original_image_size=None,
             return_mica_images=False,
             align_images=True,
+            video_clip_cache_size_mb=None,
+            video_clip_cache_readahead=False,
+            video_clip_cache_log_every=None,
     ) -> None:
         landmark_types = landmark_types or ["mediapipe", "fan"]
         super().__init__(
@@ -571,6 +614,9 @@ class CelebVHQDataset(VideoDatasetBase):
             temporal_split_start=temporal_split_start,
             temporal_split_end=temporal_split_end,
             preload_videos=preload_videos,
+            video_clip_cache_size_mb=video_clip_cache_size_mb,
+            video_clip_cache_readahead=video_clip_cache_readahead,
+            video_clip_cache_log_every=video_clip_cache_log_every,
             inflate_by_video_size=inflate_by_video_size,
             include_filename=include_filename,
             original_image_size=original_image_size,
@@ -1,11 +1,11 @@
 import numpy as np
 from pathlib import Path
-from inferno.datasets.ImageDatasetHelpers import bbox2point, bbpoint_warp
+from inferno.datasets.ImageDatasetHelpers import bbox2point, bbpoint_warp, bbpoint_warp_images
 import skvideo
 import types
 
 
-def align_face(image, landmarks, landmark_type, scale_adjustment, target_size_height, target_size_width=None,):
+def align_face(image, landmarks, landmark_type, scale_adjustment, target_size_height, target_size_width=None, backend="cv2"):
     """
     Returns an image with the face aligned to the center of the image.
     :param image: The full resolution image in which to align the face. 
@@ -14,6 +14,7 @@ def align_face(image, landmarks, landmark_type, scale_adjustment, target_size_he
     :param scale_adjustment: The scale adjustment to apply to the image.
     :param target_size_height: The height of the output image.
     :param target_size_width: The width of the output image. If not provided, it is assumed to be the same as target_size_height.
+    :param backend: The warp backend ('cv2', 'torch' or 'skimage', see bbpoint_warp_images).
     :return: The aligned face image. The image will be in range [0,1].
     """
     # landmarks_for_alignment = "mediapipe"
@@ -25,18 +26,20 @@ def align_face(image, landmarks, landmark_type, scale_adjustment, target_size_he
     old_size, center = bbox2point(left, right, top, bottom, type=landmark_type)
     size = (old_size * scale_adjustment).astype(np.int32)
 
-    img_warped, lmk_warped = bbpoint_warp(image, center, size, target_size_height, target_size_width, landmarks=landmarks)
+    img_warped, lmk_warped = bbpoint_warp(image, center, size, target_size_height, target_size_width, landmarks=landmarks, 
+        backend=backend)
 
     return img_warped
 
 
-def align_video(video, centers, sizes, landmarks, target_size_height, target_size_width=None, ):
+def align_video(video, centers, sizes, landmarks, target_size_height, target_size_width=None, backend="cv2"):
     """
     Returns a video with the face aligned to the center of the image.
     :param video: The full resolution video in which to align the face. 
     :param landmarks: The landmarks of the face in the video (in the original video coordinates).
     :param target_size_height: The height of the output video.
     :param target_size_width: The width of the output video. If not provided, it is assumed to be the same as target_size_height.
+    :param backend: The warp backend ('cv2', 'torch' or 'skimage', see bbpoint_warp_images).
     :return: The aligned face video. The video will be in range [0,1].
     """
     if isinstance(video, (str, Path)):
@@ -49,18 +52,17 @@ def align_video(video, centers, sizes, landmarks, target_size_height, target_siz
     aligned_video = []
     warped_landmarks = []
     if isinstance(video, np.ndarray):
-        for i in range(len(centers)): 
-            img_warped, lmk_warped = bbpoint_warp(video[i], centers[i], sizes[i], 
-                    target_size_height=target_size_height, target_size_width=target_size_width, 
-                    landmarks=landmarks[i])
-            aligned_video.append(img_warped)
-            warped_landmarks += [lmk_warped]
+        # all the frames are already in memory, warp them in one go
+        aligned_video, warped_landmarks = bbpoint_warp_images(video[:len(centers)], centers, sizes, 
+                target_size_height=target_size_height, target_size_width=target_size_width, 
+                landmarks=[landmarks[i] for i in range(len(centers))], backend=backend)
+        aligned_video = list(aligned_video)
             
     elif isinstance(video, types.GeneratorType): 
         for i, frame in enumerate(video):
             img_warped, lmk_warped = bbpoint_warp(frame, centers[i], sizes[i], 
                     target_size_height=target_size_height, target_size_width=target_size_width, 
-                    landmarks=landmarks[i])
+                    landmarks=landmarks[i], backend=backend)
             aligned_video.append(img_warped)
             warped_landmarks += [lmk_warped] 
 
@@ -68,13 +70,15 @@ def align_video(video, centers, sizes, landmarks, target_size_height, target_siz
     return aligned_video, warped_landmarks
 
 
-def align_and_save_video(video, out_video_path, centers, sizes, landmarks, target_size_height, target_size_width=None, output_dict=None):
+def align_and_save_video(video, out_video_path, centers, sizes, landmarks, target_size_height, target_size_width=None, output_dict=None, 
+        backend="cv2"):
     """
     Returns a video with the face aligned to the center of the image.
     :param video: The full resolution video in which to align the face. 
     :param landmarks: The landmarks of the face in the video (in the original video coordinates).
     :param target_size_height: The height of the output video.
     :param target_size_width: The width of the output video. If not provided, it is assumed to be the same as target_size_height.
+    :param backend: The warp backend ('cv2', 'torch' or 'skimage', see bbpoint_warp_images).
     :return: The aligned face video. The video will be in range [0,1].
     """
     if isinstance(video, (str, Path)):
@@ -90,7 +94,7 @@ def align_and_save_video(video, out_video_path, centers, sizes, landmarks, targe
         for i in range(len(centers)): 
             img_warped, lmk_warped = bbpoint_warp(video[i], centers[i], sizes[i], 
                     target_size_height=target_size_height, target_size_width=target_size_width, 
-                    landmarks=landmarks[i])
+                    landmarks=landmarks[i], backend=backend)
             img_warped = (img_warped * 255).astype(np.uint8)
             writer.writeFrame(img_warped)
             warped_landmarks += [lmk_warped]
@@ -99,7 +103,7 @@ def align_and_save_video(video, out_video_path, centers, sizes, landmarks, targe
         for i, frame in enumerate(video):
             img_warped, lmk_warped = bbpoint_warp(frame, centers[i], sizes[i], 
                     target_size_height=target_size_height, target_size_width=target_size_width, 
-                    landmarks=landmarks[i])
+                    landmarks=landmarks[i], backend=backend)
             img_warped = (img_warped * 255).astype(np.uint8)
             writer.writeFrame(img_warped)
             warped_landmarks += [lmk_warped] 
@@ -33,8 +33,9 @@ from torchvision.transforms import Resize, Compose, Normalize
 from tqdm import tqdm
 
 # from inferno.datasets.FaceVideoDataset import FaceVideoDataModule
-from inferno.datasets.IO import save_segmentation, save_segmentation_list, save_segmentation_list_v2
-from inferno.datasets.ImageDatasetHelpers import bbox2point, bbpoint_warp
+from inferno.datasets.IO import save_segmentation, save_segmentation_list, save_segmentation_list_v2, \
+    append_detection_log, load_detection_log
+from inferno.datasets.ImageDatasetHelpers import bbox2point, bbpoint_warp, bbpoint_warp_batch
 from inferno.datasets.UnsupervisedImageDataset import UnsupervisedImageDataset
 from inferno.utils.FaceDetector import FAN, MTCNN, save_landmark
 # try:
@@ -70,6 +71,7 @@ class FaceDataModuleBase(pl.LightningDataModule):
                  save_segmentation_frame_by_frame=True, # default
                  save_segmentation_one_file=False, # only use for large scale video datasets (that would produce too many files otherwise)
                  return_mica_images=False,
+                 detection_batch_size=None, # if set, frames of videos are detected (and cropped) in batches of this size
                  ):
         super().__init__()
         self.root_dir = root_dir
@@ -101,6 +103,7 @@ class FaceDataModuleBase(pl.LightningDataModule):
         self.image_size = image_size
         self.scale = scale
         self.return_mica_images = return_mica_images
+        self.detection_batch_size = detection_batch_size
 
     def _get_max_faces_per_image(self): 
         return 1
@@ -134,6 +137,19 @@ class FaceDataModuleBase(pl.LightningDataModule):
         else:
             raise ValueError("Invalid face detector specifier '%s'" % self.face_detector)
 
+    def _bbox_to_center_and_size(self, bbox, bbox_type):
+        left = bbox[0]
+        right = bbox[2]
+        top = bbox[1]
+        bottom = bbox[3]
+        old_size, center = bbox2point(left, right, top, bottom, type=bbox_type)
+
+        center[0] += abs(right-left)*self.bb_center_shift_x
+        center[1] += abs(bottom-top)*self.bb_center_shift_y
+
+        size = int(old_size * self.scale)
+        return center, size
+
     # @profile
     def _detect_faces_in_image(self, image_or_path, detected_faces=None):
         # imagepath = self.imagepath_list[index]
@@ -174,18 +190,9 @@ class FaceDataModuleBase(pl.LightningDataModule):
             # bounding_boxes += [[left, right, top, bottom]]
 
         for bi, bbox in enumerate(bounding_boxes):
-            left = bbox[0]
-            right = bbox[2]
-            top = bbox[1]
-            bottom = bbox[3]
-            old_size, center = bbox2point(left, right, top, bottom, type=bbox_type)
+            center, size = self._bbox_to_center_and_size(bbox, bbox_type)
 
-            center[0] += abs(right-left)*self.bb_center_shift_x
-            center[1] += abs(bottom-top)*self.bb_center_shift_y
-
-            size = int(old_size * self.scale)
-
-            dst_image, dts_landmark = bbpoint_warp(image, center, size, self.image_size, landmarks=landmarks[bi])
+            dst_image, dts_landmark = bbpoint_warp(image, center, size, self.image_size, landmarks=landmarks[bi], backend="cv2")
 
             # dst_image = dst_image.transpose(2, 0, 1)
             #
@@ -201,6 +208,59 @@ class FaceDataModuleBase(pl.LightningDataModule):
         del image
         return detection_images, detection_centers, detection_sizes, bbox_type, detection_landmarks, original_landmarks
 
+    def _detect_faces_in_image_batch(self, images, detected_faces=None):
+        """
+        Batched version of _detect_faces_in_image. The detector runs on the whole batch of frames 
+        and all the detected faces are cropped with a single batched warp on self.device.
+        images: list or array of N frames [H, W, 3] (of the same size), uint8
+        Returns a list of N tuples in the same format as the output of _detect_faces_in_image.
+        """
+        images = list(images)
+        for i in range(len(images)):
+            if len(images[i].shape) == 2:
+                images[i] = np.tile(images[i][:, :, None], (1, 1, 3))
+            if len(images[i].shape) == 3 and images[i].shape[2] > 3:
+                images[i] = images[i][:, :, :3]
+        images = np.stack(images, axis=0)
+
+        self._instantiate_detector()
+        detector_results = self.face_detector.run_batch(images, with_landmarks=True, detected_faces=detected_faces)
+
+        bbox_types = []
+        original_landmarks = []
+        crop_image_indices = []
+        crop_centers = []
+        crop_sizes = []
+        crop_landmarks = []
+        for fi, (bounding_boxes, bbox_type, landmarks) in enumerate(detector_results):
+            bbox_types += [bbox_type]
+            original_landmarks += [landmarks]
+            for bi, bbox in enumerate(bounding_boxes):
+                center, size = self._bbox_to_center_and_size(bbox, bbox_type)
+                crop_image_indices += [fi]
+                crop_centers += [center]
+                crop_sizes += [size]
+                crop_landmarks += [landmarks[bi]]
+
+        results = [([], [], [], bbox_types[fi], [], original_landmarks[fi]) for fi in range(len(images))]
+        if len(crop_centers) == 0:
+            return results
+
+        with torch.no_grad():
+            frames = torch.from_numpy(images).to(self.device).permute(0, 3, 1, 2).float() / 255.
+            crops, crop_dst_landmarks = bbpoint_warp_batch(frames, crop_centers, crop_sizes, self.image_size, 
+                image_indices=crop_image_indices, landmarks=crop_landmarks)
+            crops = (crops.clamp(0., 1.) * 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+            del frames
+
+        for ci, fi in enumerate(crop_image_indices):
+            detection_images, detection_centers, detection_sizes, _, detection_landmarks, _ = results[fi]
+            detection_images += [crops[ci]]
+            detection_centers += [crop_centers[ci]]
+            detection_sizes += [crop_sizes[ci]]
+            detection_landmarks += [crop_dst_landmarks[ci]]
+        return results
+
     # @profile
     def _detect_faces_in_image_wrapper(self, frame_list, fid, out_detection_folder, out_landmark_folder, bb_outfile,
                                        centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
@@ -227,7 +287,33 @@ class FaceDataModuleBase(pl.LightningDataModule):
         # fig = go.Figure(data=go.Image(z=frame,))
         # fig.show()
 
-        
+        self._save_detections_of_frame(frame_fname, fid, detection_ims, centers, sizes, bbox_type, landmarks, orig_landmarks,
+                                       out_detection_folder, out_landmark_folder, bb_outfile,
+                                       centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                       out_landmarks_all, out_landmarks_orig_all, out_bbox_type_all)
+        torch.cuda.empty_cache()
+
+    def _detect_faces_in_image_batch_wrapper(self, frames, frame_fnames, fids, out_detection_folder, out_landmark_folder, bb_outfile,
+                                       centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                       out_landmarks_all=None, out_landmarks_orig_all=None, out_bbox_type_all=None):
+        """
+        Batched counterpart of _detect_faces_in_image_wrapper. 
+        frames: list of already loaded frames, frame_fnames and fids are the corresponding names and frame indices.
+        """
+        results = self._detect_faces_in_image_batch(frames)
+        for frame_fname, fid, result in zip(frame_fnames, fids, results):
+            detection_ims, centers, sizes, bbox_type, landmarks, orig_landmarks = result
+            self._save_detections_of_frame(frame_fname, fid, detection_ims, centers, sizes, bbox_type, landmarks, orig_landmarks,
+                                        out_detection_folder, out_landmark_folder, bb_outfile,
+                                        centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                        out_landmarks_all, out_landmarks_orig_all, out_bbox_type_all)
+        torch.cuda.empty_cache()
+
+    def _save_detections_of_frame(self, frame_fname, fid, detection_ims, centers, sizes, bbox_type, landmarks, orig_landmarks,
+                                  out_detection_folder, out_landmark_folder, bb_outfile,
+                                  centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                  out_landmarks_all=None, out_landmarks_orig_all=None, out_bbox_type_all=None):
+        frame_fname = Path(frame_fname)
         centers_all += [centers]
         sizes_all += [sizes]
         if out_landmarks_all is not None:
@@ -264,11 +350,29 @@ class FaceDataModuleBase(pl.LightningDataModule):
         detection_fnames_all += [detection_fnames]
         landmark_fnames_all += [landmark_fnames]
 
-        torch.cuda.empty_cache()
-        checkpoint_frequency = 100
-        if fid % checkpoint_frequency == 0:
-            FaceDataModuleBase.save_detections(bb_outfile, detection_fnames_all, landmark_fnames_all,
-                                                centers_all, sizes_all, fid)
+        checkpoint_frequency = self._get_detection_checkpoint_frequency()
+        if len(centers_all) % checkpoint_frequency == 0:
+            self._commit_detections(bb_outfile, checkpoint_frequency, 
+                                    centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                    out_landmarks_all, out_landmarks_orig_all, out_bbox_type_all)
+
+    def _get_detection_checkpoint_frequency(self): 
+        return 100
+
+    def _commit_detections(self, detection_log_file, num_frames, 
+                           centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                           out_landmarks_all=None, out_landmarks_orig_all=None, out_bbox_type_all=None):
+        """
+        Appends the detections of the last num_frames frames to the detection log of the sequence.
+        """
+        if num_frames == 0:
+            return
+        start = len(centers_all) - num_frames
+        FaceDataModuleBase.append_detections(detection_log_file, start,
+            detection_fnames_all[start:], landmark_fnames_all[start:], centers_all[start:], sizes_all[start:],
+            out_landmarks_all[start:] if out_landmarks_all is not None else None, 
+            out_landmarks_orig_all[start:] if out_landmarks_orig_all is not None else None, 
+            out_bbox_type_all[start:] if out_bbox_type_all is not None else None)
 
 
     def _get_segmentation_method(self): 
@@ -503,6 +607,43 @@ class FaceDataModuleBase(pl.LightningDataModule):
             pkl.dump(last_frame_id, f)
             pkl.dump(landmark_fnames, f)
 
+    @staticmethod
+    def append_detections(fname, start_frame_id, detection_fnames, landmark_fnames, centers, sizes, 
+                          landmarks=None, landmarks_original=None, landmark_types=None):
+        chunk = {
+            "start_frame": start_frame_id,
+            "detection_fnames": detection_fnames,
+            "landmark_fnames": landmark_fnames,
+            "centers": centers,
+            "sizes": sizes,
+        }
+        if landmarks is not None:
+            chunk["landmarks"] = landmarks
+        if landmarks_original is not None:
+            chunk["landmarks_original"] = landmarks_original
+        if landmark_types is not None:
+            chunk["landmark_types"] = landmark_types
+        append_detection_log(fname, chunk)
+
+    @staticmethod
+    def load_appended_detections(fname):
+        """
+        Loads the committed part of a detection log written by append_detections. 
+        Returns a dict of per-frame lists (the same keys as the chunks) and the number of committed frames. 
+        """
+        detections = {}
+        num_frames = 0
+        for chunk in load_detection_log(fname):
+            if chunk["start_frame"] != num_frames: 
+                raise RuntimeError(f"Detection log '{fname}' is not contiguous. Expected a chunk starting at frame "
+                                   f"{num_frames} but got {chunk['start_frame']}")
+            for key, value in chunk.items():
+                if key == "start_frame":
+                    continue
+                detections.setdefault(key, []).extend(value)
+            num_frames += len(chunk["centers"])
+        return detections, num_frames
+
     @staticmethod
     def load_detections(fname):
         with open(fname, "rb" ) as f:
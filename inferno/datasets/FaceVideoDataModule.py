@@ -53,6 +53,7 @@ import torch.nn.functional as F
 from inferno.utils.batch import dict_to_device
 from inferno.datasets.VideoFaceDetectionDataset import VideoFaceDetectionDataset
 import types
+import itertools
 
 from inferno.utils.FaceDetector import save_landmark, save_landmark_v2
 
@@ -93,6 +94,10 @@ class FaceVideoDataModule(FaceDataModuleBase):
                  read_audio=True,
                  align_images=True,
                  return_mica_images = False,
+                 detection_batch_size = None,
+                 video_clip_cache_size_mb = None, # if set (and not preloading), the datasets keep decoded clips in a LRU cache of this size per worker
+                 video_clip_cache_readahead = False,
+                 video_clip_cache_log_every = None,
                  ):
         super().__init__(root_dir, output_dir,
                          processed_subfolder=processed_subfolder,
@@ -109,6 +114,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
                          bb_center_shift_x=bb_center_shift_x, # in relative numbers
                          bb_center_shift_y=bb_center_shift_y, # in relative numbers (i.e. -0.1 for 10% shift upwards, ...)
                          return_mica_images = return_mica_images,
+                         detection_batch_size = detection_batch_size,
                          )
         self.unpack_videos = unpack_videos
         self.detect_landmarks_on_restored_images = None
@@ -134,6 +140,9 @@ class FaceVideoDataModule(FaceDataModuleBase):
         self.include_processed_audio = include_processed_audio
         self.include_raw_audio = include_raw_audio
         self.preload_videos = preload_videos
+        self.video_clip_cache_size_mb = video_clip_cache_size_mb
+        self.video_clip_cache_readahead = video_clip_cache_readahead
+        self.video_clip_cache_log_every = video_clip_cache_log_every
         self.inflate_by_video_size = inflate_by_video_size
 
         self._must_include_audio = False
@@ -382,33 +391,60 @@ class FaceVideoDataModule(FaceDataModuleBase):
         sizes_all = []
         detection_fnames_all = []
         landmark_fnames_all = []
+        if self.save_landmarks_one_file: 
+            out_landmarks_all = [] # landmarks wrt to the aligned image
+            out_landmarks_original_all = [] # landmarks wrt to the original image
+            out_bbox_type_all = []
+        else: 
+            out_landmarks_all = None
+            out_landmarks_original_all = None
+            out_bbox_type_all = None
         # save_folder = frame_fname.parents[3] / 'detections'
 
-        # # TODO: resuming is not tested, probably doesn't work yet
-        # checkpoint_frequency = 100
-        # resume = False
-        # if resume and out_file.exists():
-        #     detection_fnames_all, landmark_fnames_all, centers_all, sizes_all, start_fid = \
-        #         FaceVideoDataModule.load_detections(out_file)
-        # else:
-        #     start_fid = 0
+        # detections are committed into an append-only log every few frames, 
+        # if a previous run got interrupted, resume from its last committed frame
+        out_file_detection_log = out_detection_folder / "bboxes_log.pkl"
+        start_fid = 0
+        if out_file_detection_log.is_file():
+            detections, start_fid = FaceVideoDataModule.load_appended_detections(out_file_detection_log)
+            if start_fid > 0:
+                print(f"Resuming face detection in sequence '{video_file}' from frame {start_fid}")
+                centers_all = detections["centers"]
+                sizes_all = detections["sizes"]
+                detection_fnames_all = detections["detection_fnames"]
+                landmark_fnames_all = detections["landmark_fnames"]
+                if self.save_landmarks_one_file: 
+                    out_landmarks_all = detections["landmarks"]
+                    out_landmarks_original_all = detections["landmarks_original"]
+                    out_bbox_type_all = detections["landmark_types"]
         #
         # # hack trying to circumvent memory leaks on the cluster
         # detector_instantion_frequency = 200
-        start_fid = 0
+        batch_size = self.detection_batch_size
+        fid = start_fid - 1
 
         if self.unpack_videos:
             frame_list = self.frame_lists[sequence_id]
-            fid = 0
             if len(frame_list) == 0:
                 print("Nothing to detect in: '%s'. All frames have been processed" % self.video_list[sequence_id])
-            for fid, frame_fname in enumerate(tqdm(range(start_fid, len(frame_list)))):
+            if batch_size is not None and batch_size > 1: 
+                for batch_start in tqdm(range(start_fid, len(frame_list), batch_size)):
+                    fids = list(range(batch_start, min(batch_start + batch_size, len(frame_list))))
+                    frames = [np.array(imread(Path(self.output_dir) / frame_list[i])) for i in fids]
+                    self._detect_faces_in_image_batch_wrapper(frames, [frame_list[i] for i in fids], fids, 
+                                                out_detection_folder, out_landmark_folder, out_file_detection_log,
+                                                centers_all, sizes_all, detection_fnames_all, landmark_fnames_all,
+                                                out_landmarks_all, out_landmarks_original_all, out_bbox_type_all)
+                    fid = fids[-1]
+            else:
+                for fid in tqdm(range(start_fid, len(frame_list))):
 
-                # if fid % detector_instantion_frequency == 0:
-                #     self._instantiate_detector(overwrite=True)
+                    # if fid % detector_instantion_frequency == 0:
+                    #     self._instantiate_detector(overwrite=True)
 
-                self._detect_faces_in_image_wrapper(frame_list, fid, out_detection_folder, out_landmark_folder, out_file_boxes,
-                                            centers_all, sizes_all, detection_fnames_all, landmark_fnames_all)
+                    self._detect_faces_in_image_wrapper(frame_list, fid, out_detection_folder, out_landmark_folder, out_file_detection_log,
+                                                centers_all, sizes_all, detection_fnames_all, landmark_fnames_all,
+                                                out_landmarks_all, out_landmarks_original_all, out_bbox_type_all)
 
         else: 
             num_frames = self.video_metas[sequence_id]['num_frames']
@@ -418,33 +454,43 @@ class FaceVideoDataModule(FaceDataModuleBase):
                 video_name = video_file = self._get_path_to_sequence_restored(
                     sequence_id, method=self.detect_landmarks_on_restored_images)
             assert video_name.is_file()
-            if start_fid == 0:
-                videogen =  vreader(str(video_name))
-                # videogen =  vread(str(video_name))
-                # for i in range(start_fid): 
-                    # _discarded_frame = next(videogen
-                # reader = skvideo.io.FFmpegReader(str(video_name))
-                # num_frames = videogen.getShape()[0]
-            else: 
-                videogen =  vread(str(video_name))
-
-            if self.save_landmarks_one_file: 
-                out_landmarks_all = [] # landmarks wrt to the aligned image
-                out_landmarks_original_all = [] # landmarks wrt to the original image
-                out_bbox_type_all = []
-            else: 
-                out_landmarks_all = None
-                out_landmarks_original_all = None
-                out_bbox_type_all = None
-
-            for fid in tqdm(range(start_fid, num_frames)):
-                try:
-                    self._detect_faces_in_image_wrapper(videogen, fid, out_detection_folder, out_landmark_folder, out_file_boxes,
+            videogen =  vreader(str(video_name))
+            # skip the frames that have already been processed (decoding only, no detection)
+            for _ in range(start_fid):
+                next(videogen)
+            # reader = skvideo.io.FFmpegReader(str(video_name))
+            # num_frames = videogen.getShape()[0]
+
+            if batch_size is not None and batch_size > 1:
+                # decode a whole batch of frames, detect and crop all of them at once
+                for batch_start in tqdm(range(start_fid, num_frames, batch_size)):
+                    frames = list(itertools.islice(videogen, min(batch_size, num_frames - batch_start)))
+                    if len(frames) == 0: 
+                        print(f"[WARNING] Reached the end of the video. Expected number of frames: {num_frames} but the video has only {batch_start} frames.")
+                        break
+                    fids = list(range(batch_start, batch_start + len(frames)))
+                    self._detect_faces_in_image_batch_wrapper(frames, [Path(f"{i:05d}.png") for i in fids], fids,
+                                                out_detection_folder, out_landmark_folder, out_file_detection_log,
                                                 centers_all, sizes_all, detection_fnames_all, landmark_fnames_all,
                                                 out_landmarks_all, out_landmarks_original_all, out_bbox_type_all)
-                except StopIteration as e:
-                    print(f"[WARNING] Reached the end of the video. Expected number of frames: {num_frames} but the video has only {fid} frames.")
-                    break
+                    fid = fids[-1]
+                    if len(frames) < batch_size and fid + 1 < num_frames: 
+                        print(f"[WARNING] Reached the end of the video. Expected number of frames: {num_frames} but the video has only {fid + 1} frames.")
+                        break
+            else:
+                for fid in tqdm(range(start_fid, num_frames)):
+                    try:
+                        self._detect_faces_in_image_wrapper(videogen, fid, out_detection_folder, out_landmark_folder, out_file_detection_log,
+                                                    centers_all, sizes_all, detection_fnames_all, landmark_fnames_all,
+                                                    out_landmarks_all, out_landmarks_original_all, out_bbox_type_all)
+                    except StopIteration as e:
+                        print(f"[WARNING] Reached the end of the video. Expected number of frames: {num_frames} but the video has only {fid} frames.")
+                        break
+
+        # commit the frames since the last checkpoint
+        self._commit_detections(out_file_detection_log, len(centers_all) % self._get_detection_checkpoint_frequency(), 
+                                centers_all, sizes_all, detection_fnames_all, landmark_fnames_all,
+                                out_landmarks_all, out_landmarks_original_all, out_bbox_type_all)
                                             
         if self.save_landmarks_one_file: 
             # saves all landmarks per video  
@@ -459,6 +505,9 @@ class FaceVideoDataModule(FaceDataModuleBase):
 
         FaceVideoDataModule.save_detections(out_file_boxes,
                                             detection_fnames_all, landmark_fnames_all, centers_all, sizes_all, fid)
+        # the sequence is finished and saved in the final format, the log is no longer needed
+        if out_file_detection_log.is_file():
+            out_file_detection_log.unlink()
         print("Done detecting faces in sequence: '%s'" % self.video_list[sequence_id])
         return 
 
@@ -647,7 +696,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
         
         from inferno.datasets.IO import load_segmentation_list, save_segmentation_list_v2
         seg_images, seg_types, seg_names = load_segmentation_list(old_file)
-        save_segmentation_list_v2(new_file, seg_images, seg_types, seg_names, overwrite=False, compression_level=1)
+        save_segmentation_list_v2(new_file, seg_images, seg_types, seg_names, overwrite=False)
 
     def _segment_faces_in_sequence(self, sequence_id, use_aligned_videos=False, segmentation_net=None):
         video_file = self.video_list[sequence_id]
@@ -1432,190 +1481,189 @@ class FaceVideoDataModule(FaceDataModuleBase):
                                        save_video=True, rec_methods='emoca', retarget_from=None, retarget_suffix=None):
         if retarget_from is not None:
             raise NotImplementedError("Retargeting is not implemented yet for _reconstruct_faces_in_sequence_v2")
-            import datetime
-            t = datetime.datetime.now()
-            t_str = t.strftime("%Y_%m_%d_%H-%M-%S")
-            suffix = f"_retarget_{t_str}_{str(hash(t_str))}" if retarget_suffix is None else retarget_suffix
-        else:
-            codedict_retarget = None
-            suffix = None
-
-        if not isinstance(rec_methods, list):
-            rec_methods = [rec_methods]
 
         print("Running face reconstruction in sequence '%s'" % self.video_list[sequence_id])
+        # a single sequence has nothing to prefetch, DataLoader workers would only add their startup 
+        # (and nest processes inside the workers of inferno.utils.local_executor)
+        self._reconstruct_faces_in_sequences_v2([sequence_id], device=device, rec_methods=rec_methods, num_workers=0)
+        print("Done running face reconstruction in sequence '%s'" % self.video_list[sequence_id])
 
-        out_folder = {}
-        out_file_shape = {}
-        out_file_appearance = {}
-        for rec_method in rec_methods:
-            out_folder[rec_method] = self._get_path_to_sequence_reconstructions(sequence_id, rec_method=rec_method, suffix=suffix)
-
-            # out_file_shape[rec_method] = out_folder[rec_method] / f"shape_pose_cam.pkl"
-            # out_file_appearance[rec_method] = out_folder[rec_method] / f"appearance.pkl"
-            out_file_shape[rec_method] = out_folder[rec_method] / f"shape_pose_cam.hdf5"
-            out_file_appearance[rec_method] = out_folder[rec_method] / f"appearance.hdf5"
-            out_folder[rec_method].mkdir(exist_ok=True, parents=True)
+    def _reconstruct_faces_in_sequences_v2(self, sequence_ids, device=None, rec_methods='emoca', num_workers=2):
+        """
+        Reconstructs the faces in the given sequences (see _run_sequence_pipeline). The sequences whose 
+        reconstructions already exist are skipped.
+        """
+        if not isinstance(rec_methods, list):
+            rec_methods = [rec_methods]
 
-        if retarget_from is not None:
-            raise NotImplementedError("Retargeting is not implemented yet for _reconstruct_faces_in_sequence_v2")
-            out_folder.mkdir(exist_ok=True, parents=True)
+        out_files = {}
+        for sequence_id in sequence_ids:
+            out_files[sequence_id] = {}
+            for rec_method in rec_methods:
+                out_folder = self._get_path_to_sequence_reconstructions(sequence_id, rec_method=rec_method, suffix=None)
+                out_files[sequence_id][rec_method] = (out_folder / f"shape_pose_cam.hdf5", out_folder / f"appearance.hdf5")
 
+        def exists(sequence_id, rec_method):
+            out_file_shape, out_file_appearance = out_files[sequence_id][rec_method]
+            return out_file_shape.is_file() and out_file_appearance.is_file()
 
-        exists = True
-        for rec_method in rec_methods:
-            if not out_file_shape[rec_method].is_file(): 
-                exists = False
-                break
-            if not out_file_appearance[rec_method].is_file():
-                exists = False
-                break
-        if exists: 
+        sequence_ids = [sid for sid in sequence_ids if not all(exists(sid, rec_method) for rec_method in rec_methods)]
+        if len(sequence_ids) == 0:
             return
 
         device = device or torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-        # reconstruction_net = reconstruction_net or self._get_reconstruction_net_v2(device, rec_method=rec_method)
-
-        # if retarget_from is not None:
-        #     image = imread(retarget_from)
-        #     batch_r = {}
-        #     batch_r["image"] = torch.from_numpy(image).float().unsqueeze(0).to(device)
-        #     # to torch channel format
-        #     batch_r["image"] = batch_r["image"].permute(0, 3, 1, 2)
-        #     batch_r["image"] = fixed_image_standardization(batch_r["image"])
-        #     with torch.no_grad():
-        #         codedict_retarget = reconstruction_net.encode(batch_r, training=False)
-
-
-        # video_writer = None
-        # if self.unpack_videos:
-        #     detections_fnames_or_images = sorted(list(in_folder.glob("*.png")))
-        # else:
-        #     from skvideo.io import vread
-        #     detections_fnames_or_images = vread(str(in_folder))
-             
-        dataset = self.get_single_video_dataset(sequence_id)
-        batch_size = 32
-        # batch_size = 64
-        loader = DataLoader(dataset, batch_size=batch_size, num_workers=0, shuffle=False)
 
-        for i, batch in enumerate(tqdm(loader)):
-            with torch.no_grad():
-                batch = dict_to_device(batch, device)
-                for rec_method in rec_methods:
-
-                    # import matplotlib.pyplot as plt
-                    # plt.figure()
-
-                    # im = batch['video'][0, 0].cpu().numpy() 
-                    # im = np.transpose(im, (1, 2, 0))
-                    # plt.imshow(im)
-                    # plt.show()
-
-                    if out_file_shape[rec_method].is_file() and  out_file_appearance[rec_method].is_file(): 
-                        continue
-                    batch_ = batch.copy()
-                    reconstruction_net = self._get_reconstruction_net_v2(device, rec_method=rec_method)
-                    result = reconstruction_net(batch_, input_key='video', output_prefix="")
-                    assert batch['video'].shape[0] == 1
-                    T = batch['video'].shape[1]
-                    result_keys_to_keep = ['shape', 'exp', 'jaw', 'global_pose', 'cam']
-                    shape_pose = {k: result[k].cpu().numpy() for k in result_keys_to_keep}
-                    assert shape_pose['shape'].shape[1] == T, f"{shape_pose['shape'].shape[1]} != {T}"
-                    result_keys_to_keep = ['tex', 'light', 'detail']
-                    appearance = {k: result[k].cpu().numpy() for k in result_keys_to_keep if k in result.keys()}
-
-                    # with open(out_file_shape, "wb") as f:
-                    #     hkl.dump(shape_pose, f) 
-                    # with open(out_file_appearance, "wb") as f:
-                    #     hkl.dump(appearance, f)
-                    # hkl.dump(shape_pose, out_file_shape[rec_method])
-                    # hkl.dump(appearance, out_file_appearance[rec_method])
-                    if out_file_shape[rec_method].suffix == '.hdf5':
-                        save_reconstruction_list_v2(out_file_shape[rec_method], shape_pose)
-                    elif out_file_shape[rec_method].suffix == '.pkl':
-                        save_reconstruction_list(out_file_shape[rec_method], shape_pose)
-                    else: 
-                        raise ValueError(f"Unknown file format {out_file_shape[rec_method].suffix}")
-                    if out_file_appearance[rec_method].suffix == '.hdf5':
-                        save_reconstruction_list_v2(out_file_appearance[rec_method], appearance)
-                    elif out_file_appearance[rec_method].suffix == '.pkl':
-                        save_reconstruction_list(out_file_appearance[rec_method], appearance)
-                    else:
-                        raise ValueError(f"Unknown file format {out_file_appearance[rec_method].suffix}")
-
-        print("Done running face reconstruction in sequence '%s'" % self.video_list[sequence_id])
+        def reconstruct(sequence_id, batch):
+            results = {}
+            for rec_method in rec_methods:
+                if exists(sequence_id, rec_method): 
+                    continue
+                batch_ = batch.copy()
+                reconstruction_net = self._get_reconstruction_net_v2(device, rec_method=rec_method)
+                result = reconstruction_net(batch_, input_key='video', output_prefix="")
+                assert batch['video'].shape[0] == 1
+                T = batch['video'].shape[1]
+                result_keys_to_keep = ['shape', 'exp', 'jaw', 'global_pose', 'cam']
+                shape_pose = {k: result[k].cpu().numpy() for k in result_keys_to_keep}
+                assert shape_pose['shape'].shape[1] == T, f"{shape_pose['shape'].shape[1]} != {T}"
+                result_keys_to_keep = ['tex', 'light', 'detail']
+                appearance = {k: result[k].cpu().numpy() for k in result_keys_to_keep if k in result.keys()}
+                results[rec_method] = (shape_pose, appearance)
+            return results
+
+        def write(sequence_id, results):
+            for rec_method, (shape_pose, appearance) in results.items():
+                out_file_shape, out_file_appearance = out_files[sequence_id][rec_method]
+                out_file_shape.parent.mkdir(exist_ok=True, parents=True)
+                if out_file_shape.suffix == '.hdf5':
+                    save_reconstruction_list_v2(out_file_shape, shape_pose)
+                elif out_file_shape.suffix == '.pkl':
+                    save_reconstruction_list(out_file_shape, shape_pose)
+                else: 
+                    raise ValueError(f"Unknown file format {out_file_shape.suffix}")
+                if out_file_appearance.suffix == '.hdf5':
+                    save_reconstruction_list_v2(out_file_appearance, appearance)
+                elif out_file_appearance.suffix == '.pkl':
+                    save_reconstruction_list(out_file_appearance, appearance)
+                else:
+                    raise ValueError(f"Unknown file format {out_file_appearance.suffix}")
 
+        self._run_sequence_pipeline(sequence_ids, reconstruct, write, device, num_workers=num_workers)
 
-    
     def _extract_emotion_in_sequence(self, sequence_id, emotion_net=None, device=None,
                                        emo_methods='resnet50',):
+        print("Running face emotion recognition in sequence '%s'" % self.video_list[sequence_id])
+        self._extract_emotion_in_sequences([sequence_id], device=device, emo_methods=emo_methods, num_workers=0)
+        print("Done running face emotion recognition in sequence '%s'" % self.video_list[sequence_id])
+
+    def _extract_emotion_in_sequences(self, sequence_ids, device=None, emo_methods='resnet50', num_workers=2):
+        """
+        Runs emotion recognition in the given sequences (see _run_sequence_pipeline). The sequences whose 
+        emotions already exist are skipped.
+        """
         if not isinstance(emo_methods, list):
             emo_methods = [emo_methods]
 
-        print("Running face emotion recognition in sequence '%s'" % self.video_list[sequence_id])
+        out_files = {}
+        for sequence_id in sequence_ids:
+            out_files[sequence_id] = {}
+            for emo_method in emo_methods:
+                out_folder = self._get_path_to_sequence_emotions(sequence_id, emo_method=emo_method)
+                out_files[sequence_id][emo_method] = (out_folder / f"emotions.hdf5", out_folder / f"features.hdf5")
 
-        out_folder = {}
-        out_file_emotion = {}
-        out_file_features = {}
-        for emo_method in emo_methods:
-            out_folder[emo_method] = self._get_path_to_sequence_emotions(sequence_id, emo_method=emo_method)
-            # out_file_emotion[emo_method] = out_folder[emo_method] / f"emotions.pkl"
-            # out_file_features[emo_method] = out_folder[emo_method] / f"features.pkl"
-            out_file_emotion[emo_method] = out_folder[emo_method] / f"emotions.hdf5"
-            out_file_features[emo_method] = out_folder[emo_method] / f"features.hdf5"
-            out_folder[emo_method].mkdir(exist_ok=True, parents=True)
+        def exists(sequence_id, emo_method):
+            out_file_emotion, out_file_features = out_files[sequence_id][emo_method]
+            return out_file_emotion.is_file() and out_file_features.is_file()
 
-        exists = True
-        for emo_method in emo_methods:
-            if not out_file_emotion[emo_method].is_file(): 
-                exists = False
-                break
-            if not out_file_features[emo_method].is_file():
-                exists = False
-                break
-        if exists: 
+        sequence_ids = [sid for sid in sequence_ids if not all(exists(sid, emo_method) for emo_method in emo_methods)]
+        if len(sequence_ids) == 0:
             return
 
         device = device or torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-        # emotion_net = emotion_net or self._get_emotion_recognition_net(device, rec_method=emo_method)
-             
-        dataset = self.get_single_video_dataset(sequence_id)
-        batch_size = 32
-        # batch_size = 64
-        loader = DataLoader(dataset, batch_size=batch_size, num_workers=0, shuffle=False)
 
-        for i, batch in enumerate(tqdm(loader)):
-            with torch.no_grad():
-                batch = dict_to_device(batch, device)
-                for emo_method in emo_methods:
-                    if out_file_emotion[emo_method].is_file() and out_file_features[emo_method].is_file(): 
-                        continue
-                    emotion_net = self._get_emotion_recognition_net(device, rec_method=emo_method)
-                    result = emotion_net(batch, input_key='video', output_prefix="")
-                    assert batch['video'].shape[0] == 1
-                    T = batch['video'].shape[1]
-                    result_keys_to_keep = ['expression', 'valence', 'arousal',]
-                    assert result['expression'].shape[1] == T, f"{result['expression'].shape[1]} != {T}"
-                    emotion_labels = {k: result[k].cpu().numpy() for k in result_keys_to_keep}
-                    result_keys_to_keep = ['feature',]
-                    emotion_features = {k: result[k].cpu().numpy() for k in result_keys_to_keep}
-                    
-                    # hkl.dump(emotion_labels, out_file_emotion[emo_method])
-                    # hkl.dump(emotion_features, out_file_features[emo_method])
-                    if out_file_emotion[emo_method].suffix == '.hdf5':
-                        save_emotion_list_v2(out_file_emotion[emo_method], emotion_labels)
-                    elif out_file_emotion[emo_method].suffix == '.pkl':
-                        save_emotion_list(out_file_emotion[emo_method], emotion_labels)
-                    else: 
-                        raise ValueError(f"Unknown file format {out_file_emotion[emo_method].suffix}")
-                    
-                    if out_file_features[emo_method].suffix == '.hdf5':
-                        save_emotion_list_v2(out_file_emotion[emo_method], emotion_labels)
-                    elif out_file_features[emo_method].suffix == '.pkl':
-                        save_emotion_list(out_file_features[emo_method], emotion_labels)
+        def recognize(sequence_id, batch):
+            results = {}
+            for emo_method in emo_methods:
+                if exists(sequence_id, emo_method): 
+                    continue
+                emotion_net = self._get_emotion_recognition_net(device, rec_method=emo_method)
+                result = emotion_net(batch, input_key='video', output_prefix="")
+                assert batch['video'].shape[0] == 1
+                T = batch['video'].shape[1]
+                result_keys_to_keep = ['expression', 'valence', 'arousal',]
+                assert result['expression'].shape[1] == T, f"{result['expression'].shape[1]} != {T}"
+                emotion_labels = {k: result[k].cpu().numpy() for k in result_keys_to_keep}
+                result_keys_to_keep = ['feature',]
+                emotion_features = {k: result[k].cpu().numpy() for k in result_keys_to_keep}
+                results[emo_method] = (emotion_labels, emotion_features)
+            return results
+
+        def write(sequence_id, results):
+            for emo_method, (emotion_labels, emotion_features) in results.items():
+                out_file_emotion, out_file_features = out_files[sequence_id][emo_method]
+                out_file_emotion.parent.mkdir(exist_ok=True, parents=True)
+                if out_file_emotion.suffix == '.hdf5':
+                    save_emotion_list_v2(out_file_emotion, emotion_labels)
+                elif out_file_emotion.suffix == '.pkl':
+                    save_emotion_list(out_file_emotion, emotion_labels)
+                else: 
+                    raise ValueError(f"Unknown file format {out_file_emotion.suffix}")
+                
+                if out_file_features.suffix == '.hdf5':
+                    save_emotion_list_v2(out_file_features, emotion_features)
+                elif out_file_features.suffix == '.pkl':
+                    save_emotion_list(out_file_features, emotion_features)
 
-        print("Done running face reconstruction in sequence '%s'" % self.video_list[sequence_id])
+        self._run_sequence_pipeline(sequence_ids, recognize, write, device, num_workers=num_workers)
+
+    def _run_sequence_pipeline(self, sequence_ids, process_fn, write_fn, device, num_workers=2, max_queue_size=2):
+        """
+        Runs process_fn(sequence_id, batch) -> results (the network, returns numpy arrays) 
+        and write_fn(sequence_id, results) for each of the sequences as a pipeline: 
+        DataLoader workers decode the next sequences into pinned memory, the network runs on the current one 
+        and a writer thread saves the results of the previous one. Prints the time spent in each stage.
+        """
+        import time
+        from torch.utils.data import ConcatDataset, Subset
+        from inferno.utils.pipeline import run_pipeline
+
+        # the whole sequence is the first (and only) sample of the single video dataset
+        dataset = ConcatDataset([Subset(self.get_single_video_dataset(sid), [0]) for sid in sequence_ids])
+        pin_memory = torch.device(device).type == 'cuda'
+        loader = DataLoader(dataset, batch_size=1, num_workers=num_workers, shuffle=False, pin_memory=pin_memory)
+        timings = {"decode": 0., "inference": 0., "write": 0.}
+
+        def decode():
+            batches = iter(loader)
+            for sequence_id in sequence_ids:
+                start = time.time()
+                batch = next(batches)
+                timings["decode"] += time.time() - start
+                yield sequence_id, batch
+
+        def infer(item):
+            sequence_id, batch = item
+            start = time.time()
+            with torch.no_grad(): # (grad mode is per thread)
+                batch = dict_to_device(batch, device, non_blocking=pin_memory)
+                results = process_fn(sequence_id, batch)
+            timings["inference"] += time.time() - start
+            return sequence_id, results
+
+        def write(item):
+            start = time.time()
+            write_fn(*item)
+            timings["write"] += time.time() - start
+            return item[0]
+
+        start = time.time()
+        for _ in tqdm(run_pipeline(decode(), [infer, write], max_queue_size=max_queue_size), total=len(sequence_ids)):
+            pass
+        total = time.time() - start
+        print(f"Processed {len(sequence_ids)} sequences in {total:.1f}s, time per stage (overlapping): " + 
+              ", ".join(f"{stage} {t:.1f}s" for stage, t in timings.items()) + 
+              f" (bottleneck: {max(timings, key=timings.get)})")
+        return timings
 
 
     def _reconstruction_video_of_sequence(self, 
@@ -2036,6 +2084,20 @@ class FaceVideoDataModule(FaceDataModuleBase):
     def num_sequences(self):
         return len(self.video_list)
 
+    def _process_locally(self, stages, video_indices=None, gpus=None, workers_per_gpu=1, 
+                         num_cpu_workers=None, threads_per_worker=None):
+        """
+        Runs the given stages of _process_video (e.g. ["detect_landmarks", "reconstruct_faces"]) over all (or the given) 
+        videos with a pool of local worker processes pinned to the available GPUs (see inferno.utils.local_executor).
+        The completion markers are kept in '<output_dir>/processing_markers' so reruns skip finished work.
+        """
+        from inferno.utils.local_executor import process_videos_locally
+        if video_indices is None:
+            video_indices = range(self.num_sequences)
+        return process_videos_locally(self, video_indices, stages, Path(self.output_dir) / "processing_markers", 
+            gpus=gpus, workers_per_gpu=workers_per_gpu, num_cpu_workers=num_cpu_workers, 
+            threads_per_worker=threads_per_worker)
+
     def _get_detection_for_sequence(self, sid):
         out_folder = self._get_path_to_sequence_detections(sid)
         out_file = out_folder / "bboxes.pkl"
@@ -2113,13 +2175,95 @@ class FaceVideoDataModule(FaceDataModuleBase):
         indices, labels, mean, cov, fnames = FaceVideoDataModule._load_recognitions(recognition_path)
         return indices, labels, mean, cov, fnames
 
+    def _composite_reconstruction_frames(self, frames, centers, sizes, vis_ims, mask_ims, detection_size, 
+                                         retarget_suffix=None, cat_dim=0, include_transparent=True, include_original=True, 
+                                         include_rec=True, black_background=False, use_mask=True):
+        """
+        Pastes the reconstruction visualizations back into a batch of frames and concatenates the requested versions 
+        (original with bounding boxes, reconstruction, transparent reconstruction). 
+        All the crops of the batch are warped back with one batched inverse warp and alpha-blended as tensor operations on self.device.
+        frames: B frames [H, W, 3], uint8 
+        centers, sizes: per frame, lists of the centers and sizes of its faces 
+        vis_ims, mask_ims: per frame, lists of the uint8 visualizations of its faces (of size detection_size) 
+            and the 'geometry_coarse' images they are masked with
+        Returns the composited frames as a uint8 array [B, H', W', 3]
+        """
+        from inferno.datasets.ImageDatasetHelpers import bbpoint_unwarp_batch, composite_crops_batch
+        frames = np.stack(frames, axis=0)[..., :3]
+        B, H, W = frames.shape[:3]
+
+        face_centers, face_sizes, face_vis, face_masks, image_indices, face_ranks = [], [], [], [], [], []
+        for fi in range(B):
+            for nd in range(len(vis_ims[fi])):
+                face_centers += [centers[fi][nd]]
+                face_sizes += [sizes[fi][nd]]
+                face_vis += [vis_ims[fi][nd][..., :3]]
+                face_masks += [mask_ims[fi][nd]]
+                image_indices += [fi]
+                face_ranks += [nd]
+
+        with torch.no_grad():
+            frames_t = torch.from_numpy(frames).to(self.device).permute(0, 3, 1, 2).float() / 255.
+            if retarget_suffix is not None or black_background is False:
+                background = frames_t
+            else:
+                background = torch.zeros_like(frames_t)
+            rec_frames = background
+            trans_frames = background
+            if len(face_vis) > 0:
+                vis = torch.from_numpy(np.stack(face_vis, axis=0)).to(self.device).permute(0, 3, 1, 2).float() / 255.
+                # a hacky way to get the mask
+                masks = np.stack([(np.prod(mask_im, axis=2) > 30) for mask_im in face_masks], axis=0)
+                if not use_mask:
+                    masks = np.ones_like(masks)
+                masks = torch.from_numpy(masks).to(self.device)[:, None].float()
+                if vis.shape[-2:] != (detection_size, detection_size):
+                    vis = F.interpolate(vis, size=(detection_size, detection_size), mode='bilinear', align_corners=False)
+                if masks.shape[-2:] != (detection_size, detection_size):
+                    masks = F.interpolate(masks, size=(detection_size, detection_size), mode='nearest')
+
+                warped = bbpoint_unwarp_batch(torch.cat([vis, masks], dim=1), face_centers, face_sizes, (H, W)).clamp(0., 1.)
+                warped_vis, warped_mask = warped[:, :3], warped[:, 3:]
+                rec_frames = composite_crops_batch(background, warped_vis, warped_mask, image_indices, face_ranks)
+                if include_transparent:
+                    trans_frames = composite_crops_batch(background, warped_vis, warped_mask * (196. / 255.), 
+                        image_indices, face_ranks)
+            rec_frames = (rec_frames * 255.).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+            if include_transparent:
+                trans_frames = (trans_frames * 255.).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+
+        if include_original:
+            frames_bb = np.ascontiguousarray(frames.copy())
+            for ci, fi in enumerate(image_indices):
+                bb = point2bbox(face_centers[ci], face_sizes[ci])
+                cv2.rectangle(frames_bb[fi], (int(bb[0, 0]), int(bb[0, 1])), (int(bb[2, 0]), int(bb[1, 1])), 
+                    (0, 128, 0), 5)
+
+        if cat_dim is None:
+            if H > W:
+                cat_dim = 1
+            else:
+                cat_dim = 0
+
+        im_list = [] 
+        if include_original: 
+            im_list += [frames_bb]
+        
+        if include_rec: 
+            im_list += [rec_frames] 
+
+        if include_transparent: 
+            im_list += [trans_frames]
+
+        return np.concatenate(im_list, axis=cat_dim + 1)
+
     def create_reconstruction_video(self, sequence_id, overwrite=False, distance_threshold=0.5,
                                     rec_method='emoca', image_type=None, retarget_suffix=None, cat_dim=0, include_transparent=True, 
                                     include_original=True, include_rec=True, black_background=False, use_mask=True, 
-                                    out_folder=None):
+                                    out_folder=None, batch_size=16):
         print("Include original: " + str(include_original)) 
         print("========================")
-        from PIL import Image, ImageDraw
+        from inferno.utils.pipeline import run_pipeline
         # fid = 0
         image_type = image_type or "geometry_detail"
         detection_fnames, centers, sizes, last_frame_id = self._get_detection_for_sequence(sequence_id)
@@ -2143,147 +2287,99 @@ class FaceVideoDataModule(FaceDataModuleBase):
                                                  overwrite=overwrite)
             return
 
-        writer = None  # cv2.VideoWriter()
-        broken = False
-        did = 0
-        for fid in tqdm(range(len(vid_frames))):
-            if broken:
-                break
-
-            frame_name = vid_frames[fid]
-            frame = imread(frame_name)
-
-            if len(centers) > 0 and len(sizes) > 0:
-                c = centers[fid]
-                s = sizes[fid]
-            else: 
-                c = [[frame.shape[0] / 2, frame.shape[0] / 2]]
-                s = frame.shape[0]
-
-
-            frame_pill_bb = Image.fromarray(frame)
-            if retarget_suffix is not None or black_background is False:
-                frame_deca_full = Image.fromarray(frame)
-                frame_deca_trans = Image.fromarray(frame)
-            else:
-                frame_deca_full = Image.fromarray(np.zeros_like( frame))
-                frame_deca_trans = Image.fromarray(np.zeros_like( frame))
-
-            frame_draw = ImageDraw.Draw(frame_pill_bb)
+        detection_size = [None]
 
-            for nd in range(len(c)):
-                detection_name = detection_fnames[fid][nd]
-
-                if did >= len(vis_fnames):
-                    broken = True
+        def load_frames():
+            # reads the frames and the visualizations of their faces from disk and groups them into batches
+            broken = False
+            did = 0
+            batch = []
+            for fid in range(len(vid_frames)):
+                if broken:
                     break
 
-                vis_name = vis_fnames[did]
-
-                if detection_name.stem not in str(vis_name) :
-                    print("%s != %s" % (detection_name.stem, vis_name.stem))
-                    raise RuntimeError("Detection and visualization filenames should match but they don't.")
-
-                try:
-                    detection_im = imread(self.output_dir / detection_name)
-                except:
-                    # ugly hack to deal with the old AffWild2 dataset
-                    detection_im = imread(self.output_dir / detection_name.relative_to(detection_name.parents[4]))
-                try:
-                    vis_im = imread(vis_name)
-                except ValueError as e:
-                    continue
-
-                im_r = vis_im.shape[0]
-                im_c = vis_im.shape[1]
-                num_ims = im_c // im_r
-
-                # if image_type == "coarse":
-                #     vis_im = vis_im[:, im_r*3:im_r*4, ...] # coarse
-                # elif image_type == "detail":
-                #     vis_im = vis_im[:, im_r*4:im_r*5, ...] # detail
-
-                    
-                # vis_im = vis_im[:, :, ...]
-
-                # vis_mask = np.prod(vis_im, axis=2) == 0
-                mask_name = vis_name.parent / "geometry_coarse.png"
-                mask_im = imread(mask_name)
-
-                # a hacky way to get the mask
-                vis_mask = (np.prod(mask_im, axis=2) > 30).astype(np.uint8) * 255
-                if not use_mask: 
-                    vis_mask = np.ones_like(vis_mask) * 255
-
-                # vis_im = np.concatenate([vis_im, vis_mask[..., np.newaxis]], axis=2)
-
-                warped_im = bbpoint_warp(vis_im, c[nd], s[nd], detection_im.shape[0],
-                                         output_shape=(frame.shape[0], frame.shape[1]), inv=False)
-                # warped_im = bbpoint_warp(vis_im, c[nd], s[nd], frame.shape[0], frame.shape[1], False)
-                warped_mask = bbpoint_warp(vis_mask, c[nd], s[nd], detection_im.shape[0],
-                                           output_shape=(frame.shape[0], frame.shape[1]), inv=False)
-                # warped_mask = bbpoint_warp(vis_mask, c[nd], s[nd], frame.shape[0], frame.shape[1], False)
-
-                # dst_image = bbpoint_warp(frame, c[nd], s[nd], warped_im.shape[0])
-                # frame2 = bbpoint_warp(dst_image, c[nd], s[nd], warped_im.shape[0], output_shape=(frame.shape[0], frame.shape[1]), inv=False)
-
-                # frame_pil = Image.fromarray(frame)
-                # frame_pil2 = Image.fromarray(frame)
-                vis_pil = Image.fromarray((warped_im * 255).astype(np.uint8))
-                mask_pil = Image.fromarray((warped_mask * 255).astype(np.uint8))
-                if include_transparent:
-                    mask_pil_transparent = Image.fromarray((warped_mask * 196).astype(np.uint8))
-
-                bb = point2bbox(c[nd], s[nd])
+                frame_name = vid_frames[fid]
+                frame = imread(frame_name)
+
+                if len(centers) > 0 and len(sizes) > 0:
+                    c = centers[fid]
+                    s = sizes[fid]
+                else: 
+                    c = [[frame.shape[0] / 2, frame.shape[0] / 2]]
+                    s = frame.shape[0]
+
+                face_centers = []
+                face_sizes = []
+                vis_ims = []
+                mask_ims = []
+                for nd in range(len(c)):
+                    detection_name = detection_fnames[fid][nd]
+
+                    if did >= len(vis_fnames):
+                        broken = True
+                        break
 
-                frame_draw.rectangle(((bb[0, 0], bb[0, 1],), (bb[2, 0], bb[1, 1],)),
-                                     outline='green', width=5)
-                frame_deca_full.paste(vis_pil, (0, 0), mask_pil)
-                if include_transparent:
-                    frame_deca_trans.paste(vis_pil, (0, 0), mask_pil_transparent)
-                # tform =
-                did += 1
+                    vis_name = vis_fnames[did]
 
-            final_im = np.array(frame_pill_bb)
-            final_im2 = np.array(frame_deca_full)
-            if include_transparent:
-                final_im3 = np.array(frame_deca_trans)
+                    if detection_name.stem not in str(vis_name) :
+                        print("%s != %s" % (detection_name.stem, vis_name.stem))
+                        raise RuntimeError("Detection and visualization filenames should match but they don't.")
 
-            if cat_dim is None:
-                if final_im.shape[0] > final_im.shape[1]:
-                    cat_dim = 1
-                else:
-                    cat_dim = 0
-            
-            im_list = [] 
-            if include_original: 
-                im_list += [final_im]
-            
-            if include_rec: 
-                im_list += [final_im2] 
+                    if detection_size[0] is None:
+                        # all the detections have the same size, only the first one needs to be read
+                        try:
+                            detection_im = imread(self.output_dir / detection_name)
+                        except:
+                            # ugly hack to deal with the old AffWild2 dataset
+                            detection_im = imread(self.output_dir / detection_name.relative_to(detection_name.parents[4]))
+                        detection_size[0] = detection_im.shape[0]
+                    try:
+                        vis_im = imread(vis_name)
+                    except ValueError as e:
+                        continue
 
-            if include_transparent: 
-                im_list += [final_im3]
+                    mask_name = vis_name.parent / "geometry_coarse.png"
+                    mask_im = imread(mask_name)
 
-            im = np.concatenate(im_list, axis=cat_dim)
+                    face_centers += [c[nd]]
+                    face_sizes += [s[nd]]
+                    vis_ims += [vis_im]
+                    mask_ims += [mask_im]
+                    did += 1
 
-            # if include_transparent:
-            #     im = np.concatenate([final_im, final_im2, final_im3], axis=cat_dim)
-            # else: 
-            #     im = np.concatenate([final_im, final_im2,], axis=cat_dim)
+                batch += [(frame, face_centers, face_sizes, vis_ims, mask_ims)]
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if len(batch) > 0:
+                yield batch
+
+        def composite(batch):
+            frames, face_centers, face_sizes, vis_ims, mask_ims = zip(*batch)
+            return self._composite_reconstruction_frames(frames, face_centers, face_sizes, vis_ims, mask_ims, 
+                detection_size[0] or self.image_size, 
+                retarget_suffix=retarget_suffix, cat_dim=cat_dim, include_transparent=include_transparent, 
+                include_original=include_original, include_rec=include_rec, black_background=black_background, 
+                use_mask=use_mask)
 
-            if writer is None:
-                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-                # outfile = str(vis_folder / "video.mp4")
-                
-                # fps = int(self.video_metas[sequence_id]['fps'].split('/')[0])
-                fps = int(self.video_metas[sequence_id]['fps'].split('/')[0]) / int(self.video_metas[sequence_id]['fps'].split('/')[1])
-                writer = cv2.VideoWriter(str(outfile), cv2.CAP_FFMPEG,
-                                         fourcc, fps,
-                                         (im.shape[1], im.shape[0]), True)
-                
-            im_cv = cv2.cvtColor(im, cv2.COLOR_RGB2BGR)
-            writer.write(im_cv)
+        writer = None  # cv2.VideoWriter()
+        pbar = tqdm(total=len(vid_frames))
+        for ims in run_pipeline(load_frames(), [composite]):
+            for im in ims:
+                if writer is None:
+                    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                    # outfile = str(vis_folder / "video.mp4")
+                    
+                    # fps = int(self.video_metas[sequence_id]['fps'].split('/')[0])
+                    fps = int(self.video_metas[sequence_id]['fps'].split('/')[0]) / int(self.video_metas[sequence_id]['fps'].split('/')[1])
+                    writer = cv2.VideoWriter(str(outfile), cv2.CAP_FFMPEG,
+                                             fourcc, fps,
+                                             (im.shape[1], im.shape[0]), True)
+                    
+                im_cv = cv2.cvtColor(im, cv2.COLOR_RGB2BGR)
+                writer.write(im_cv)
+            pbar.update(len(ims))
+        pbar.close()
         writer.release()
         outfile_with_sound = attach_audio_to_reconstruction_video(outfile, self.root_dir / self.video_list[sequence_id])
         return outfile, outfile_with_sound
@@ -3686,7 +3782,8 @@ class TestFaceVideoDM(FaceVideoDataModule):
                  detect = True,
                  batch_size=8,
                  num_workers=4,
-                 device=None):
+                 device=None,
+                 detection_batch_size=None):
         self.video_path = Path(video_path)
         self.batch_size = batch_size
         self.num_workers = num_workers
@@ -3697,7 +3794,8 @@ class TestFaceVideoDM(FaceVideoDataModule):
                  face_detector_threshold,
                  image_size,
                  scale,
-                 device)
+                 device, 
+                 detection_batch_size=detection_batch_size)
     
     def prepare_data(self, *args, **kwargs):
         outdir = Path(self.output_dir)
@@ -3745,6 +3843,14 @@ class TestFaceVideoDM(FaceVideoDataModule):
             detected_faces = [np.array([0,0, width, height]) ]
             return super()._detect_faces_in_image(image_path, detected_faces)
 
+    def _detect_faces_in_image_batch(self, images, detected_faces=None):
+        if self.detect:
+            return super()._detect_faces_in_image_batch(images, None)
+        else: 
+            # the images are already detections, the whole image is the face
+            detected_faces = [[np.array([0, 0, image.shape[1], image.shape[0]])] for image in images]
+            return super()._detect_faces_in_image_batch(images, detected_faces)
+
     def _get_path_to_sequence_results(self, sequence_id, rec_method='EMOCA', suffix=''):
         return self._get_path_to_sequence_files(sequence_id, "results", rec_method, suffix)
 
@@ -3793,6 +3899,81 @@ class TestFaceVideoDM(FaceVideoDataModule):
     def test_dataloader(self, *args, **kwargs) -> Union[DataLoader, List[DataLoader]]:
         return DataLoader(self.testdata, batch_size=self.batch_size, num_workers=self.num_workers, shuffle=False)
 
+    def reconstruct_video_streaming(self, process_fn, rec_method='emoca', image_type=None, cat_dim=0,
+                                    include_transparent=True, include_original=True, include_rec=True,
+                                    black_background=False, use_mask=True, out_folder=None, max_queue_size=4):
+        """
+        Frame-free counterpart of prepare_data + setup + create_reconstruction_video.
+        The video is decoded, detected, cropped, reconstructed, composited and encoded in one pass,
+        with each stage running in its own thread and bounded queues in between, so no frames, detections
+        or visualizations are written to disk and only a few batches of frames are held in memory at a time.
+        process_fn: a function that takes a batch {"image": float tensor [N, 3, H, W] in [0, 1]} of face crops
+        and returns a tuple (vis_ims, mask_ims) of uint8 arrays [N, H', W', 3] (the visualization of image_type
+        and the 'geometry_coarse' image used to compute the mask)
+        Returns the path to the output video and the path to the video with sound.
+        """
+        from inferno.utils.pipeline import run_pipeline
+        image_type = image_type or "geometry_detail"
+        if not hasattr(self, "video_metas") or self.video_metas is None or len(self.video_metas) == 0:
+            self._gather_data(exist_ok=True)
+
+        if out_folder is None:
+            out_folder = self._get_path_to_sequence_results(0, rec_method=rec_method)
+        out_folder = Path(out_folder)
+        out_folder.mkdir(parents=True, exist_ok=True)
+        outfile = out_folder / ("video_" + image_type + ".mp4")
+        fps = int(self.video_metas[0]['fps'].split('/')[0]) / int(self.video_metas[0]['fps'].split('/')[1])
+
+        def decode():
+            reader = vreader(str(self.root_dir / self.video_list[0]))
+            while True:
+                frames = list(itertools.islice(reader, self.batch_size))
+                if len(frames) == 0:
+                    return
+                yield frames
+
+        def detect(frames):
+            return frames, self._detect_faces_in_image_batch(frames)
+
+        def reconstruct(item):
+            frames, detections = item
+            crops = [crop for detection in detections for crop in detection[0]]
+            vis_ims, mask_ims = [], []
+            if len(crops) > 0:
+                images = torch.from_numpy(np.stack(crops, axis=0)).permute(0, 3, 1, 2).float() / 255.
+                vis_ims, mask_ims = process_fn({"image": images})
+            return frames, detections, vis_ims, mask_ims
+
+        def composite(item):
+            frames, detections, vis_ims, mask_ims = item
+            face_vis, face_masks = [], []
+            ci = 0
+            for detection in detections:
+                num_faces = len(detection[0])
+                face_vis += [list(vis_ims[ci:ci + num_faces])]
+                face_masks += [list(mask_ims[ci:ci + num_faces])]
+                ci += num_faces
+            return self._composite_reconstruction_frames(frames, [d[1] for d in detections], [d[2] for d in detections],
+                face_vis, face_masks, self.image_size,
+                cat_dim=cat_dim, include_transparent=include_transparent, include_original=include_original,
+                include_rec=include_rec, black_background=black_background, use_mask=use_mask)
+
+        print("Creating reconstruction video for '%s' " % (self.video_list[0]))
+        writer = None
+        for composited in tqdm(run_pipeline(decode(), [detect, reconstruct, composite], max_queue_size=max_queue_size)):
+            for im in composited:
+                if writer is None:
+                    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                    writer = cv2.VideoWriter(str(outfile), cv2.CAP_FFMPEG, fourcc, fps,
+                                             (im.shape[1], im.shape[0]), True)
+                writer.write(cv2.cvtColor(im, cv2.COLOR_RGB2BGR))
+        if writer is None:
+            print("[WARNING] No frames were decoded from '%s'" % (self.video_list[0]))
+            return None, None
+        writer.release()
+        outfile_with_sound = attach_audio_to_reconstruction_video(outfile, self.root_dir / self.video_list[0], overwrite=True)
+        return outfile, outfile_with_sound
+
 
 def alpha_blend(A, B):
     """
@@ -0,0 +1,106 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import torch
+from torch.utils.data import default_collate
+from inferno.datasets.IO import save_feature_list_v2
+from inferno.utils.batch import dict_to_device
+
+
+def audio_encoder_extractor(audio_model):
+    """
+    Extractor for a frozen audio encoder (Wav2Vec2Encoder). The feature is served as 'audio_feature_cached',
+    the encoder then only applies its dropout.
+    Note: the feature is computed over the whole audio track, so the (transformer) context differs from
+    the one of a training clip and the cached features are close to but not exactly the per-clip ones.
+    """
+    def extract(batch):
+        sample = {key: value for key, value in batch.items() if key in ["raw_audio", "samplerate", "processed_audio"]}
+        T = sample["raw_audio"].shape[1] if "raw_audio" in sample.keys() else None
+        dropout = audio_model.dropout
+        audio_model.dropout = None # the dropout is applied at training time on top of the cached feature
+        try:
+            sample = audio_model(sample, train=False, desired_output_length=T)
+        finally:
+            audio_model.dropout = dropout
+        return {"audio_feature_cached": sample["audio_feature"]}
+    return extract
+
+
+def emoca_extractor(preprocessor, input_key="video", output_prefix="gt_"):
+    """
+    Extractor for EmocaPreprocessor. Caches the per-frame codes of the encoder, the preprocessor then
+    only does the (clip dependent) shape averaging and the FLAME decoding.
+    """
+    def extract(batch):
+        images = batch[input_key]
+        B, T, C, H, W = images.shape
+        values = preprocessor.encode(images.view(B*T, C, H, W))
+        return {preprocessor.cached_code_key(output_prefix, code): values[code].view(B, T, -1)
+                for code in preprocessor.cached_codes if code in values.keys()}
+    return extract
+
+
+def preprocessor_extractor(preprocessor, input_key="video", output_prefix="gt_"):
+    """
+    Extractor for preprocessors with per-frame outputs that skip themselves if their outputs are already
+    in the batch (EmotionRecognitionPreprocessor, SpeechEmotionRecognitionPreprocessor).
+    All the new per-frame outputs are cached under their output names.
+    """
+    def extract(batch):
+        T = batch[input_key].shape[1]
+        keys = set(batch.keys())
+        batch_ = preprocessor(dict(batch), input_key, output_prefix=output_prefix)
+        return {key: value for key, value in batch_.items()
+                if key not in keys and isinstance(value, torch.Tensor) and value.ndim >= 2 and value.shape[1] == T}
+    return extract
+
+
+def extract_feature_cache(dataset, feature_type, extractors, device=None, overwrite=False):
+    """
+    Runs frozen modules over whole videos of a VideoDatasetBase and saves their per-frame outputs into
+    '<output_dir>/features/<feature_type>/<video>/features.hdf5' (see VideoDatasetBase._path_to_features).
+    A dataset created with feature_cache_types=[feature_type] then serves the features sliced by start_frame
+    and the models skip the frozen modules.
+    :param dataset: a VideoDatasetBase returning whole videos (sequence_length="all", no temporal split, no augmentation)
+    :param feature_type: name of the cache (for instance the name of the frozen model)
+    :param extractors: list of functions batch -> dict of per-frame tensors [1, T, ...]
+        (see audio_encoder_extractor, emoca_extractor, preprocessor_extractor)
+    """
+    from tqdm import auto
+    assert dataset.sequence_length == "all", "The features are extracted from whole videos, set sequence_length='all'"
+    assert dataset.temporal_split_start is None, "The features are extracted from whole videos, do not use a temporal split"
+    assert not dataset.inflate_by_video_size and not dataset.hack_length, "Each video must be visited exactly once"
+    device = device or torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    for i in auto.tqdm(range(len(dataset.video_indices)), desc=f"Extracting features '{feature_type}'"):
+        out_folder = dataset._path_to_features(i, feature_type)
+        out_file = out_folder / "features.hdf5"
+        if out_file.is_file() and not overwrite:
+            continue
+        batch = default_collate([dataset[i]])
+        batch = dict_to_device(batch, device)
+        num_frames = dataset._get_num_frames(i)
+        features = {}
+        with torch.no_grad():
+            for extractor in extractors:
+                features.update(extractor(batch))
+        features = {key: value[:, :num_frames].cpu().numpy() for key, value in features.items()}
+        out_folder.mkdir(parents=True, exist_ok=True)
+        save_feature_list_v2(out_file, features, overwrite=overwrite)
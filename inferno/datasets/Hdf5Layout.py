@@ -0,0 +1,185 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import os
+import time
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+import h5py
+from inferno.datasets.IO import HDF5_LAYOUT_VERSION, DEFAULT_CHUNK_FRAMES, DEFAULT_SEGMENTATION_CHUNK_FRAMES, \
+    _save_hdf5_dict, _load_hdf5_dict, save_segmentation_list_v2, load_segmentation_list_v2
+
+
+def hdf5_file_kind(filename):
+    """
+    Returns "segmentation" (save_segmentation_list_v2), "dict" (reconstructions, emotions and features, 
+    see _save_hdf5_dict), "landmarks" (save_landmark_list_v3) or None for other files.
+    """
+    with h5py.File(filename, 'r') as f:
+        keys = set(f.keys())
+        if {"frames", "frame_types", "frame_names"} <= keys:
+            return "segmentation"
+        if {"landmarks", "validity"} <= keys:
+            return "landmarks"
+        if len(keys) > 0 and all(isinstance(f[key], h5py.Dataset) and f[key].ndim >= 2 for key in keys):
+            return "dict"
+    return None
+
+
+def hdf5_layout_version(filename):
+    with h5py.File(filename, 'r') as f:
+        return int(f.attrs.get("layout_version", 0))
+
+
+def migrate_hdf5_file(filename, out_filename=None, chunk_frames=None, compression=None, compression_level=None):
+    """
+    Rewrites a segmentation or reconstruction/emotion/feature file in the current (chunked, frame-major) layout.
+    The file is written under a temporary name and moved over out_filename (the input file by default).
+    The landmark files are kept as they are (they are contiguous on purpose, to be memory-mapped).
+    Returns True if the file was rewritten.
+    """
+    filename = Path(filename)
+    out_filename = Path(out_filename) if out_filename is not None else filename
+    kind = hdf5_file_kind(filename)
+    if kind not in ["segmentation", "dict"]:
+        return False
+    tmp_filename = out_filename.parent / (out_filename.stem + f".tmp{os.getpid()}" + out_filename.suffix)
+    out_filename.parent.mkdir(parents=True, exist_ok=True)
+    if kind == "segmentation":
+        seg_images, seg_types, seg_names = load_segmentation_list_v2(filename)
+        seg_types = [t.decode() if isinstance(t, bytes) else t for t in seg_types]
+        seg_names = [n.decode() if isinstance(n, bytes) else n for n in seg_names]
+        save_segmentation_list_v2(tmp_filename, seg_images, seg_types, seg_names, overwrite=True,
+                                  compression=compression or "gzip", compression_level=compression_level,
+                                  chunk_frames=chunk_frames or DEFAULT_SEGMENTATION_CHUNK_FRAMES)
+    else:
+        data = _load_hdf5_dict(filename)
+        _save_hdf5_dict(data, tmp_filename, overwrite=True, compression=compression, compression_level=compression_level,
+                        chunk_frames=chunk_frames or DEFAULT_CHUNK_FRAMES)
+    os.replace(tmp_filename, out_filename)
+    return True
+
+
+def migrate_hdf5_directory(root, pattern="**/*.hdf5", force=False, **layout_kwargs):
+    """
+    Migrates all the segmentation, reconstruction, emotion and feature files under root in place 
+    (files already in the current layout are skipped unless force=True).
+    """
+    from tqdm import auto
+    files = sorted(Path(root).glob(pattern))
+    migrated = 0
+    for filename in auto.tqdm(files, desc="Migrating HDF5 files"):
+        if not force and hdf5_layout_version(filename) >= HDF5_LAYOUT_VERSION:
+            continue
+        try:
+            migrated += int(migrate_hdf5_file(filename, **layout_kwargs))
+        except OSError as e:
+            print(f"[WARNING] Could not migrate '{filename}': {e}")
+    print(f"Migrated {migrated} of {len(files)} files")
+    return migrated
+
+
+def benchmark_window_reads(filename, window=64, num_reads=200, seed=0):
+    """
+    Measures random window reads (the access pattern of VideoDatasetBase with a fixed sequence_length) from a file.
+    Returns the mean read time in milliseconds.
+    """
+    kind = hdf5_file_kind(filename)
+    if kind == "segmentation":
+        load = load_segmentation_list_v2
+        with h5py.File(filename, 'r') as f:
+            num_frames = f["frames"].shape[0]
+    elif kind == "dict":
+        load = _load_hdf5_dict
+        with h5py.File(filename, 'r') as f:
+            key = next(iter(f.keys()))
+            num_frames = f[key].shape[0 if f.attrs.get("layout_version", 0) >= 1 else 1]
+    else:
+        raise ValueError(f"Unsupported file '{filename}'")
+    rng = np.random.RandomState(seed)
+    window = min(window, num_frames)
+    starts = rng.randint(0, num_frames - window + 1, num_reads)
+    start = time.time()
+    for s in starts:
+        load(filename, s, s + window)
+    return (time.time() - start) / num_reads * 1000.
+
+
+def benchmark_layouts(num_frames=3000, window=64, num_reads=200, seg_resolution=256, 
+                      compressions=(None, "lzf", "gzip", "blosc")):
+    """
+    Writes synthetic reconstruction and segmentation files of a long video in the legacy and the chunked layouts 
+    and compares the size and the speed of random window reads.
+    """
+    rng = np.random.RandomState(0)
+    reconstructions = {
+        "shape": rng.randn(1, num_frames, 300).astype(np.float32),
+        "exp": rng.randn(1, num_frames, 100).astype(np.float32),
+        "jaw": rng.randn(1, num_frames, 3).astype(np.float32),
+    }
+    # blocky masks (similar to face segmentations, they compress well)
+    seg_images = np.zeros((num_frames, seg_resolution, seg_resolution), dtype=np.uint8)
+    y, x = np.mgrid[:seg_resolution, :seg_resolution]
+    for t in range(num_frames):
+        c = seg_resolution / 2 + 10 * np.sin(t / 25.)
+        seg_images[t][(y - c) ** 2 + (x - seg_resolution / 2) ** 2 < (seg_resolution / 3) ** 2] = 1 + t % 3
+    seg_types = ["face"] * num_frames
+    seg_names = [f"{t:06d}" for t in range(num_frames)]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        configs = [("legacy", dict(layout_version=0))] + \
+            [(f"chunked/{c}", dict(compression=c)) for c in compressions if c != "gzip"]
+        for name, kwargs in configs:
+            filename = tmp / f"rec_{name.replace('/', '_')}.hdf5"
+            _save_hdf5_dict(reconstructions, filename, overwrite=True, **kwargs)
+            results["reconstruction " + name] = (filename.stat().st_size, benchmark_window_reads(filename, window, num_reads))
+
+        # the legacy segmentation layout: gzip with h5py's automatic chunking
+        filename = tmp / "seg_legacy.hdf5"
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset("frames", data=seg_images, compression="gzip", compression_opts=1)
+            f.create_dataset("frame_types", data=seg_types, dtype=h5py.special_dtype(vlen=str))
+            f.create_dataset("frame_names", data=seg_names, dtype=h5py.special_dtype(vlen=str))
+        results["segmentation legacy/gzip"] = (filename.stat().st_size, benchmark_window_reads(filename, window, num_reads))
+        for c in compressions:
+            filename = tmp / f"seg_chunked_{c}.hdf5"
+            save_segmentation_list_v2(filename, seg_images, seg_types, seg_names, overwrite=True, compression=c)
+            results[f"segmentation chunked/{c}"] = (filename.stat().st_size, benchmark_window_reads(filename, window, num_reads))
+
+    print(f"Random {window}-frame window reads from a {num_frames}-frame video:")
+    for name, (size, ms) in results.items():
+        print(f"{name:>32}: {size / 2**20:8.2f} MB, {ms:7.2f} ms/read")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrates processed HDF5 files to the chunked layout or benchmarks the layouts")
+    parser.add_argument("root", nargs="?", default=None, help="Directory to migrate (runs the synthetic benchmark if not given)")
+    parser.add_argument("--compression", default=None, choices=["lzf", "gzip", "blosc"])
+    parser.add_argument("--chunk_frames", type=int, default=None)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    if args.root is None:
+        benchmark_layouts()
+    else:
+        migrate_hdf5_directory(args.root, force=args.force, compression=args.compression, chunk_frames=args.chunk_frames)
@@ -18,6 +18,7 @@ All rights reserved.
 """
 
 
+import os
 import pickle as pkl
 import compress_pickle as cpkl
 import hickle as hkl
@@ -25,6 +26,46 @@ from pathlib import Path
 import numpy as np
 from timeit import default_timer as timer
 import h5py
+try:
+    import hdf5plugin # registers the blosc filter (optional, only needed for blosc compressed files)
+except ImportError:
+    hdf5plugin = None
+
+
+# Version of the HDF5 layout written by _save_hdf5_dict (stored in the 'layout_version' attribute of the file)
+#  0 - (no attribute) arrays with a leading batch dimension of 1 ([1, T, ...]), contiguous, uncompressed
+#  1 - frame-major arrays ([T, ...]) stored in chunks of whole frames, optionally compressed
+HDF5_LAYOUT_VERSION = 1
+# frames per chunk, a random window of W frames reads at most W + 2 * chunk_frames frames
+DEFAULT_CHUNK_FRAMES = 16
+DEFAULT_SEGMENTATION_CHUNK_FRAMES = 4
+
+
+def hdf5_compression_kwargs(compression, compression_level=None):
+    """
+    Returns the h5py create_dataset arguments of a compressor: None, "lzf" (fast, always available), 
+    "gzip" or "blosc" (fastest, requires hdf5plugin, falls back to lzf if it is not installed)
+    """
+    if compression is None:
+        return {}
+    if compression == "lzf":
+        return {"compression": "lzf"}
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": 1 if compression_level is None else compression_level}
+    if compression == "blosc":
+        if hdf5plugin is None:
+            print("[WARNING] hdf5plugin is not installed, using lzf instead of blosc compression")
+            return {"compression": "lzf"}
+        return dict(hdf5plugin.Blosc(cname="lz4", clevel=5 if compression_level is None else compression_level, 
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError(f"Unknown compression '{compression}'")
+
+
+def _frame_chunks(shape, chunk_frames):
+    # chunks of whole frames (all the other dimensions are kept complete)
+    if len(shape) == 0 or shape[0] == 0:
+        return None
+    return (min(chunk_frames, shape[0]),) + tuple(shape[1:])
 
 
 def _load_hickle_file(filename, start_frame=None, end_frame=None):
@@ -60,8 +101,8 @@ def save_reconstruction_list(filename, reconstructions):
     _save_hickle_file(reconstructions, filename)
     # hkl.dump(reconstructions, filename)
 
-def save_reconstruction_list_v2(filename, reconstructions, overwrite=False):
-    _save_hdf5_dict(reconstructions, filename)
+def save_reconstruction_list_v2(filename, reconstructions, overwrite=False, **layout_kwargs):
+    _save_hdf5_dict(reconstructions, filename, overwrite, **layout_kwargs)
 
 
 def load_reconstruction_list_v2(filename, start_frame=None, end_frame=None):
@@ -81,14 +122,19 @@ def save_emotion_list(filename, emotions):
 def _load_hdf5_dict(filename, start_frame=None, end_frame=None):
     data_dict = {}
     with h5py.File(filename, 'r') as f:
+        frame_major = f.attrs.get("layout_version", 0) >= 1
         for key in f.keys():
             dset = f[key]
             if start_frame is None:
                 start_frame = 0
-            if end_frame is None:
-                end_frame = dset.shape[1]
-            # for some reason we saved the data with a leading batch dimension of size 1, so let's just run with it
-            data_dict[key] = dset[:, start_frame:end_frame]
+            if frame_major:
+                # only the chunks of the requested frames are read, the batch dimension is added for the callers 
+                data_dict[key] = dset[start_frame:end_frame][np.newaxis]
+            else:
+                if end_frame is None:
+                    end_frame = dset.shape[1]
+                # for some reason we saved the data with a leading batch dimension of size 1, so let's just run with it
+                data_dict[key] = dset[:, start_frame:end_frame]
     return data_dict
 
 
@@ -108,22 +154,81 @@ def _load_hdf5_group_dict(filename, start_frame=None, end_frame=None):
     return data_dict
 
 
-def _save_hdf5_dict(data_dict, filename, overwrite=False):
+def _save_hdf5_dict(data_dict, filename, overwrite=False, layout_version=HDF5_LAYOUT_VERSION, 
+                    chunk_frames=DEFAULT_CHUNK_FRAMES, compression=None, compression_level=None):
+    """
+    Saves a dict of per-frame arrays [1, T, ...] (the leading batch dimension is kept in the API for backwards compatibility).
+    """
     if not overwrite and Path(filename).exists():
         raise RuntimeError(f"File '{filename}' already exists. Set overwrite=True to overwrite.")
     
     with h5py.File(filename, 'w') as f:
+        if layout_version == 0:
+            for key, data in data_dict.items():
+                dset = f.create_dataset(key, data.shape, dtype=data.dtype)
+                dset[:] = data
+            return
+        f.attrs["layout_version"] = layout_version
         for key, data in data_dict.items():
-            dset = f.create_dataset(key, data.shape, dtype=data.dtype)
-            dset[:] = data
+            data = np.asarray(data)
+            assert data.shape[0] == 1, f"Expected a leading batch dimension of 1 for '{key}', got shape {data.shape}"
+            data = data[0]
+            f.create_dataset(key, data=data, chunks=_frame_chunks(data.shape, chunk_frames), 
+                             **hdf5_compression_kwargs(compression, compression_level))
+
+
+def append_detection_log(filename, chunk):
+    """
+    Appends one chunk (a dict of per-frame detection results) to an append-only detection log. 
+    Only the new chunk is written (constant work per chunk) and it is flushed to disk right away, 
+    so that an interrupted run can resume from the last committed chunk.
+    """
+    with open(filename, "ab") as f:
+        pkl.dump(chunk, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_detection_log(filename, repair=True):
+    """
+    Loads all committed chunks of a detection log (see append_detection_log). A partially written 
+    chunk at the end of the file (the run died while writing it) is discarded and, if repair=True, 
+    cut off the file so that new chunks can be appended after the last valid one.
+    """
+    chunks = []
+    committed_size = 0
+    with open(filename, "rb") as f:
+        while True:
+            try:
+                chunk = pkl.load(f)
+            except (EOFError, pkl.UnpicklingError, ValueError):
+                break
+            chunks += [chunk]
+            committed_size = f.tell()
+    if repair and committed_size < Path(filename).stat().st_size:
+        print(f"[WARNING] Discarding an incomplete chunk at the end of detection log '{filename}'")
+        with open(filename, "r+b") as f:
+            f.truncate(committed_size)
+    return chunks
 
 
 def load_emotion_list_v2(filename, start_frame=None, end_frame=None):
     return _load_hdf5_dict(filename, start_frame, end_frame)
 
 
-def save_emotion_list_v2(filename, emotions, overwrite=False):
-    _save_hdf5_dict(emotions, filename, overwrite)
+def save_emotion_list_v2(filename, emotions, overwrite=False, **layout_kwargs):
+    _save_hdf5_dict(emotions, filename, overwrite, **layout_kwargs)
+
+
+def load_feature_list_v2(filename, start_frame=None, end_frame=None):
+    return _load_hdf5_dict(filename, start_frame, end_frame)
+
+
+def save_feature_list_v2(filename, features, overwrite=False, **layout_kwargs):
+    """
+    Saves precomputed per-frame features (dict of arrays [1, T, ...], same layout as the v2 reconstructions and emotions)
+    """
+    _save_hdf5_dict(features, filename, overwrite, **layout_kwargs)
 
 
 def save_segmentation_list(filename, seg_images, seg_types, seg_names):
@@ -148,7 +253,8 @@ def load_segmentation_list(filename):
     return seg_images, seg_types, seg_names
 
 
-def save_segmentation_list_v2(filename, seg_images, seg_types, seg_names, overwrite=False, compression_level=1):
+def save_segmentation_list_v2(filename, seg_images, seg_types, seg_names, overwrite=False, compression_level=1, 
+                              compression="gzip", chunk_frames=DEFAULT_SEGMENTATION_CHUNK_FRAMES):
     if not overwrite and Path(filename).exists():
         raise RuntimeError(f"File '{filename}' already exists. Set overwrite=True to overwrite.")
     
@@ -156,7 +262,11 @@ def save_segmentation_list_v2(filename, seg_images, seg_types, seg_names, overwr
         seg_images = np.stack(seg_images, axis=0)
 
     with h5py.File(filename, 'w') as f:
-        dset = f.create_dataset("frames", seg_images.shape, dtype=seg_images.dtype, compression="gzip", compression_opts=compression_level)
+        f.attrs["layout_version"] = HDF5_LAYOUT_VERSION
+        # chunks of whole frames, a window read decompresses only its own frames
+        dset = f.create_dataset("frames", seg_images.shape, dtype=seg_images.dtype, 
+                                chunks=_frame_chunks(seg_images.shape, chunk_frames), 
+                                **hdf5_compression_kwargs(compression, compression_level))
         dset[:] = seg_images
     
         dset_types = f.create_dataset("frame_types", (len(seg_types),), dtype=h5py.special_dtype(vlen=str))
@@ -181,6 +291,106 @@ def load_segmentation_list_v2(filename, start_frame=None, end_frame=None):
     return seg_images, seg_types, seg_names
 
 
+def save_landmark_list_v3(filename, landmark_list, landmark_shape=None, max_faces=None, overwrite=False):
+    """
+    Saves a per-video landmark list (for each frame a list of [K, D] arrays, one per detected face) 
+    as a fixed-shape [T, max_faces, K, D] float32 array and a [T, max_faces] validity mask. 
+    Missing faces are zero-padded and marked invalid, faces beyond max_faces are dropped. 
+    The datasets are stored contiguous and uncompressed so that they can be memory-mapped 
+    and sliced by frame (see open_landmark_list_v3 and load_landmark_list_v3).
+    landmark_shape: (K, D) fallback, only used if there is no detection at all in the video
+    """
+    if not overwrite and Path(filename).exists():
+        raise RuntimeError(f"File '{filename}' already exists. Set overwrite=True to overwrite.")
+
+    for frame_landmarks in landmark_list:
+        if len(frame_landmarks) > 0:
+            landmark_shape = np.asarray(frame_landmarks[0]).shape
+            break
+    if landmark_shape is None:
+        raise ValueError(f"Cannot infer the landmark shape for '{filename}' (no detections), please specify landmark_shape")
+    if max_faces is None: 
+        max_faces = max([len(frame_landmarks) for frame_landmarks in landmark_list] + [1])
+
+    num_frames = len(landmark_list)
+    landmarks = np.zeros((num_frames, max_faces, *landmark_shape), dtype=np.float32)
+    validity = np.zeros((num_frames, max_faces), dtype=bool)
+    for fi, frame_landmarks in enumerate(landmark_list):
+        for di in range(min(len(frame_landmarks), max_faces)):
+            landmarks[fi, di] = frame_landmarks[di]
+            validity[fi, di] = True
+    _write_landmark_arrays_v3(filename, landmarks, validity)
+
+
+def _write_landmark_arrays_v3(filename, landmarks, validity):
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset("landmarks", data=landmarks)
+        f.create_dataset("validity", data=validity)
+
+
+def open_landmark_list_v3(filename):
+    """
+    Opens the landmarks and the validity mask of a file saved with save_landmark_list_v3 as read-only memory maps. 
+    Nothing is read until the arrays are sliced and the pages are shared by all processes that open the same file.
+    """
+    arrays = []
+    with h5py.File(filename, 'r') as f:
+        for key in ["landmarks", "validity"]:
+            dset = f[key]
+            offset = dset.id.get_offset()
+            if offset is None: # not contiguous (or empty), fall back to reading it
+                arrays += [dset[()]]
+            else:
+                arrays += [np.memmap(filename, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset)]
+    return arrays[0], arrays[1]
+
+
+def load_landmark_list_v3(filename, start_frame=None, end_frame=None):
+    with h5py.File(filename, 'r') as f:
+        dset = f["landmarks"]
+        dset_validity = f["validity"]
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = dset.shape[0]
+        landmarks = dset[start_frame:end_frame]
+        validity = dset_validity[start_frame:end_frame]
+    return landmarks, validity
+
+
+def convert_landmark_list_to_v3(filename, out_filename=None, landmark_shape=None, max_faces=None, overwrite=False):
+    """
+    Converts a pickled per-video landmark list (as saved by FaceDataModuleBase.save_landmark_list) 
+    into the fixed-shape format of save_landmark_list_v3. By default, the result is saved next to the pickle with an .hdf5 suffix.
+    """
+    out_filename = out_filename or Path(filename).with_suffix(".hdf5")
+    with open(filename, "rb") as f:
+        landmark_list = pkl.load(f)
+    save_landmark_list_v3(out_filename, landmark_list, landmark_shape=landmark_shape, max_faces=max_faces, overwrite=overwrite)
+    return out_filename
+
+
+def convert_aligned_landmark_list_to_v3(filename, used_frame_indices_filename, out_filename=None, overwrite=False):
+    """
+    Converts the landmarks of an aligned video (landmarks_aligned_video_smoothed.pkl, one [K, D] array per frame, 
+    including the interpolated frames) into the format of save_landmark_list_v3 with one face per frame. 
+    Only the frames listed in used_frame_indices_filename (landmarks_alignment_used_frame_indices.pkl) are valid, 
+    as in VideoDatasetBaseV2. By default, the result is saved next to the pickle with an .hdf5 suffix.
+    """
+    out_filename = out_filename or Path(filename).with_suffix(".hdf5")
+    if not overwrite and Path(out_filename).exists():
+        raise RuntimeError(f"File '{out_filename}' already exists. Set overwrite=True to overwrite.")
+    with open(filename, "rb") as f:
+        landmark_list = pkl.load(f)
+    with open(used_frame_indices_filename, "rb") as f:
+        used_frame_indices = pkl.load(f)
+    landmarks = np.stack(landmark_list, axis=0).astype(np.float32)[:, np.newaxis]
+    validity = np.zeros((landmarks.shape[0], 1), dtype=bool)
+    validity[used_frame_indices] = True
+    _write_landmark_arrays_v3(out_filename, landmarks, validity)
+    return out_filename
+
+
 def load_segmentation(filename):
     with open(filename, "rb") as f:
         seg = cpkl.load(f, compression='gzip')
@@ -19,6 +19,8 @@ All rights reserved.
 
 
 import numpy as np
+import torch
+import torch.nn.functional as F
 from skimage.transform import estimate_transform, warp
 
 
@@ -67,8 +69,16 @@ def point2transform(center, size, target_size_height, target_size_width):
 
 
 def bbpoint_warp(image, center, size, target_size_height, target_size_width=None, output_shape=None, inv=True, landmarks=None, 
-        order=3 # order of interpolation, bicubic by default
+        order=3, # order of interpolation, bicubic by default
+        backend="skimage", # 'skimage', 'cv2' or 'torch', see bbpoint_warp_images
         ):
+    if backend != "skimage":
+        if landmarks is None:
+            return bbpoint_warp_images(image[None], [center], [size], target_size_height, target_size_width, 
+                output_shape=output_shape, inv=inv, order=order, backend=backend)[0]
+        dst_image, dst_landmarks = bbpoint_warp_images(image[None], [center], [size], target_size_height, target_size_width, 
+            output_shape=output_shape, inv=inv, landmarks=[landmarks], order=order, backend=backend)
+        return dst_image[0], dst_landmarks[0]
     target_size_width = target_size_width or target_size_height
     tform = point2transform(center, size, target_size_height, target_size_width)
     tf = tform.inverse if inv else tform
@@ -93,4 +103,289 @@ def bbpoint_warp(image, center, size, target_size_height, target_size_width=None
             dst_landmarks[key] = tf_lmk(landmarks[key][:, :2])
     else: 
         raise ValueError("landmarks must be np.ndarray, list or dict")
-    return dst_image, dst_landmarks
\ No newline at end of file
+    return dst_image, dst_landmarks
+
+def _warp_order_to_grid_sample_mode(order):
+    if order == 0:
+        return 'nearest'
+    elif order == 1:
+        return 'bilinear'
+    elif order == 3:
+        return 'bicubic'
+    raise ValueError(f"Interpolation order {order} is not supported by grid_sample (use 0, 1 or 3)")
+
+
+def _transform_landmarks(tform_params, landmarks):
+    lmk = np.asarray(landmarks)[:, :2]
+    lmk = np.concatenate([lmk, np.ones((lmk.shape[0], 1), dtype=lmk.dtype)], axis=1) @ tform_params.T
+    return lmk[:, :2] / lmk[:, 2:3]
+
+
+def _grid_sample_affine(images, inverse_maps, output_shape, order=3):
+    """
+    Warps images [N, C, H, W] (torch) with one grid_sample call. 
+    inverse_maps: [N, 3, 3] matrices mapping output pixels to input pixels (the inverse map, as in skimage's warp)
+    """
+    N, C, H, W = images.shape
+    out_h, out_w = output_shape
+    inverse_maps = torch.as_tensor(np.asarray(inverse_maps), device=images.device, dtype=images.dtype)
+    # output pixel -> input pixel, expressed in grid_sample's normalized coordinates (align_corners=True)
+    ys, xs = torch.meshgrid(torch.arange(out_h, device=images.device, dtype=images.dtype),
+                            torch.arange(out_w, device=images.device, dtype=images.dtype), 
+                            indexing='ij')
+    dst_pts = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(1, -1, 3)
+    src_pts = dst_pts @ inverse_maps.transpose(1, 2)
+    src_pts = src_pts[..., :2] / src_pts[..., 2:3]
+    scale = torch.tensor([2. / max(W - 1, 1), 2. / max(H - 1, 1)], device=images.device, dtype=images.dtype)
+    grid = (src_pts * scale - 1.).view(N, out_h, out_w, 2)
+    return F.grid_sample(images, grid, mode=_warp_order_to_grid_sample_mode(order), 
+        padding_mode='zeros', align_corners=True)
+
+
+def _warp_order_to_cv2_interpolation(order):
+    import cv2
+    if order == 0:
+        return cv2.INTER_NEAREST
+    elif order == 1:
+        return cv2.INTER_LINEAR
+    elif order == 3:
+        return cv2.INTER_CUBIC
+    raise ValueError(f"Interpolation order {order} is not supported by cv2.warpAffine (use 0, 1 or 3)")
+
+
+def _clip_to_input_range(warped, image):
+    # skimage's warp clips the output to the range of the input (and the zero fill value), 
+    # cubic interpolation of cv2/grid_sample overshoots at strong edges otherwise
+    return np.clip(warped, min(float(image.min()), 0.), max(float(image.max()), 0.), out=warped)
+
+
+def _transform_landmarks_any(tform_params, landmarks):
+    # the same landmark containers as bbpoint_warp accepts (array, list of arrays, dict of arrays)
+    if isinstance(landmarks, np.ndarray):
+        return _transform_landmarks(tform_params, landmarks)
+    elif isinstance(landmarks, list): 
+        return [_transform_landmarks(tform_params, lmk) for lmk in landmarks]
+    elif isinstance(landmarks, dict): 
+        return {key: _transform_landmarks(tform_params, lmk) for key, lmk in landmarks.items()}
+    raise ValueError("landmarks must be np.ndarray, list or dict")
+
+
+def bbpoint_warp_images(images, centers, sizes, target_size_height, target_size_width=None, output_shape=None, inv=True, 
+        landmarks=None, order=3, backend="cv2", device=None):
+    """
+    Batched drop-in for bbpoint_warp. Warps N images with their own crop (center, size) and returns the same 
+    results as calling bbpoint_warp on each of them (up to interpolation differences of the backends). 
+    images: [N, H, W, C] or [N, H, W] array (or a list of arrays of the same shape), uint8 or float. 
+        As with skimage, uint8 images are converted to float in [0, 1], float images are kept as they are.
+    centers: [N, 2] crop centers, sizes: [N] crop sizes
+    inv: if True (default), crops are cut out of the images. If False, the images are crops that get pasted back 
+        into an image of output_shape.
+    landmarks: optional list of N landmark arrays (or lists/dicts of arrays, as in bbpoint_warp)
+    backend: 
+        'cv2' - cv2.warpAffine per image on the CPU, float32
+        'torch' - one grid_sample call for the whole batch (on 'device', the images' device if they are a tensor)
+        'skimage' - the reference implementation (bbpoint_warp in a loop)
+        The cv2 and torch outputs are clipped to the range of the input image, as skimage's warp does. 
+        Their cubic kernels differ slightly from skimage's, on natural (smooth) images the results agree to within 
+        a few 1/255 (see tests/test_image_dataset_helpers.py and benchmark_bbpoint_warp), at hard edges the difference 
+        can be larger.
+    Returns: 
+        warped: float32 array [N, h, w, C] (or [N, h, w])
+        dst_landmarks: list of N transformed landmarks (only if landmarks are given)
+    """
+    target_size_width = target_size_width or target_size_height
+    output_shape = tuple(output_shape or (target_size_height, target_size_width))
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(-1)
+    N = centers.shape[0]
+
+    # the forward maps (input pixel -> output pixel), the same as the ones bbpoint_warp uses for landmarks
+    tforms = [point2transform(centers[i], sizes[i], target_size_height, target_size_width).params for i in range(N)]
+    if not inv:
+        tforms = [np.linalg.inv(tform) for tform in tforms]
+    tforms = np.stack(tforms, axis=0) if N > 0 else np.zeros((0, 3, 3))
+
+    if backend == "skimage":
+        warped = [bbpoint_warp(images[i], centers[i], sizes[i], target_size_height, target_size_width, 
+            output_shape=output_shape, inv=inv, order=order) for i in range(N)]
+        warped = np.stack(warped, axis=0).astype(np.float32) if N > 0 else np.zeros((0,) + output_shape, dtype=np.float32)
+    elif backend == "cv2":
+        import cv2
+        interpolation = _warp_order_to_cv2_interpolation(order)
+        warped = []
+        for i in range(N):
+            image = np.asarray(images[i])
+            image = image.astype(np.float32) / 255. if image.dtype == np.uint8 else image.astype(np.float32)
+            warped += [_clip_to_input_range(cv2.warpAffine(image, tforms[i][:2], (output_shape[1], output_shape[0]), 
+                flags=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=0), image)]
+            if image.ndim == 3 and warped[-1].ndim == 2:
+                warped[-1] = warped[-1][..., None] # cv2 drops the singleton channel dimension
+        warped = np.stack(warped, axis=0) if N > 0 else np.zeros((0,) + output_shape, dtype=np.float32)
+    elif backend == "torch":
+        if isinstance(images, torch.Tensor):
+            images_t = images.to(device) if device is not None else images
+        else:
+            images_t = torch.from_numpy(np.stack([np.asarray(im) for im in images], axis=0)).to(device or 'cpu')
+        if images_t.dtype == torch.uint8:
+            images_t = images_t.float() / 255.
+        images_t = images_t.float()
+        squeeze = images_t.ndim == 3
+        if squeeze:
+            images_t = images_t[..., None]
+        with torch.no_grad():
+            warped = _grid_sample_affine(images_t.permute(0, 3, 1, 2), np.linalg.inv(tforms), output_shape, order)
+            # clip to the range of each input image (and the zero fill value), as skimage's warp does
+            reduce_dims = tuple(range(1, images_t.ndim))
+            lo = images_t.amin(dim=reduce_dims).clamp(max=0.).view(-1, 1, 1, 1)
+            hi = images_t.amax(dim=reduce_dims).clamp(min=0.).view(-1, 1, 1, 1)
+            warped = torch.max(torch.min(warped, hi), lo)
+        warped = warped.permute(0, 2, 3, 1).cpu().numpy()
+        if squeeze:
+            warped = warped[..., 0]
+    else:
+        raise ValueError(f"Unknown warp backend '{backend}'")
+
+    if landmarks is None:
+        return warped
+    dst_landmarks = [_transform_landmarks_any(tforms[i], landmarks[i]) for i in range(N)]
+    return warped, dst_landmarks
+
+
+def bbpoint_warp_batch(images, centers, sizes, target_size_height, target_size_width=None, image_indices=None, 
+        landmarks=None, order=3):
+    """
+    Batched version of bbpoint_warp (for the default inv=True case). Crops N faces out of a batch of images 
+    with a single grid_sample call, on whatever device the images live on.
+    images: torch tensor [B, C, H, W], float 
+    centers: [N, 2] array of crop centers (in pixels of the source images)
+    sizes: [N] array of crop sizes (in pixels of the source images)
+    image_indices: [N] index of the source image of each crop, defaults to one crop per image (arange(N))
+    landmarks: optional list of N arrays [K, D] (D >= 2) in source image coordinates
+    Returns: 
+        crops: torch tensor [N, C, target_size_height, target_size_width]
+        dst_landmarks: list of N arrays [K, 2] (only if landmarks are given)
+    """
+    target_size_width = target_size_width or target_size_height
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(-1)
+    N = centers.shape[0]
+    if image_indices is None:
+        image_indices = np.arange(N)
+    B, C, H, W = images.shape
+
+    # the same similarity transforms as in bbpoint_warp (source -> crop)
+    tforms = np.stack([point2transform(centers[i], sizes[i], target_size_height, target_size_width).params 
+        for i in range(N)], axis=0)
+
+    if N == 0:
+        crops = images.new_zeros((0, C, target_size_height, target_size_width))
+    else:
+        source = images[torch.as_tensor(image_indices, device=images.device, dtype=torch.long)]
+        crops = _grid_sample_affine(source, np.linalg.inv(tforms), (target_size_height, target_size_width), order)
+
+    if landmarks is None:
+        return crops
+    dst_landmarks = [_transform_landmarks(tforms[i], landmarks[i]) for i in range(N)]
+    return crops, dst_landmarks
+
+
+def bbpoint_unwarp_batch(crops, centers, sizes, output_shape, order=3):
+    """
+    Inverse of bbpoint_warp_batch (the batched counterpart of bbpoint_warp with inv=False). Pastes N crops 
+    back into the coordinate frame of their source images with a single grid_sample call. 
+    crops: torch tensor [N, C, h, w], float 
+    centers: [N, 2] array of crop centers (in pixels of the source images)
+    sizes: [N] array of crop sizes (in pixels of the source images)
+    output_shape: (H, W) of the source images
+    Returns: 
+        warped: torch tensor [N, C, H, W], each crop in the coordinates of its source image (zero outside of the crop)
+    """
+    N, C, h, w = crops.shape
+    H, W = output_shape
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(-1)
+    if N == 0:
+        return crops.new_zeros((0, C, H, W))
+
+    # source pixel -> crop pixel
+    tforms = np.stack([point2transform(centers[i], sizes[i], h, w).params for i in range(N)], axis=0)
+    return _grid_sample_affine(crops, tforms, (H, W), order)
+
+
+def composite_crops_batch(frames, crops, alphas, image_indices, face_ranks=None):
+    """
+    Alpha-blends crops that have already been warped into the coordinates of their frames 
+    (e.g. by bbpoint_unwarp_batch) over the frames, as a few batched array operations. 
+    frames: torch tensor [B, C, H, W] 
+    crops: torch tensor [N, C, H, W]
+    alphas: torch tensor [N, 1, H, W] in [0, 1]
+    image_indices: [N] index of the frame of each crop 
+    face_ranks: [N] order in which the crops of the same frame are pasted (later crops go over earlier ones), 
+        defaults to the order of the crops
+    Returns the blended frames [B, C, H, W] 
+    """
+    image_indices = np.asarray(image_indices, dtype=np.int64).reshape(-1)
+    if face_ranks is None:
+        face_ranks = np.zeros_like(image_indices)
+        for i in range(1, len(image_indices)):
+            face_ranks[i] = np.sum(image_indices[:i] == image_indices[i])
+    face_ranks = np.asarray(face_ranks, dtype=np.int64).reshape(-1)
+    out = frames.clone()
+    # faces of the same rank come from different frames, so each rank is blended in one go
+    for rank in range(int(face_ranks.max()) + 1 if len(face_ranks) > 0 else 0):
+        sel = np.nonzero(face_ranks == rank)[0]
+        idx = torch.as_tensor(image_indices[sel], device=frames.device, dtype=torch.long)
+        sel = torch.as_tensor(sel, device=frames.device, dtype=torch.long)
+        a = alphas[sel]
+        out[idx] = out[idx] * (1. - a) + crops[sel] * a
+    return out
+
+
+def benchmark_bbpoint_warp(num_images=64, image_shape=(480, 640), crop_size=224, backends=("skimage", "cv2", "torch"), 
+        order=3, repeats=3, device=None, seed=0):
+    """
+    Compares the warp backends of bbpoint_warp_images against the skimage reference (bbpoint_warp) 
+    on random uint8 frames and crops: throughput (images per second, best of 'repeats') and numerical agreement 
+    (max and mean absolute difference of the crops in [0, 1], max difference of the warped landmarks in pixels).
+    """
+    import time
+    rng = np.random.RandomState(seed)
+    H, W = image_shape
+    images = rng.randint(0, 256, size=(num_images, H, W, 3)).astype(np.uint8)
+    sizes = rng.uniform(0.3, 0.6, size=num_images) * min(H, W)
+    centers = np.stack([rng.uniform(W * 0.3, W * 0.7, size=num_images), rng.uniform(H * 0.3, H * 0.7, size=num_images)], axis=1)
+    landmarks = [np.stack([rng.uniform(0, W, size=68), rng.uniform(0, H, size=68)], axis=1) for _ in range(num_images)]
+
+    results = {}
+    reference = None
+    for backend in backends:
+        timings = []
+        for _ in range(repeats):
+            start = time.time()
+            warped, warped_landmarks = bbpoint_warp_images(images, centers, sizes, crop_size, landmarks=landmarks, 
+                order=order, backend=backend, device=device)
+            if backend == "torch" and device is not None and torch.device(device).type == "cuda":
+                torch.cuda.synchronize()
+            timings += [time.time() - start]
+        if reference is None:
+            reference = bbpoint_warp_images(images, centers, sizes, crop_size, landmarks=landmarks, order=order, backend="skimage")
+        diff = np.abs(warped - reference[0])
+        # the borders of the crops differ the most (different handling of the samples that fall outside of the image)
+        inner = diff[:, 2:-2, 2:-2]
+        results[backend] = {
+            "images_per_second": num_images / min(timings),
+            "max_abs_diff": float(diff.max()),
+            "mean_abs_diff": float(diff.mean()),
+            "inner_max_abs_diff": float(inner.max()),
+            "landmark_max_diff": float(max(np.abs(a - b).max() for a, b in zip(warped_landmarks, reference[1]))),
+        }
+        print(f"{backend:>8}: {results[backend]['images_per_second']:9.1f} im/s, "
+              f"max diff {results[backend]['max_abs_diff']:.4f} (inner {results[backend]['inner_max_abs_diff']:.4f}), "
+              f"mean diff {results[backend]['mean_abs_diff']:.5f}, landmark diff {results[backend]['landmark_max_diff']:.2e}")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_bbpoint_warp()
+    if torch.cuda.is_available():
+        benchmark_bbpoint_warp(backends=("skimage", "torch"), device="cuda")
@@ -59,6 +59,10 @@ class LRS3DataModule(FaceVideoDataModule):
                 segmentation_source=None,
                 segmentation_type =None,
                 return_mica_images=False,
+                detection_batch_size=None,
+                video_clip_cache_size_mb=None,
+                video_clip_cache_readahead=False,
+                video_clip_cache_log_every=None,
                 ):
         super().__init__(root_dir, output_dir, processed_subfolder, 
             face_detector, face_detector_threshold, image_size, scale, device, 
@@ -72,8 +76,12 @@ class LRS3DataModule(FaceVideoDataModule):
             include_processed_audio = include_processed_audio,
             include_raw_audio = include_raw_audio,
             preload_videos=preload_videos,
+            video_clip_cache_size_mb=video_clip_cache_size_mb,
+            video_clip_cache_readahead=video_clip_cache_readahead,
+            video_clip_cache_log_every=video_clip_cache_log_every,
             inflate_by_video_size=inflate_by_video_size,
             return_mica_images=return_mica_images,
+            detection_batch_size=detection_batch_size,
             )
         self.detect_landmarks_on_restored_images = landmarks_from
         self.batch_size_train = batch_size_train
@@ -352,6 +360,14 @@ class LRS3DataModule(FaceVideoDataModule):
         num_shards = int(np.ceil( self.num_sequences / videos_per_shard))
         return num_shards
 
+    def _get_reconstruction_methods_to_process(self):
+        # return ['emoca', 'spectre',]
+        return ['EMICA-CVT_flame2020',]
+        # return ['EMICA-CVT_flame2023',]
+
+    def _get_emotion_methods_to_process(self):
+        return ['resnet50', ]
+
     def _process_video(self, idx, extract_audio=True, restore_videos=True, 
             detect_landmarks=True, segment_videos=True, reconstruct_faces=False, 
             recognize_emotions=False,):
@@ -365,15 +381,13 @@ class LRS3DataModule(FaceVideoDataModule):
             self._segment_faces_in_sequence(idx)
             # raise NotImplementedError()
         if reconstruct_faces: 
-            # rec_methods = ['emoca', 'spectre',]
-            rec_methods = ['EMICA-CVT_flame2020',]
-            # rec_methods = ['EMICA-CVT_flame2023',]
+            rec_methods = self._get_reconstruction_methods_to_process()
             self._reconstruct_faces_in_sequence_v2(
                                     idx, reconstruction_net=None, device=None,
                                     save_obj=False, save_mat=True, save_vis=False, save_images=False,
                                     save_video=False, rec_methods=rec_methods, retarget_from=None, retarget_suffix=None)
         if recognize_emotions:
-            emo_methods = ['resnet50', ]
+            emo_methods = self._get_emotion_methods_to_process()
             self._extract_emotion_in_sequence(idx, emo_methods=emo_methods)
   
 
@@ -393,9 +407,10 @@ class LRS3DataModule(FaceVideoDataModule):
         
         for i in range(start_idx, end_idx):
             idx = idxs[i]
+            # the network stages run on the whole shard below (one pipelined loader over the videos)
             self._process_video(idx, extract_audio=extract_audio, restore_videos=restore_videos,
-                detect_landmarks=detect_landmarks, segment_videos=segment_videos, reconstruct_faces=reconstruct_faces, 
-                recognize_emotions=recognize_emotions)
+                detect_landmarks=detect_landmarks, segment_videos=segment_videos, reconstruct_faces=False, 
+                recognize_emotions=False)
             # if extract_audio: 
             #     self._extract_audio_for_video(idx)
             # if restore_videos:
@@ -419,6 +434,12 @@ class LRS3DataModule(FaceVideoDataModule):
             #         self._reconstruct_faces_in_sequence(idx, reconstruction_net=None, device=None,
             #                            save_obj=False, save_mat=True, save_vis=False, save_images=False,
             #                            save_video=False, rec_method=rec_method, retarget_from=None, retarget_suffix=None)
+
+        shard_idxs = [int(idx) for idx in idxs[start_idx:end_idx]]
+        if reconstruct_faces: 
+            self._reconstruct_faces_in_sequences_v2(shard_idxs, rec_methods=self._get_reconstruction_methods_to_process())
+        if recognize_emotions: 
+            self._extract_emotion_in_sequences(shard_idxs, emo_methods=self._get_emotion_methods_to_process())
             
         print("Done processing shard")
 
@@ -592,6 +613,9 @@ class LRS3DataModule(FaceVideoDataModule):
                 temporal_split_start=self.temporal_split[0] if self.temporal_split is not None else None,
                 temporal_split_end= self.temporal_split[0] + self.temporal_split[1] if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
 
                 landmark_source=self.landmark_sources,
@@ -611,6 +635,9 @@ class LRS3DataModule(FaceVideoDataModule):
                 temporal_split_start=self.temporal_split[0] if self.temporal_split is not None else None,
                 temporal_split_end= self.temporal_split[0] + self.temporal_split[1] if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
                 
                 landmark_source=self.landmark_sources,
@@ -628,6 +655,9 @@ class LRS3DataModule(FaceVideoDataModule):
                 temporal_split_start=self.temporal_split[0] if self.temporal_split is not None else None,
                 temporal_split_end= self.temporal_split[0] + self.temporal_split[1] if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
 
                 
@@ -772,6 +802,9 @@ class LRS3Dataset(VideoDatasetBase):
             emotion_type=None,
             return_emotion_feature=False,
             return_mica_images=False,
+            video_clip_cache_size_mb=None,
+            video_clip_cache_readahead=False,
+            video_clip_cache_log_every=None,
     ) -> None:
         landmark_types = landmark_types or "mediapipe"
         super().__init__(
@@ -804,6 +837,9 @@ class LRS3Dataset(VideoDatasetBase):
             temporal_split_start=temporal_split_start,
             temporal_split_end=temporal_split_end,
             preload_videos=preload_videos,
+            video_clip_cache_size_mb=video_clip_cache_size_mb,
+            video_clip_cache_readahead=video_clip_cache_readahead,
+            video_clip_cache_log_every=video_clip_cache_log_every,
             inflate_by_video_size=inflate_by_video_size,
             include_filename=include_filename, 
             read_video = read_video,
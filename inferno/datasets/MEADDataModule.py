@@ -151,6 +151,10 @@ class MEADDataModule(FaceVideoDataModule):
             shuffle_validation=False,
             align_images=True,
             return_mica_images=False,
+            detection_batch_size=None,
+            video_clip_cache_size_mb=None,
+            video_clip_cache_readahead=False,
+            video_clip_cache_log_every=None,
             ):
         super().__init__(root_dir, output_dir, processed_subfolder, 
             face_detector, face_detector_threshold, image_size, scale, 
@@ -167,11 +171,15 @@ class MEADDataModule(FaceVideoDataModule):
             include_processed_audio = include_processed_audio,
             include_raw_audio = include_raw_audio,
             preload_videos=preload_videos,
+            video_clip_cache_size_mb=video_clip_cache_size_mb,
+            video_clip_cache_readahead=video_clip_cache_readahead,
+            video_clip_cache_log_every=video_clip_cache_log_every,
             inflate_by_video_size=inflate_by_video_size,
             read_video=read_video,
             read_audio=read_audio,
             align_images=align_images,
             return_mica_images=return_mica_images,
+            detection_batch_size=detection_batch_size,
             )
         # self.detect_landmarks_on_restored_images = landmarks_from
         self.batch_size_train = batch_size_train
@@ -269,6 +277,9 @@ class MEADDataModule(FaceVideoDataModule):
                 # temporal_split_start=self.temporal_split[0] if self.temporal_split is not None else None,
                 # temporal_split_end= self.temporal_split[0] + self.temporal_split[1] if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
                 read_video=self.read_video,
                 read_audio=self.read_audio,
@@ -375,6 +386,14 @@ class MEADDataModule(FaceVideoDataModule):
         return out_folder
 
 
+    def _get_reconstruction_methods_to_process(self):
+        return ["EMICA-MEAD_flame2020"]
+        # return ["EMICA-MEAD_flame2023"]
+
+    def _get_emotion_methods_to_process(self):
+        return ['resnet50', ]
+        # return ['swin-b', ]
+
     def _process_video(self, idx, extract_audio=True, 
             restore_videos=True, 
             detect_landmarks=True, 
@@ -410,15 +429,13 @@ class MEADDataModule(FaceVideoDataModule):
             self._detect_landmarkes_in_aligned_sequence(idx)
 
         if reconstruct_faces: 
-            rec_methods = ["EMICA-MEAD_flame2020"]
-            # rec_methods = ["EMICA-MEAD_flame2023"]
+            rec_methods = self._get_reconstruction_methods_to_process()
             self._reconstruct_faces_in_sequence_v2(
                         idx, reconstruction_net=None, device=None,
                         save_obj=False, save_mat=True, save_vis=False, save_images=False,
                         save_video=False, rec_methods=rec_methods, retarget_from=None, retarget_suffix=None)
         if recognize_emotions:
-            emo_methods = ['resnet50', ]
-            # emo_methods = ['swin-b', ]
+            emo_methods = self._get_emotion_methods_to_process()
             self._extract_emotion_in_sequence(idx, emo_methods=emo_methods)
         
         if segmentations_to_hdf5:
@@ -462,13 +479,29 @@ class MEADDataModule(FaceVideoDataModule):
                 detect_landmarks=detect_landmarks, 
                 segment_videos=segment_videos, 
                 detect_aligned_landmarks=detect_aligned_landmarks,
-                reconstruct_faces=reconstruct_faces, 
-                recognize_emotions=recognize_emotions,
+                reconstruct_faces=False, # the network stages run on the whole shard below (pipelined over the videos)
+                recognize_emotions=False,
                 segmentations_to_hdf5=segmentations_to_hdf5,
                 )
+
+        shard_idxs = [int(idx) for idx in idxs[start_idx:end_idx]]
+        if reconstruct_faces: 
+            self._reconstruct_faces_in_sequences_v2(shard_idxs, rec_methods=self._get_reconstruction_methods_to_process())
+        if recognize_emotions: 
+            self._extract_emotion_in_sequences(shard_idxs, emo_methods=self._get_emotion_methods_to_process())
             
         print("Done processing shard")
 
+    def _process_locally(self, stages, *args, **kwargs):
+        if "detect_aligned_landmarks" in stages: 
+            assert "detect_landmarks" not in stages, \
+                "Cannot detect landmarks for aligned videos and original videos at the same time"  +\
+                " since this requries instantiation of a new face detector."
+            self.face_detector_type = 'fan3d'
+            if hasattr(self, 'face_detector'): # the detector is instantiated in the workers
+                del self.face_detector
+        return super()._process_locally(stages, *args, **kwargs)
+
     def _get_path_to_sequence_files(self, sequence_id, file_type, method="", suffix="", assert_=True): 
         if assert_:
             assert file_type in ['videos', 'videos_aligned', 'detections', 
@@ -767,6 +800,9 @@ class MEADDataModule(FaceVideoDataModule):
                 temporal_split_start= 0 if self.temporal_split is not None else None,
                 temporal_split_end=self.temporal_split[0] if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
                 read_video=self.read_video,
                 read_audio=self.read_audio,
@@ -790,6 +826,9 @@ class MEADDataModule(FaceVideoDataModule):
                 temporal_split_start=self.temporal_split[0] if self.temporal_split is not None else None,
                 temporal_split_end= self.temporal_split[0] + self.temporal_split[1] if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
                 read_video=self.read_video,
                 read_audio=self.read_audio,
@@ -813,6 +852,9 @@ class MEADDataModule(FaceVideoDataModule):
                 temporal_split_start=self.temporal_split[0] + self.temporal_split[1] if self.temporal_split is not None else None,
                 temporal_split_end= sum(self.temporal_split) if self.temporal_split is not None else None,
                 preload_videos=self.preload_videos,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 inflate_by_video_size=self.inflate_by_video_size,
                 read_video=self.read_video,
                 read_audio=self.read_audio,
@@ -924,6 +966,10 @@ class MEADDataset(VideoDatasetBaseV2):
             align_images = True,
             original_image_size = None,
             return_mica_images = False,
+            feature_cache_types = None,
+            video_clip_cache_size_mb=None,
+            video_clip_cache_readahead=False,
+            video_clip_cache_log_every=None,
     ) -> None:
         landmark_types = landmark_types or ["mediapipe", "fan"]
         super().__init__(
@@ -956,6 +1002,9 @@ class MEADDataset(VideoDatasetBaseV2):
             temporal_split_start=temporal_split_start,
             temporal_split_end=temporal_split_end,
             preload_videos=preload_videos,
+            video_clip_cache_size_mb=video_clip_cache_size_mb,
+            video_clip_cache_readahead=video_clip_cache_readahead,
+            video_clip_cache_log_every=video_clip_cache_log_every,
             inflate_by_video_size=inflate_by_video_size,
             include_filename=include_filename,
             read_video=read_video,
@@ -969,6 +1018,7 @@ class MEADDataset(VideoDatasetBaseV2):
             align_images = align_images,
             original_image_size = original_image_size,
             return_mica_images = return_mica_images,
+            feature_cache_types = feature_cache_types,
         )
         self._setup_identity_labels()
         self.read_gt_text = False
@@ -1115,6 +1165,15 @@ class MEADDataset(VideoDatasetBaseV2):
         emo_path = path_prefix / parts[0] / "/".join(parts[2:])
         return emo_path.with_suffix("")
 
+    def _path_to_features(self, index, feature_type): 
+        parts = self.video_list[self.video_indices[index]].parts
+        video_part = parts[1] 
+        expected_values = ["video", "1", "2"]
+        assert video_part in expected_values, f"Expected video part to be one of {expected_values}, but got '{video_part}'"
+        path_prefix = Path(self.output_dir) / f"features" / feature_type
+        feature_path = path_prefix / parts[0] / "/".join(parts[2:])
+        return feature_path.with_suffix("")
+
     def _get_text(self, sample, index):
         if self.read_gt_text:
             if not hasattr(self, "_gt_text"):
@@ -71,9 +71,13 @@ class MEADPseudo3DDM(MEADDataModule):
                 average_shape_decode= True,
                 emotion_type=None,
                 return_emotion_feature=False,
+                feature_cache_types=None,
                 shuffle_validation=False,
                 align_images=False,
                 return_mica_images=False,
+                video_clip_cache_size_mb=None,
+                video_clip_cache_readahead=False,
+                video_clip_cache_log_every=None,
             ):
         super().__init__(root_dir, output_dir, processed_subfolder, face_detector, 
             landmarks_from, 
@@ -98,6 +102,9 @@ class MEADPseudo3DDM(MEADDataModule):
             include_raw_audio=include_raw_audio,
             inflate_by_video_size=inflate_by_video_size,
             preload_videos=preload_videos, 
+            video_clip_cache_size_mb=video_clip_cache_size_mb,
+            video_clip_cache_readahead=video_clip_cache_readahead,
+            video_clip_cache_log_every=video_clip_cache_log_every,
             landmark_types=landmark_types,
             landmark_sources=landmark_sources,
             segmentation_source=segmentation_source,
@@ -125,6 +132,10 @@ class MEADPseudo3DDM(MEADDataModule):
         self.emotion_type = emotion_type
         self.return_emotion_feature = return_emotion_feature
 
+        self.feature_cache_types = feature_cache_types
+        if isinstance(self.feature_cache_types, omegaconf.listconfig.ListConfig): 
+            self.feature_cache_types = list(self.feature_cache_types)
+
     def _get_smaller_renderable_subset_single_identity(self, indices, max_videos_per_category=1, 
                                                        accepted_expression=None, 
                                                        accepted_intensity=None):
@@ -188,6 +199,10 @@ class MEADPseudo3DDM(MEADDataModule):
                 average_shape_decode=self.average_shape_decode,
                 emotion_type=self.emotion_type,
                 return_emotion_feature=self.return_emotion_feature,
+                feature_cache_types=self.feature_cache_types,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 return_mica_images=self.return_mica_images,
                 original_image_size=self.processed_video_size,
             )
@@ -225,6 +240,10 @@ class MEADPseudo3DDM(MEADDataModule):
                 average_shape_decode=self.average_shape_decode,
                 emotion_type=self.emotion_type,
                 return_emotion_feature=self.return_emotion_feature,
+                feature_cache_types=self.feature_cache_types,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 return_mica_images=self.return_mica_images,
                 original_image_size=self.processed_video_size,
               )           
@@ -315,6 +334,10 @@ class MEADPseudo3DDM(MEADDataModule):
                 average_shape_decode=self.average_shape_decode,
                 emotion_type=self.emotion_type,
                 return_emotion_feature=self.return_emotion_feature,
+                feature_cache_types=self.feature_cache_types,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 return_mica_images=self.return_mica_images,
                 original_image_size=self.processed_video_size,
                 )
@@ -360,6 +383,10 @@ class MEADPseudo3DDM(MEADDataModule):
                 average_shape_decode=self.average_shape_decode,
                 emotion_type=self.emotion_type,
                 return_emotion_feature=self.return_emotion_feature,
+                feature_cache_types=self.feature_cache_types,
+                video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                video_clip_cache_readahead=self.video_clip_cache_readahead,
+                video_clip_cache_log_every=self.video_clip_cache_log_every,
                 return_mica_images=self.return_mica_images,
                 original_image_size=self.processed_video_size,
                 )
@@ -444,6 +471,10 @@ class MEADPseudo3DDM(MEADDataModule):
                     average_shape_decode=self.average_shape_decode,
                     emotion_type=self.emotion_type,
                     return_emotion_feature=self.return_emotion_feature,
+                    feature_cache_types=self.feature_cache_types,
+                    video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                    video_clip_cache_readahead=self.video_clip_cache_readahead,
+                    video_clip_cache_log_every=self.video_clip_cache_log_every,
                     return_mica_images=self.return_mica_images,
                     original_image_size=self.processed_video_size,
                     )
@@ -487,6 +518,10 @@ class MEADPseudo3DDM(MEADDataModule):
                     average_shape_decode=self.average_shape_decode,
                     emotion_type=self.emotion_type,
                     return_emotion_feature=self.return_emotion_feature,
+                    feature_cache_types=self.feature_cache_types,
+                    video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                    video_clip_cache_readahead=self.video_clip_cache_readahead,
+                    video_clip_cache_log_every=self.video_clip_cache_log_every,
                     return_mica_images=self.return_mica_images,
                     original_image_size=self.processed_video_size,
                     )
@@ -545,6 +580,10 @@ class MEADPseudo3DDM(MEADDataModule):
                     average_shape_decode=self.average_shape_decode,
                     emotion_type=self.emotion_type,
                     return_emotion_feature=self.return_emotion_feature,
+                    feature_cache_types=self.feature_cache_types,
+                    video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                    video_clip_cache_readahead=self.video_clip_cache_readahead,
+                    video_clip_cache_log_every=self.video_clip_cache_log_every,
                     return_mica_images=self.return_mica_images,
                     original_image_size=self.processed_video_size,
                     )
@@ -585,6 +624,10 @@ class MEADPseudo3DDM(MEADDataModule):
                     average_shape_decode=self.average_shape_decode,
                     emotion_type=self.emotion_type,
                     return_emotion_feature=self.return_emotion_feature,
+                    feature_cache_types=self.feature_cache_types,
+                    video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                    video_clip_cache_readahead=self.video_clip_cache_readahead,
+                    video_clip_cache_log_every=self.video_clip_cache_log_every,
                     return_mica_images=self.return_mica_images,
                     original_image_size=self.processed_video_size,
                     )
@@ -626,6 +669,10 @@ class MEADPseudo3DDM(MEADDataModule):
                     average_shape_decode=self.average_shape_decode,
                     emotion_type=self.emotion_type,
                     return_emotion_feature=self.return_emotion_feature,
+                    feature_cache_types=self.feature_cache_types,
+                    video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                    video_clip_cache_readahead=self.video_clip_cache_readahead,
+                    video_clip_cache_log_every=self.video_clip_cache_log_every,
                     return_mica_images=self.return_mica_images,
                     original_image_size=self.processed_video_size,
                     )
@@ -666,6 +713,10 @@ class MEADPseudo3DDM(MEADDataModule):
                     average_shape_decode=self.average_shape_decode,
                     emotion_type=self.emotion_type,
                     return_emotion_feature=self.return_emotion_feature,
+                    feature_cache_types=self.feature_cache_types,
+                    video_clip_cache_size_mb=self.video_clip_cache_size_mb,
+                    video_clip_cache_readahead=self.video_clip_cache_readahead,
+                    video_clip_cache_log_every=self.video_clip_cache_log_every,
                     return_mica_images=self.return_mica_images,
                     original_image_size=self.processed_video_size,
                     )
@@ -896,6 +947,10 @@ class MEADPseudo3dDataset(MEADDataset):
             return_emotion_feature=False,
             return_mica_images=False,
             original_image_size = None,
+            feature_cache_types=None,
+            video_clip_cache_size_mb=None,
+            video_clip_cache_readahead=False,
+            video_clip_cache_log_every=None,
             ) -> None:
         super().__init__(root_path, output_dir, video_list, 
             video_metas, video_indices, audio_metas, sequence_length, audio_noise_prob, stack_order_audio, audio_normalization, 
@@ -912,6 +967,9 @@ class MEADPseudo3dDataset(MEADDataset):
             transforms, 
             hack_length, 
             preload_videos=preload_videos, 
+            video_clip_cache_size_mb=video_clip_cache_size_mb,
+            video_clip_cache_readahead=video_clip_cache_readahead,
+            video_clip_cache_log_every=video_clip_cache_log_every,
             inflate_by_video_size=inflate_by_video_size, 
             include_filename=include_filename,
             temporal_split_start=temporal_split_start,
@@ -928,6 +986,7 @@ class MEADPseudo3dDataset(MEADDataset):
             return_emotion_feature = return_emotion_feature,
             return_mica_images = return_mica_images,
             original_image_size = original_image_size,
+            feature_cache_types = feature_cache_types,
             )
         # self.read_video = read_video
 
@@ -0,0 +1,182 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import os
+import io
+import pickle as pkl
+from pathlib import Path
+import numpy as np
+
+
+class PackedShardWriter(object):
+    """
+    Writes samples into a few large shard files instead of many small per-sample files.
+    Each record is a dict of fields (usually the raw bytes of the original files, such as an encoded PNG
+    or a landmark pickle) and gets appended to the current shard. The index (shard, byte offset and length
+    of each record) is stored in 'index.npz' together with per-sample metadata columns as numpy arrays,
+    so a sample is read with a single seek + read and no per-sample file lookups.
+    """
+
+    def __init__(self, output_dir, shard_size_mb=512, prefix="shard"):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_size_bytes = int(shard_size_mb * 2**20)
+        self.prefix = prefix
+        self.shard_names = []
+        self.shards = []
+        self.offsets = []
+        self.lengths = []
+        self.metadata = {}
+        self._file = None
+        self._file_size = 0
+
+    def _shard_name(self, shard_id):
+        return f"{self.prefix}_{shard_id:05d}.bin"
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        self.shard_names += [self._shard_name(len(self.shard_names))]
+        self._file = open(self.output_dir / self.shard_names[-1], "wb")
+        self._file_size = 0
+
+    def add(self, record, metadata=None):
+        """
+        Appends a record (dict of fields) and its metadata (dict of column -> scalar or string).
+        Returns the index of the record.
+        """
+        data = pkl.dumps(record, protocol=pkl.HIGHEST_PROTOCOL)
+        if self._file is None or (self._file_size > 0 and self._file_size + len(data) > self.shard_size_bytes):
+            self._next_shard()
+        self.shards += [len(self.shard_names) - 1]
+        self.offsets += [self._file_size]
+        self.lengths += [len(data)]
+        self._file.write(data)
+        self._file_size += len(data)
+
+        metadata = metadata or {}
+        idx = len(self.lengths) - 1
+        for key in set(self.metadata.keys()) | set(metadata.keys()):
+            if key not in self.metadata:
+                self.metadata[key] = [None] * idx
+            self.metadata[key] += [metadata.get(key, None)]
+        return idx
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index = {
+            "shard_names": np.array(self.shard_names),
+            "shards": np.array(self.shards, dtype=np.int32),
+            "offsets": np.array(self.offsets, dtype=np.int64),
+            "lengths": np.array(self.lengths, dtype=np.int64),
+        }
+        for key, values in self.metadata.items():
+            index["meta_" + key] = np.array(values)
+        # written under a temporary name, the shards are only usable once the index exists
+        tmp_path = self.output_dir / "index.tmp.npz"
+        np.savez(tmp_path, **index)
+        os.replace(tmp_path, self.output_dir / "index.npz")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PackedShardReader(object):
+    """
+    Reads records written by PackedShardWriter. The shard files are opened lazily and reopened in every process,
+    so the reader can be created before the DataLoader workers are forked or spawned.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = Path(shard_dir)
+        with np.load(self.shard_dir / "index.npz", allow_pickle=False) as index:
+            self.shard_names = [str(name) for name in index["shard_names"]]
+            self.shards = index["shards"]
+            self.offsets = index["offsets"]
+            self.lengths = index["lengths"]
+            self.metadata = {key[len("meta_"):]: index[key] for key in index.files if key.startswith("meta_")}
+        self._files = {}
+        self._pid = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"] = {}
+        state["_pid"] = None
+        return state
+
+    def _get_file(self, shard_id):
+        if self._pid != os.getpid():
+            # file handles must not be shared with the parent process
+            self._files = {}
+            self._pid = os.getpid()
+        if shard_id not in self._files:
+            self._files[shard_id] = open(self.shard_dir / self.shard_names[shard_id], "rb")
+        return self._files[shard_id]
+
+    def read(self, idx):
+        f = self._get_file(int(self.shards[idx]))
+        f.seek(int(self.offsets[idx]))
+        return pkl.loads(f.read(int(self.lengths[idx])))
+
+    def indices_of(self, column, values):
+        """
+        Returns the record indices of the given values of a metadata column (-1 for the values that are not packed)
+        """
+        import pandas as pd
+        return pd.Index(self.metadata[column]).get_indexer(np.asarray(values))
+
+
+def read_file_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def decode_image(data):
+    from skimage.io import imread
+    return imread(io.BytesIO(data))
+
+
+def decode_landmark(data):
+    # the format of inferno.utils.FaceDetector.save_landmark
+    f = io.BytesIO(data)
+    landmark_type = pkl.load(f)
+    landmark = pkl.load(f)
+    return landmark_type, landmark
+
+
+def decode_segmentation(data):
+    # the format of inferno.datasets.IO.save_segmentation
+    import compress_pickle as cpkl
+    seg = cpkl.load(io.BytesIO(data), compression='gzip')
+    return seg[1], seg[0]
+
+
+def decode_emotion(data):
+    # the format of inferno.datasets.IO.save_emotion
+    import compress_pickle as cpkl
+    emo = cpkl.load(io.BytesIO(data), compression='gzip')
+    return emo[2], emo[1]
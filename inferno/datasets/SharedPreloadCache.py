@@ -0,0 +1,155 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import os
+import time
+import hashlib
+import pickle as pkl
+from pathlib import Path
+import numpy as np
+
+
+class SharedArray(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    A read-only array stored in a .npy file that gets memory-mapped on first access.
+    Pickling only stores the file name, so forked or spawned DataLoader workers and all DDP ranks
+    attach to the same file and share its pages through the OS page cache instead of holding private copies.
+    Arithmetic and numpy functions work on it as on the mapped array and return new (writable) arrays. 
+    Indexing returns read-only views of the mapped file, copy them before modifying them in place.
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.load(self.filename, mmap_mode='r')
+        return self._array
+
+    def __getitem__(self, item):
+        return self.array[item]
+
+    def __len__(self):
+        return len(self.array)
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return np.asarray(self.array)
+        return np.asarray(self.array, dtype=dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # operands and 'out' arrays that are SharedArrays are replaced by the mapped arrays 
+        inputs = tuple(x.array if isinstance(x, SharedArray) else x for x in inputs)
+        if "out" in kwargs:
+            kwargs["out"] = tuple(x.array if isinstance(x, SharedArray) else x for x in kwargs["out"])
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getattr__(self, name):
+        # forward shape, dtype, size, astype, ... to the mapped array
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.array, name)
+
+    def __getstate__(self):
+        return {"filename": self.filename}
+
+    def __setstate__(self, state):
+        self.filename = state["filename"]
+        self._array = None
+
+
+class SharedPreloadCache(object):
+    """
+    On-disk cache of preloaded data (videos, segmentations, landmarks, reconstructions, ...) that is
+    built once and then attached to by all processes. Each entry is an arbitrary nesting of dicts, lists and tuples.
+    Large arrays are stored as separate .npy files and replaced by SharedArray references, the rest of the entry
+    is pickled. Entries are built under a lock file and published with an atomic rename,
+    so concurrent processes (DataLoader workers, DDP ranks on the same node) build each entry only once.
+    The cache is not invalidated automatically, delete the cache folder if the underlying data changes.
+    """
+
+    def __init__(self, cache_dir, min_shared_bytes=2**20, poll_interval=1.0, stale_lock_timeout=3600.):
+        self.cache_dir = Path(cache_dir)
+        self.min_shared_bytes = min_shared_bytes
+        self.poll_interval = poll_interval
+        self.stale_lock_timeout = stale_lock_timeout
+
+    @staticmethod
+    def key_for(what):
+        return hashlib.sha1(str(what).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key, name):
+        return self.cache_dir / key[:2] / key / (name + ".pkl")
+
+    def get(self, key, name, load_fn):
+        """
+        Returns the cached entry 'name' of 'key'. If it does not exist yet, it is built with load_fn()
+        (or, if another process is already building it, waited for).
+        """
+        entry_path = self._entry_path(key, name)
+        while not entry_path.is_file():
+            entry_path.parent.mkdir(parents=True, exist_ok=True)
+            lock_path = entry_path.with_suffix(".lock")
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time.time() - lock_path.stat().st_mtime > self.stale_lock_timeout:
+                        print(f"[WARNING] Removing stale preload cache lock '{lock_path}'")
+                        os.remove(lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(self.poll_interval) # another process is building this entry
+                continue
+            try:
+                os.close(fd)
+                if not entry_path.is_file():
+                    self._build(entry_path, load_fn)
+            finally:
+                os.remove(lock_path)
+        with open(entry_path, "rb") as f:
+            return pkl.load(f)
+
+    def _build(self, entry_path, load_fn):
+        array_dir = entry_path.with_suffix("")
+        num_arrays = [0]
+
+        def share(obj):
+            if isinstance(obj, np.ndarray) and obj.dtype != object and obj.nbytes >= self.min_shared_bytes:
+                array_dir.mkdir(parents=True, exist_ok=True)
+                array_path = array_dir / f"{num_arrays[0]:04d}.npy"
+                num_arrays[0] += 1
+                np.save(array_path, np.ascontiguousarray(obj))
+                return SharedArray(array_path)
+            if isinstance(obj, dict):
+                return {k: share(v) for k, v in obj.items()}
+            if isinstance(obj, list):
+                return [share(v) for v in obj]
+            if isinstance(obj, tuple):
+                return tuple(share(v) for v in obj)
+            return obj
+
+        entry = share(load_fn())
+        tmp_path = entry_path.with_suffix(".pkl.tmp")
+        with open(tmp_path, "wb") as f:
+            pkl.dump(entry, f)
+        os.replace(tmp_path, entry_path)
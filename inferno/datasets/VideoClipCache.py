@@ -0,0 +1,158 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import os
+from collections import OrderedDict
+from decord import VideoReader, cpu
+
+
+def is_main_data_worker():
+    """
+    True in the main process and in the first DataLoader worker of the first rank on the node. 
+    The diagnostics of the dataset caches are printed only from there, not once per worker.
+    """
+    import torch
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is not None and worker_info.id != 0:
+        return False
+    return int(os.environ.get("LOCAL_RANK", 0)) == 0
+
+
+class VideoClipCache(object):
+    """
+    Size-bounded LRU cache of decoded frame ranges (and of open decord readers) keyed by the video path.
+    A middle ground between decoding every sample from scratch and preloading whole videos.
+    With readahead, a miss decodes the requested window together with the following one in a single
+    pass, so sequential sampling (one video split into consecutive windows) mostly hits the cache.
+    Each process (DataLoader worker) holds its own cache, the budget is per process. The hit/miss counters 
+    are per process as well. If 'log_every' is set, the first worker prints its statistics every 'log_every' 
+    requests (see log_stats), the other workers see a similar load.
+    """
+
+    def __init__(self, max_size_mb=1024, max_open_readers=8, readahead=False, log_every=None):
+        self.max_size_bytes = int(max_size_mb * 2**20)
+        self.max_open_readers = max_open_readers
+        self.readahead = readahead
+        self.log_every = log_every
+        self._reset()
+
+    def _reset(self):
+        self.clips = OrderedDict() # (video_path, width, height, start_frame) -> frames [T, H, W, C]
+        self.readers = OrderedDict() # (video_path, width, height) -> VideoReader
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # open readers cannot be pickled and cached frames should not be copied into new workers
+        state = self.__dict__.copy()
+        for key in ["clips", "readers", "size_bytes", "hits", "misses", "evictions"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.,
+            "evictions": self.evictions,
+            "size_mb": self.size_bytes / 2**20,
+            "num_clips": len(self.clips),
+            "num_open_readers": len(self.readers),
+        }
+
+    def log_stats(self):
+        import torch
+        worker_info = torch.utils.data.get_worker_info()
+        process = f"worker {worker_info.id}" if worker_info is not None else "main process"
+        stats = self.stats()
+        print(f"[VideoClipCache] {process}: {stats['hits'] + stats['misses']} requests, hit rate {stats['hit_rate']:.3f}, "
+              f"{stats['evictions']} evictions, {stats['size_mb']:.1f}/{self.max_size_bytes / 2**20:.1f} MB in "
+              f"{stats['num_clips']} clips, {stats['num_open_readers']} open readers")
+
+    def _count_request(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.log_every is not None and (self.hits + self.misses) % self.log_every == 0 and is_main_data_worker():
+            self.log_stats()
+
+    def get_reader(self, video_path, width=-1, height=-1):
+        key = (video_path, width, height)
+        if key in self.readers:
+            self.readers.move_to_end(key)
+            return self.readers[key]
+        reader = VideoReader(video_path, ctx=cpu(0), width=width, height=height)
+        self.readers[key] = reader
+        while len(self.readers) > self.max_open_readers:
+            self.readers.popitem(last=False)
+        return reader
+
+    def _find_clip(self, video_path, width, height, start_frame, end_frame):
+        for key, frames in self.clips.items():
+            path, w, h, clip_start = key
+            if path == video_path and w == width and h == height \
+                    and clip_start <= start_frame and end_frame <= clip_start + frames.shape[0]:
+                self.clips.move_to_end(key)
+                return frames[start_frame - clip_start:end_frame - clip_start]
+        return None
+
+    def _insert_clip(self, video_path, width, height, start_frame, frames):
+        if frames.nbytes > self.max_size_bytes:
+            return
+        key = (video_path, width, height, start_frame)
+        if key in self.clips:
+            self.size_bytes -= self.clips.pop(key).nbytes
+        self.clips[key] = frames
+        self.size_bytes += frames.nbytes
+        while self.size_bytes > self.max_size_bytes:
+            _, evicted = self.clips.popitem(last=False)
+            self.size_bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def get_frames(self, video_path, start_frame, num_frames, width=-1, height=-1, readahead=None):
+        """
+        Returns the decoded frames [start_frame, start_frame + num_frames) of the video (uint8, [T, H, W, C]),
+        fewer if the video ends earlier. The returned array is owned by the cache, do not modify it in place.
+        """
+        video_path = str(video_path)
+        readahead = self.readahead if readahead is None else readahead
+        reader = self.get_reader(video_path, width, height)
+        end_frame = min(start_frame + num_frames, len(reader))
+
+        frames = self._find_clip(video_path, width, height, start_frame, end_frame)
+        self._count_request(hit=frames is not None)
+        if frames is not None:
+            return frames
+
+        decode_end = min(end_frame + num_frames, len(reader)) if readahead else end_frame
+        frames = reader.get_batch(range(start_frame, decode_end)).asnumpy()
+        if readahead and decode_end > end_frame:
+            # keep the window that will most likely be requested next separately (copied, so that it can be evicted on its own)
+            self._insert_clip(video_path, width, height, end_frame, frames[end_frame - start_frame:].copy())
+            frames = frames[:end_frame - start_frame].copy()
+        self._insert_clip(video_path, width, height, start_frame, frames)
+        return frames
@@ -17,6 +17,7 @@ All rights reserved.
 # For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
 """
 
+import os
 import torch
 import numpy as np 
 import imgaug
@@ -29,7 +30,8 @@ from inferno.datasets.FaceDataModuleBase import FaceDataModuleBase
 from inferno.datasets.IO import (load_and_process_segmentation, process_segmentation, 
                              load_segmentation, load_segmentation_list, load_segmentation_list_v2,
                              load_reconstruction_list, load_emotion_list, 
-                             load_reconstruction_list_v2, load_emotion_list_v2,
+                             load_reconstruction_list_v2, load_emotion_list_v2, load_feature_list_v2,
+                             open_landmark_list_v3, load_landmark_list_v3,
                              )
 from inferno.datasets.ImageDatasetHelpers import bbox2point, bbpoint_warp
 from inferno.utils.FaceDetector import load_landmark
@@ -41,6 +43,7 @@ import traceback
 from inferno.layers.losses.MediaPipeLandmarkLosses import MEDIAPIPE_LANDMARK_NUMBER
 import cv2
 from decord import VideoReader, cpu
+from inferno.datasets.VideoClipCache import is_main_data_worker
 
 class AbstractVideoDataset(torch.utils.data.Dataset):
 
@@ -85,7 +88,7 @@ class VideoDatasetBase(AbstractVideoDataset):
             include_raw_audio = True,
             temporal_split_start=None, # if temporally splitting the video (train, val, test), this is the start of the split
             temporal_split_end=None, # if temporally splitting the video (train, val, test), this is the end of the split
-            preload_videos=False, # cache all videos in memory (recommended for smaller datasets)
+            preload_videos=False, # cache all videos in memory (recommended for smaller datasets), "shared" builds the cache in parallel as memory-mapped files shared by all workers and ranks
             inflate_by_video_size=False, 
             include_filename=False, # if True includes the filename of the video in the sample
             align_images = True,
@@ -100,6 +103,10 @@ class VideoDatasetBase(AbstractVideoDataset):
             read_audio=True,
             original_image_size=None, ## the processed videos may be different in size and if they are, the landmarks will be, too. This is to remember
             return_mica_images=False,
+            video_clip_cache_size_mb=None, # if set (and not preloading), decoded clips are kept in a LRU cache of this size (per worker)
+            video_clip_cache_readahead=False, # if True, the clip cache also decodes the following window (for sequential sampling)
+            video_clip_cache_log_every=None, # if set, the first worker prints the statistics of its clip cache every this many requests
+            feature_cache_types=None, # precomputed features of frozen modules to serve (see inferno.datasets.FeatureCache)
         ) -> None:
         super().__init__()
         self.root_path = root_path
@@ -189,12 +196,17 @@ class VideoDatasetBase(AbstractVideoDataset):
         self.emotion_type = emotion_type
         self.return_emotion_feature = return_emotion_feature
 
+        self.feature_cache_types = feature_cache_types
+        if isinstance(self.feature_cache_types, str): 
+            self.feature_cache_types = [self.feature_cache_types]
+
         self.video_cache = {}
         self.audio_cache = {}
         self.seg_cache = {}
         self.lmk_cache = {}
         self.rec_cache = {}
         self.emo_cache = {}
+        self.feature_cache = {}
         if self.preload_videos:
             self._preload_videos()
             
@@ -202,6 +214,12 @@ class VideoDatasetBase(AbstractVideoDataset):
         if self.inflate_by_video_size: 
             self._inflate_by_video_size()
 
+        self.clip_cache = None
+        if video_clip_cache_size_mb is not None and not self.preload_videos:
+            from inferno.datasets.VideoClipCache import VideoClipCache
+            self.clip_cache = VideoClipCache(max_size_mb=video_clip_cache_size_mb, readahead=video_clip_cache_readahead, 
+                                             log_every=video_clip_cache_log_every)
+
         self.include_filename = include_filename
 
         # if True, face alignment will not crash if invalid. By default this should be False to avoid silent data errors
@@ -253,6 +271,9 @@ class VideoDatasetBase(AbstractVideoDataset):
 
 
     def _preload_videos(self): 
+        if self.preload_videos == "shared":
+            self._preload_videos_shared()
+            return
         # indices = np.unique(self.video_indices)
         from tqdm import auto
         for i in auto.tqdm( range(len(self.video_indices)), desc="Preloading videos" ):
@@ -287,10 +308,86 @@ class VideoDatasetBase(AbstractVideoDataset):
                     self.emo_cache[i] = {}
                 self.emo_cache[i]["emotions"] = emotions 
                 self.emo_cache[i]["features"] = features
+            if self.feature_cache_types is not None: 
+                self.feature_cache[i] = {feature_type: self._load_cached_features(i, feature_type) 
+                                         for feature_type in self.feature_cache_types}
     
 
         print("Video cache loaded")
 
+    def _get_preload_cache_dir(self):
+        return Path(self.output_dir) / "preload_cache"
+
+    def _preload_video_shared(self, cache, i): 
+        """
+        Builds (or attaches to) the shared cache entries of the i-th video. 
+        """
+        video_path = str(self._get_video_path(i))
+        key = cache.key_for(video_path)
+        entries = {"video_path": video_path}
+        if self.read_video:
+            entries["video"] = cache.get(key, "video", lambda: vread(video_path))
+            entries["segmentations"] = cache.get(key, f"segmentations_{self.segmentation_source}_{self.segmentation_type}", 
+                lambda: self._read_segmentations(i))
+        if self.read_audio:
+            entries["audio"] = cache.get(key, "audio", lambda: self._read_audio(i))
+        entries["landmarks"] = {}
+        for lmk_type, lmk_source in zip(self.landmark_types, self.landmark_source):
+            entries["landmarks"][(lmk_type, lmk_source)] = cache.get(key, f"landmarks_{lmk_type}_{lmk_source}", 
+                lambda: self._read_landmarks(i, lmk_type, lmk_source))
+        if self.reconstruction_type is not None: 
+            entries["reconstructions"] = {}
+            for rec_type in self.reconstruction_type: 
+                name = f"reconstructions_{Path(rec_type).name}" + ("_appearance" if self.return_appearance else "")
+                entries["reconstructions"][rec_type] = cache.get(key, name, 
+                    lambda: self._load_reconstructions(i, rec_type, self.return_appearance))
+        if self.emotion_type is not None: 
+            name = f"emotions_{self.emotion_type}" + ("_features" if self.return_emotion_feature else "")
+            entries["emotions"] = cache.get(key, name, lambda: self._load_emotions(i, features=self.return_emotion_feature))
+        if self.feature_cache_types is not None: 
+            entries["cached_features"] = {}
+            for feature_type in self.feature_cache_types: 
+                entries["cached_features"][feature_type] = cache.get(key, f"features_{Path(feature_type).name}", 
+                    lambda: self._load_cached_features(i, feature_type))
+        return entries
+
+    def _preload_videos_shared(self, num_threads=None): 
+        """
+        Fills the same caches as _preload_videos but the data lives in memory-mapped files 
+        (see SharedPreloadCache) that are built once, in parallel, and shared by all DataLoader workers 
+        and all processes on the node. Host RAM then does not grow with the number of workers.
+        """
+        from tqdm import auto
+        from concurrent.futures import ThreadPoolExecutor
+        from inferno.datasets.SharedPreloadCache import SharedPreloadCache
+        cache = SharedPreloadCache(self._get_preload_cache_dir())
+        num_threads = num_threads or min(16, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            all_entries = pool.map(lambda i: self._preload_video_shared(cache, i), range(len(self.video_indices)))
+            for i, entries in enumerate(auto.tqdm(all_entries, total=len(self.video_indices), desc="Preloading videos (shared)")):
+                video_path = entries["video_path"]
+                if self.read_video:
+                    self.video_cache[video_path] = entries["video"]
+                    self.seg_cache[video_path] = entries["segmentations"]
+                if self.read_audio:
+                    self.audio_cache[i] = entries["audio"]
+                self.lmk_cache[i] = {}
+                for (lmk_type, lmk_source), landmarks in entries["landmarks"].items():
+                    if lmk_type not in self.lmk_cache[i]:
+                        self.lmk_cache[i][lmk_type] = {}
+                    self.lmk_cache[i][lmk_type][lmk_source] = landmarks
+                if self.reconstruction_type is not None: 
+                    self.rec_cache[i] = {}
+                    for rec_type, (shape_pose_cam, appearance) in entries["reconstructions"].items():
+                        self.rec_cache[i][rec_type] = {"shape_pose_cam": shape_pose_cam, "appearance": appearance}
+                if self.emotion_type is not None: 
+                    emotions, features = entries["emotions"]
+                    self.emo_cache[i] = {"emotions": emotions, "features": features}
+                if self.feature_cache_types is not None: 
+                    self.feature_cache[i] = entries["cached_features"]
+        if is_main_data_worker():
+            print("Shared video cache attached")
+
     def _inflate_by_video_size(self):
         assert isinstance( self.sequence_length, int), "'sequence_length' must be an integer when inflating by video size"
         inflated_video_indices = []
@@ -380,6 +477,10 @@ class VideoDatasetBase(AbstractVideoDataset):
         if time:
             emo_read_time = timeit.default_timer() - start_time - video_read_time - audio_read_time - lmk_read_time - seg_read_time - face_align_time - geom_read_time
 
+        # 7b) PRECOMPUTED FEATURES OF FROZEN MODULES
+        if self.feature_cache_types is not None:
+            sample = self._get_cached_features(index, start_frame, num_read_frames, video_fps, num_frames, sample)
+
         # 8) AUGMENTATION
         if self.read_video:
             sample = self._augment_sequence_sample(index, sample)
@@ -566,13 +667,20 @@ class VideoDatasetBase(AbstractVideoDataset):
                     # from decord import VideoReader
                     # from decord import cpu, gpu
                     # start_time = timeit.default_timer()
-                    vr = VideoReader(video_path.as_posix(), ctx=cpu(0), width=self.image_size, height=self.image_size) 
-                    if len(vr) < sequence_length:
-                        sequence_length_ = len(vr)
-                    else: 
-                        sequence_length_ = sequence_length
-                    frames = vr.get_batch(range(start_frame,(start_frame + sequence_length_)))  
-                    frames = frames.asnumpy()
+                    if self.clip_cache is not None:
+                        # readahead only pays off if the windows of a video are sampled one after another
+                        frames = self.clip_cache.get_frames(video_path.as_posix(), start_frame, sequence_length, 
+                            width=self.image_size, height=self.image_size, 
+                            readahead=self.clip_cache.readahead and self.video_sample_indices is not None)
+                        sequence_length_ = frames.shape[0]
+                    else:
+                        vr = VideoReader(video_path.as_posix(), ctx=cpu(0), width=self.image_size, height=self.image_size) 
+                        if len(vr) < sequence_length:
+                            sequence_length_ = len(vr)
+                        else: 
+                            sequence_length_ = sequence_length
+                        frames = vr.get_batch(range(start_frame,(start_frame + sequence_length_)))  
+                        frames = frames.asnumpy()
 
                     if sequence_length_ < sequence_length:
                         # pad with zeros if video shorter than sequence length
@@ -654,6 +762,7 @@ class VideoDatasetBase(AbstractVideoDataset):
     def _get_audio(self, index, start_frame, num_read_frames, video_fps, num_frames, sample):
         if self.preload_videos:
             wavdata, sampling_rate = self.audio_cache[index]
+            wavdata = np.asarray(wavdata) # no copy (for shared preloading, this is the memory-mapped array)
         else:
             wavdata, sampling_rate = self._read_audio(index)
         sequence_length = self._get_sample_length(index)
@@ -715,6 +824,8 @@ class VideoDatasetBase(AbstractVideoDataset):
 
     def _read_landmarks(self, index, landmark_type, landmark_source):
         landmarks_dir = self._path_to_landmarks(index, landmark_type, landmark_source)
+        if (landmarks_dir / f"landmarks_{landmark_source}.hdf5").exists(): # fixed-shape landmark array, memory-mapped (nothing gets read here)
+            return open_landmark_list_v3(landmarks_dir / f"landmarks_{landmark_source}.hdf5")
         landmark_list = FaceDataModuleBase.load_landmark_list(landmarks_dir / f"landmarks_{landmark_source}.pkl")  
         return landmark_list
 
@@ -726,7 +837,18 @@ class VideoDatasetBase(AbstractVideoDataset):
             landmark_source = self.landmark_source[lti]
             landmarks_dir = self._path_to_landmarks(index, landmark_type, landmark_source)
             landmarks = []
-            if (landmarks_dir / "landmarks.pkl").exists(): # landmarks are saved per video in a single file
+            if (landmarks_dir / f"landmarks_{landmark_source}.hdf5").exists(): # [T, max_faces, K, D] array with a validity mask, random access
+                if not self.preload_videos: 
+                    landmarks, landmark_validity = load_landmark_list_v3(landmarks_dir / f"landmarks_{landmark_source}.hdf5", 
+                        start_frame, sequence_length + start_frame)
+                else: 
+                    landmarks, landmark_validity = self.lmk_cache[index][landmark_type][landmark_source]
+                    landmarks = landmarks[start_frame: sequence_length + start_frame]
+                    landmark_validity = landmark_validity[start_frame: sequence_length + start_frame]
+                # just take the first face for now (dropped detections are zeros)
+                landmarks = np.array(landmarks[:, 0])
+                landmark_validity = landmark_validity[:, 0:1].astype(np.float32)
+            elif (landmarks_dir / "landmarks.pkl").exists(): # landmarks are saved per video in a single file
             #    landmark_list = FaceDataModuleBase.load_landmark_list(landmarks_dir / "landmarks.pkl")  
             #    landmark_list = FaceDataModuleBase.load_landmark_list(landmarks_dir / "landmarks_original.pkl") 
                 if not self.preload_videos: 
@@ -912,6 +1034,34 @@ class VideoDatasetBase(AbstractVideoDataset):
     def _path_to_emotions(self, index): 
         return (Path(self.output_dir) / f"emotions" / self.emotion_type /  self.video_list[self.video_indices[index]]).with_suffix("")
 
+    def _path_to_features(self, index, feature_type): 
+        return (Path(self.output_dir) / f"features" / feature_type /  self.video_list[self.video_indices[index]]).with_suffix("")
+
+    def _load_cached_features(self, index, feature_type, start_frame=None, end_frame=None): 
+        features_dir = self._path_to_features(index, feature_type)
+        if not (features_dir / "features.hdf5").exists():
+            raise RuntimeError(f"Cached features not found in {features_dir}. Run inferno.datasets.FeatureCache.extract_feature_cache first.")
+        return load_feature_list_v2(features_dir / "features.hdf5", start_frame=start_frame, end_frame=end_frame)
+
+    def _get_cached_features(self, index, start_frame, num_read_frames, video_fps, num_frames, sample): 
+        sequence_length = self._get_sample_length(index)
+        for feature_type in self.feature_cache_types:
+            if not self.preload_videos:
+                features = self._load_cached_features(index, feature_type, 
+                                                      start_frame=start_frame, end_frame=start_frame+num_read_frames)
+            else: 
+                features = {key: value[:, start_frame:start_frame+num_read_frames] 
+                            for key, value in self.feature_cache[index][feature_type].items()}
+            for key in features.keys():
+                assert key not in sample.keys(), f"Key {key} already exists in sample."
+                feature = features[key][0].astype(np.float32)
+                # if shorter than the sequence, pad with zeros
+                if feature.shape[0] < sequence_length:
+                    feature = np.concatenate([feature, 
+                        np.zeros((sequence_length - feature.shape[0],) + feature.shape[1:], dtype=feature.dtype)], axis=0)
+                sample[key] = feature
+        return sample
+
     def _get_segmentations(self, index, start_frame, num_read_frames, video_fps, num_frames, sample): 
         segmentations_dir = self._path_to_segmentations(index)
         segmentations = []
@@ -1688,6 +1838,8 @@ class VideoDatasetBaseV2(VideoDatasetBase):
     def _read_landmarks(self, index, landmark_type, landmark_source):
         landmarks_dir = self._path_to_landmarks(index, landmark_type, landmark_source)
         if landmark_source == "original":
+            if (landmarks_dir / "landmarks_aligned_video_smoothed.hdf5").exists(): # [T, 1, K, D] array with a validity mask, memory-mapped
+                return open_landmark_list_v3(landmarks_dir / "landmarks_aligned_video_smoothed.hdf5")
             landmark_list_file = landmarks_dir / f"landmarks_aligned_video_smoothed.pkl"
             landmark_list = FaceDataModuleBase.load_landmark_list(landmark_list_file)  
             landmark_valid_indices = FaceDataModuleBase.load_landmark_list(landmarks_dir / "landmarks_alignment_used_frame_indices.pkl")  
@@ -1721,7 +1873,17 @@ class VideoDatasetBaseV2(VideoDatasetBase):
                 #     landmark_list = self.lmk_cache[index][landmark_type]
                 #     # landmark_types = self.lmk_cache[index]["landmark_types"]
 
-                if landmark_list_file.exists():
+                landmark_v3_file = landmarks_dir / "landmarks_aligned_video_smoothed.hdf5"
+                if landmark_v3_file.exists(): # random access, only the frames of the sample are read
+                    if not self.preload_videos: 
+                        landmarks, landmark_validity = load_landmark_list_v3(landmark_v3_file, start_frame, sequence_length + start_frame)
+                    else: 
+                        landmarks, landmark_validity = self.lmk_cache[index][landmark_type][landmark_source]
+                        landmarks = landmarks[start_frame: sequence_length + start_frame]
+                        landmark_validity = landmark_validity[start_frame: sequence_length + start_frame]
+                    landmarks = np.array(landmarks[:, 0])
+                    landmark_validity = landmark_validity[:, 0:1].astype(np.float32)
+                elif landmark_list_file.exists():
                     if not self.preload_videos:
                         landmark_list, landmark_valid_indices = self._read_landmarks(index, landmark_type, landmark_source)
                     else:
@@ -1753,12 +1915,14 @@ class VideoDatasetBaseV2(VideoDatasetBase):
                 else: 
                     landmarks, landmark_confidences = self.lmk_cache[index][landmark_type][landmark_source]
 
+                # only scale the frames of the sample (the cached landmarks may be a read-only SharedArray)
+                landmarks = landmarks[start_frame: sequence_length + start_frame]
+
                 # scale by image size 
                 original_image_size =  self.original_image_size
                 # landmarks = landmarks * self.image_size # do not use this one, this is the desired size (the video will be resized to this one)
                 landmarks = landmarks * original_image_size # use the original size
 
-                landmarks = landmarks[start_frame: sequence_length + start_frame]
                 # landmark_confidences = landmark_confidences[start_frame: sequence_length + start_frame]
                 # landmark_validity = landmark_confidences #TODO: something is wrong here, the validity is not correct and has different dimensions
                 # landmark_validity = None # this line craashes the code if FAN landmarks used (sometimes they are missing)
@@ -49,6 +49,7 @@ import inferno.utils.DecaUtils as util
 from inferno.datasets.AffWild2Dataset import Expression7
 from inferno.datasets.AffectNetDataModule import AffectNetExpressions
 from inferno.utils.lightning_logging import _log_array_image, _log_wandb_image, _torch_image2np
+from inferno.utils.metric_accumulator import MetricAccumulator, batch_size_of, log_accumulated_metrics
 
 torch.backends.cudnn.benchmark = True
 from enum import Enum
@@ -78,6 +79,10 @@ class DecaModule(LightningModule):
         super().__init__()
         self.learning_params = learning_params
         self.inout_params = inout_params
+        # the losses and metrics are accumulated on the device and only reduced at the end of the epoch
+        self._train_metrics = MetricAccumulator()
+        self._val_metrics = {}
+        self._test_metrics = {}
 
         # detail conditioning - what is given as the conditioning input to the detail generator in detail stage training
         if 'detail_conditioning' not in model_params.keys():
@@ -2309,7 +2314,7 @@ class DecaModule(LightningModule):
 
         # losses_and_metrics_to_log = {prefix + dataloader_str +'_val_' + key: value.detach().cpu() for key, value in losses_and_metrics.items()}
         # losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach() for key, value in losses_and_metrics.items()}
-        losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach().cpu().item() for key, value in losses_and_metrics.items()}
+        losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach() for key, value in losses_and_metrics.items()}
         losses_and_metrics_to_log[prefix + '_' + stage_str + 'epoch'] = self.current_epoch
         # losses_and_metrics_to_log[prefix + '_' + stage_str + 'epoch'] = torch.tensor(self.current_epoch, device=self.device)
         # log val_loss also without any prefix for a model checkpoint to track it
@@ -2326,7 +2331,8 @@ class DecaModule(LightningModule):
 
 
         if self.logger is not None:
-            self.log_dict(losses_and_metrics_to_log, on_step=False, on_epoch=True, sync_dist=True) # log per epoch # recommended
+            # log per epoch (see on_validation_epoch_end)
+            self._accumulate_metrics(self._val_metrics, dataloader_idx, losses_and_metrics_to_log, batch)
 
         if self.trainer.is_global_zero:
             if self.deca.config.val_vis_frequency > 0:
@@ -2344,6 +2350,24 @@ class DecaModule(LightningModule):
 
         return None
 
+    def _accumulate_metrics(self, accumulators, dataloader_idx, losses_and_metrics_to_log, batch):
+        dataloader_idx = dataloader_idx or 0
+        if dataloader_idx not in accumulators:
+            accumulators[dataloader_idx] = MetricAccumulator()
+        accumulators[dataloader_idx].update(losses_and_metrics_to_log, weight=batch_size_of(batch))
+
+    def training_epoch_end(self, outputs):
+        # logged before the callbacks' on_train_epoch_end, where ModelCheckpoint may save on a train metric
+        log_accumulated_metrics(self, {0: self._train_metrics})
+
+    def on_validation_epoch_end(self):
+        super().on_validation_epoch_end()
+        log_accumulated_metrics(self, self._val_metrics)
+
+    def on_test_epoch_end(self):
+        super().on_test_epoch_end()
+        log_accumulated_metrics(self, self._test_metrics)
+
     def _get_logging_prefix(self):
         prefix = self.stage_name + str(self.mode.name).lower()
         return prefix
@@ -2373,7 +2397,7 @@ class DecaModule(LightningModule):
             if 'mask' in batch.keys():
                 losses_and_metrics = self.compute_loss(values, batch, training=False, testing=testing)
                 # losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach().cpu() for key, value in losses_and_metrics.items()}
-                losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach().cpu().item() for key, value in losses_and_metrics.items()}
+                losses_and_metrics_to_log = {prefix + '_' + stage_str + key: value.detach() for key, value in losses_and_metrics.items()}
             else:
                 losses_and_metric = None
 
@@ -2395,7 +2419,7 @@ class DecaModule(LightningModule):
 
         if self.logger is not None:
             # self.logger.log_metrics(losses_and_metrics_to_log)
-            self.log_dict(losses_and_metrics_to_log, sync_dist=True, on_step=False, on_epoch=True)
+            self._accumulate_metrics(self._test_metrics, dataloader_idx, losses_and_metrics_to_log, batch)
 
         # if self.global_step % 200 == 0:
         uv_detail_normals = None
@@ -2439,7 +2463,7 @@ class DecaModule(LightningModule):
         prefix = self._get_logging_prefix()
         # losses_and_metrics_to_log = {prefix + '_train_' + key: value.detach().cpu() for key, value in losses_and_metrics.items()}
         # losses_and_metrics_to_log = {prefix + '_train_' + key: value.detach() for key, value in losses_and_metrics.items()}
-        losses_and_metrics_to_log = {prefix + '_train_' + key: value.detach().cpu().item() for key, value in losses_and_metrics.items()}
+        losses_and_metrics_to_log = {prefix + '_train_' + key: value.detach() for key, value in losses_and_metrics.items()}
         # losses_and_metrics_to_log[prefix + '_train_' + 'epoch'] = torch.tensor(self.current_epoch, device=self.device)
         losses_and_metrics_to_log[prefix + '_train_' + 'epoch'] = self.current_epoch
         losses_and_metrics_to_log[prefix + '_train_' + 'step'] = self.global_step
@@ -2457,7 +2481,8 @@ class DecaModule(LightningModule):
         losses_and_metrics_to_log['loss'] = losses_and_metrics_to_log[prefix + '_train_loss']
 
         if self.logger is not None:
-            self.log_dict(losses_and_metrics_to_log, on_step=False, on_epoch=True, sync_dist=True) # log per epoch, # recommended
+            # log per epoch (see training_epoch_end)
+            self._train_metrics.update(losses_and_metrics_to_log, weight=batch_size_of(batch))
 
         if self.deca.config.train_vis_frequency > 0:
             if self.global_step % self.deca.config.train_vis_frequency == 0:
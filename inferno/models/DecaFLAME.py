@@ -12,7 +12,7 @@ import numpy as np
 import pickle
 import torch.nn.functional as F
 
-from inferno.utils.lbs import lbs, batch_rodrigues, vertices2landmarks
+from inferno.utils.lbs import lbs, lbs_shaped, batch_rodrigues, vertices2landmarks, blend_shapes, vertices2joints
 
 
 def to_tensor(array, dtype=torch.float32):
@@ -248,6 +248,11 @@ class FLAME(nn.Module):
                           self.lbs_weights, dtype=self.dtype, 
                           detach_pose_correctives=False)
 
+        landmarks2d, landmarks3d = self._landmarks(vertices, full_pose)
+        return vertices, landmarks2d, landmarks3d
+
+    def _landmarks(self, vertices, full_pose):
+        batch_size = vertices.shape[0]
         lmk_faces_idx = self.lmk_faces_idx.unsqueeze(dim=0).expand(batch_size, -1)
         lmk_bary_coords = self.lmk_bary_coords.unsqueeze(dim=0).expand(batch_size, -1, -1)
 
@@ -265,8 +270,96 @@ class FLAME(nn.Module):
         landmarks3d = vertices2landmarks(vertices, self.faces_tensor,
                                          self.full_lmk_faces_idx.repeat(bz, 1),
                                          self.full_lmk_bary_coords.repeat(bz, 1, 1))
+        return landmarks2d, landmarks3d
 
-        return vertices, landmarks2d, landmarks3d
+    def identity_cache(self, shape_params):
+        """
+        Precomputes the identity dependent part of FLAME for shape_params [B, n_shape]: the shaped template 
+        [B, V, 3] and its joints [B, J, 3]. It can be reused for any number of frames (see forward_sequence).
+        """
+        v_shaped = self.v_template.unsqueeze(0) + blend_shapes(shape_params, self.shapedirs[:, :, :self.cfg.n_shape])
+        J = vertices2joints(self.J_regressor, v_shaped)
+        return v_shaped, J
+
+    def forward_sequence(self, shape_params=None, expression_params=None, pose_params=None, eye_pose_params=None, identity=None):
+        """
+        FLAME for sequences with one identity each (the same result as forward with shape_params repeated over time). 
+        The shaped template and its joints are computed once per sequence, only the expression blend shapes, 
+        the pose correctives and the skinning are evaluated per frame.
+            Input:
+                shape_params: B X number of shape parameters (not needed if identity is given)
+                expression_params: B X T X number of expression parameters
+                pose_params: B X T X number of pose parameters (6)
+                eye_pose_params: B X T X 6
+                identity: the output of identity_cache (optional)
+            return:
+                vertices: B X T X V X 3
+                landmarks: B X T X number of landmarks X 3
+        """
+        if identity is None:
+            identity = self.identity_cache(shape_params)
+        v_shaped_id, J_id = identity
+        B = v_shaped_id.shape[0]
+        T = next((p.shape[1] for p in [expression_params, pose_params, eye_pose_params] if p is not None), 1)
+        if pose_params is None:
+            pose_params = self.eye_pose.expand(B * T, -1)
+        if eye_pose_params is None:
+            eye_pose_params = self.eye_pose.expand(B * T, -1)
+        if expression_params is None:
+            expression_params = torch.zeros(B, T, self.cfg.n_exp, device=v_shaped_id.device, dtype=v_shaped_id.dtype)
+        expression_params = expression_params.reshape(B * T, -1)
+        pose_params = pose_params.reshape(B * T, -1)
+        eye_pose_params = eye_pose_params.reshape(B * T, -1)
+
+        # the joint regressor is linear, the joints of the expression blend shapes are added to the identity joints
+        exprdirs = self.shapedirs[:, :, self.cfg.n_shape:]
+        J_exprdirs = torch.einsum('ji,ikl->jkl', [self.J_regressor, exprdirs])
+        v_shaped = (v_shaped_id.unsqueeze(1) + blend_shapes(expression_params, exprdirs).view(B, T, -1, 3)).view(B * T, -1, 3)
+        J = (J_id.unsqueeze(1) + torch.einsum('bl,jkl->bjk', [expression_params, J_exprdirs]).view(B, T, -1, 3)).view(B * T, -1, 3)
+
+        full_pose = torch.cat(
+            [pose_params[:, :3], self.neck_pose.expand(B * T, -1), pose_params[:, 3:], eye_pose_params], dim=1)
+        vertices, _ = lbs_shaped(v_shaped, J, full_pose, self.posedirs, self.parents, self.lbs_weights, 
+                                 dtype=self.dtype, detach_pose_correctives=False)
+        landmarks2d, landmarks3d = self._landmarks(vertices, full_pose)
+        return vertices.view(B, T, *vertices.shape[1:]), landmarks2d.view(B, T, *landmarks2d.shape[1:]), \
+            landmarks3d.view(B, T, *landmarks3d.shape[1:])
+
+
+def check_and_benchmark_forward_sequence(flame, B=8, T=100, num_runs=10, device=None):
+    """
+    Compares FLAME.forward_sequence with FLAME.forward (shape repeated over the frames) on random parameters 
+    and measures the speed of both. Returns the maximum vertex difference.
+    """
+    import time
+    device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    flame = flame.to(device)
+    shape = torch.randn(B, flame.cfg.n_shape, device=device)
+    exp = torch.randn(B, T, flame.cfg.n_exp, device=device)
+    pose = torch.randn(B, T, 6, device=device) * 0.1
+
+    def run_forward():
+        return flame(shape[:, None].expand(B, T, -1).reshape(B * T, -1), exp.view(B * T, -1), pose.view(B * T, -1))
+
+    def run_sequence():
+        return flame.forward_sequence(shape, exp, pose)
+
+    with torch.no_grad():
+        reference = run_forward()
+        result = run_sequence()
+        max_diff = max((r.reshape(B * T, -1) - o.reshape(B * T, -1)).abs().max().item() for r, o in zip(reference, result))
+        print(f"Max difference to FLAME.forward: {max_diff:.3e}")
+        for name, fn in [("forward", run_forward), ("forward_sequence", run_sequence)]:
+            fn()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(num_runs):
+                fn()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            print(f"{name:>17}: {(time.time() - start) / num_runs * 1000:.2f} ms per [{B}, {T}] batch")
+    return max_diff
 
 
 class FLAME_mediapipe(FLAME): 
@@ -506,3 +599,15 @@ class FLAMETex_trainable(nn.Module):
         texture = F.interpolate(texture, [256, 256])
         texture = texture[:, [2, 1, 0], :, :]
         return texture
+
+
+if __name__ == "__main__":
+    from omegaconf import OmegaConf
+    from inferno.utils.other import get_path_to_assets
+    flame_cfg = OmegaConf.create({
+        "flame_model_path": str(get_path_to_assets() / "FLAME/geometry/generic_model.pkl"),
+        "flame_lmk_embedding_path": str(get_path_to_assets() / "FLAME/geometry/landmark_embedding.npy"),
+        "n_shape": 100,
+        "n_exp": 50,
+    })
+    check_and_benchmark_forward_sequence(FLAME(flame_cfg))
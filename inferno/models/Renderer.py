@@ -214,7 +214,7 @@ class SRenderY(nn.Module):
              (pi / 4) * (1 / 2) * (np.sqrt(5 / (4 * pi)))]).float()
         self.register_buffer('constant_factor', constant_factor)
 
-    def forward(self, vertices, transformed_vertices, albedos, lights=None, light_type='point'):
+    def forward(self, vertices, transformed_vertices, albedos, lights=None, light_type='point', rasterizer=None):
         '''
         -- Texture Rendering
         vertices: [batch_size, V, 3], vertices in world space, for calculating normals, then shading
@@ -225,7 +225,11 @@ class SRenderY(nn.Module):
             points/directional lighting: [N, n_lights, 6(xyzrgb)]
         light_type:
             point or directional
+        rasterizer:
+            optional rasterizer used instead of self.rasterizer (e.g. one of a different image size)
         '''
+        if rasterizer is None:
+            rasterizer = self.rasterizer
         batch_size = vertices.shape[0]
         ## rasterizer near 0 far 100. move mesh so minz larger than 0
         transformed_vertices[:, :, 2] = transformed_vertices[:, :, 2] + 10
@@ -244,7 +248,7 @@ class SRenderY(nn.Module):
                                -1)
 
         # rasterize
-        rendering = self.rasterizer(transformed_vertices, self.faces.expand(batch_size, -1, -1), attributes)
+        rendering = rasterizer(transformed_vertices, self.faces.expand(batch_size, -1, -1), attributes)
 
         ####
         # vis mask
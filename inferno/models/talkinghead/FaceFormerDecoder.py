@@ -306,6 +306,8 @@ class FaceFormerDecoderBase(AutoRegressiveDecoder):
         self.obj_vector = style_from_cfg(cfg)
 
         self.use_alignment_bias = cfg.get('use_alignment_bias', True)
+        # incremental decoding with cached keys/values at inference time (see _autoregressive_step_cached)
+        self.use_kv_cache = cfg.get('kv_cache', True)
 
     def to(self, *args, **kwargs):
         super().to(*args, **kwargs)
@@ -324,7 +326,20 @@ class FaceFormerDecoderBase(AutoRegressiveDecoder):
         else: 
             return self.max_len
 
+    def _kv_cache_applicable(self):
+        # the cached decoding only gives the same result if each frame attends to the past only 
+        # (and there is no dropout)
+        return self.use_kv_cache and not self.training and self.temporal_bias_type in ['faceformer', 'classic']
+
+    def _step_output_keys(self):
+        """
+        The per-frame outputs produced by _decode_vertices
+        """
+        return ["predicted_vertices"]
+
     def _autoregressive_step(self, sample, i):
+        if self._kv_cache_applicable():
+            return self._autoregressive_step_cached(sample, i)
         hidden_states = sample["hidden_feature"]
         if i==0:
             # one_hot = sample["one_hot"]
@@ -360,6 +375,105 @@ class FaceFormerDecoderBase(AutoRegressiveDecoder):
         sample["embedded_output"] = vertice_emb
         return sample
 
+    def _autoregressive_step_cached(self, sample, i):
+        """
+        Equivalent of _autoregressive_step that only runs the newest token through the transformer decoder. 
+        The self-attention keys/values of the previous tokens and the cross-attention keys/values 
+        of the audio features are cached in sample["kv_cache"], so generating T frames costs T single-token passes 
+        instead of T passes over the whole (growing) sequence. 
+        The per-frame outputs are collected in sample["kv_cache_outputs"] and concatenated in _post_prediction.
+        """
+        hidden_states = sample["hidden_feature"]
+        vertices_out_last = None
+        if i == 0:
+            style_emb = self._style(sample, hidden_states.device)
+            sample["style_emb"] = style_emb
+            vertice_emb = style_emb[:,0:1,:] # take the first to kick off the auto-regressive process
+            sample["kv_cache"] = self._init_kv_cache(hidden_states)
+            sample["kv_cache_outputs"] = {key: [] for key in self._step_output_keys()}
+            if self.PE is not None and style_emb.shape[1] > 1:
+                # the uncached path kicks off with all the per-frame style tokens and continues from the last one, 
+                # do the same to get identical results (only the first token is cached)
+                vertices_out_last = self._decode(sample, self.PE(style_emb), hidden_states)[:,-1,:]
+        else:
+            vertice_emb = sample["embedded_output"]
+            style_emb = sample["style_emb"]
+        if self.PE is not None:
+            vertices_input = self.PE(vertice_emb)[:,-1:,:]
+        else: 
+            vertices_input = vertice_emb[:,-1:,:]
+
+        transformer_out = self._decode_step(sample["kv_cache"], vertices_input, i, hidden_states.shape[1])
+        vertices_out = self._decode_vertices(sample, transformer_out, start_frame=i)
+        sample["predicted_vertices"] = vertices_out
+        for key in self._step_output_keys():
+            sample["kv_cache_outputs"][key] += [sample[key]]
+        if vertices_out_last is None:
+            vertices_out_last = vertices_out[:,-1,:]
+
+        new_output = self.vertice_map(vertices_out_last).unsqueeze(1)
+        style_T = style_emb.shape[1]
+        if style_T == 1: # per sample style embeeding
+            new_output = new_output + style_emb
+        else: # per sample and frame style embedding
+            new_output = new_output + style_emb[:,i:i+1,:]
+        vertice_emb = torch.cat((vertice_emb, new_output), 1)
+        sample["embedded_output"] = vertice_emb
+        return sample
+
+    def _init_kv_cache(self, hidden_states):
+        cache = []
+        for layer in self.transformer_decoder.layers:
+            # the cross-attention keys and values only depend on the audio features, project them once
+            _, cross_k, cross_v = _attention_in_projection(layer.multihead_attn, hidden_states, kv_only=True)
+            cache += [{"self_k": None, "self_v": None, "cross_k": cross_k, "cross_v": cross_v}]
+        return cache
+
+    def _decode_step(self, cache, x, i, memory_length):
+        """
+        Runs token i (x, [B, 1, feature_dim]) through the layers of the transformer decoder, 
+        same as nn.TransformerDecoder with the masks of _decode.
+        """
+        if self.biased_mask is not None:
+            tgt_mask = self.biased_mask[..., i:i+1, :i+1].to(device=x.device, dtype=x.dtype)
+            if tgt_mask.ndim == 3: # [num_heads, 1, i+1] -> broadcast over the batch
+                tgt_mask = tgt_mask.unsqueeze(0)
+        else: 
+            tgt_mask = None
+        if self.use_alignment_bias:
+            # attends to diagonals only (nothing if there are more frames than audio features, as in enc_dec_mask)
+            memory_mask = torch.full((1, memory_length), float('-inf'), device=x.device, dtype=x.dtype)
+            if i < memory_length:
+                memory_mask[:, i] = 0.
+        else:
+            memory_mask = None
+
+        for layer, layer_cache in zip(self.transformer_decoder.layers, cache):
+            if layer.norm_first:
+                x = x + layer.dropout1(self._cached_self_attention(layer, layer_cache, layer.norm1(x), tgt_mask))
+                x = x + layer.dropout2(self._cached_cross_attention(layer, layer_cache, layer.norm2(x), memory_mask))
+                x = x + layer._ff_block(layer.norm3(x))
+            else:
+                x = layer.norm1(x + layer.dropout1(self._cached_self_attention(layer, layer_cache, x, tgt_mask)))
+                x = layer.norm2(x + layer.dropout2(self._cached_cross_attention(layer, layer_cache, x, memory_mask)))
+                x = layer.norm3(x + layer._ff_block(x))
+        if self.transformer_decoder.norm is not None:
+            x = self.transformer_decoder.norm(x)
+        return x
+
+    def _cached_self_attention(self, layer, layer_cache, x, mask):
+        q, k, v = _attention_in_projection(layer.self_attn, x)
+        if layer_cache["self_k"] is not None:
+            k = torch.cat([layer_cache["self_k"], k], dim=2)
+            v = torch.cat([layer_cache["self_v"], v], dim=2)
+        layer_cache["self_k"] = k
+        layer_cache["self_v"] = v
+        return _attention(layer.self_attn, q, k, v, mask)
+
+    def _cached_cross_attention(self, layer, layer_cache, x, mask):
+        q, _, _ = _attention_in_projection(layer.multihead_attn, x, q_only=True)
+        return _attention(layer.multihead_attn, q, layer_cache["cross_k"], layer_cache["cross_v"], mask)
+
     def _style(self, sample, device):
         if self.obj_vector is None:
             return torch.zeros(1,1,self.cfg.feature_dim).to(device)
@@ -422,6 +536,12 @@ class FaceFormerDecoderBase(AutoRegressiveDecoder):
         return vertices_out
 
     def _post_prediction(self, sample):
+        if "kv_cache_outputs" in sample.keys():
+            # cached decoding, gather the per-frame outputs
+            for key, outputs in sample["kv_cache_outputs"].items():
+                sample[key] = torch.cat(outputs, dim=1)
+            del sample["kv_cache_outputs"]
+            del sample["kv_cache"]
         template = sample["template"]
         vertices_out = sample["predicted_vertices"]
         vertices_out = vertices_out + template[:, None, ...]
@@ -443,7 +563,7 @@ class FaceFormerDecoder(FaceFormerDecoderBase):
         nn.init.constant_(self.vertex_map.weight, 0)
         nn.init.constant_(self.vertex_map.bias, 0)
 
-    def _decode_vertices(self, sample, transformer_out): 
+    def _decode_vertices(self, sample, transformer_out, start_frame=0): 
         vertice_out = self.vertex_map(transformer_out)
         return vertice_out
 
@@ -499,8 +619,10 @@ class FlameFormerDecoder(FaceFormerDecoderBase):
     def _rotation_representation(self):
         return self.rotation_representation
 
+    def _step_output_keys(self):
+        return ["predicted_vertices", "predicted_exp", "predicted_jaw"]
 
-    def _decode_vertices(self, sample, transformer_out): 
+    def _decode_vertices(self, sample, transformer_out, start_frame=0): 
         template = sample["template"]
         # jaw = sample["gt_jaw"]
         # exp = sample["exp"]
@@ -522,13 +644,13 @@ class FlameFormerDecoder(FaceFormerDecoderBase):
                 jaw_pose = U.contiguous()
             
         else: 
-            jaw = sample["gt_jaw"][:, :T_size, ...]
+            jaw = sample["gt_jaw"][:, start_frame:start_frame + T_size, ...]
             jaw_pose = jaw.view(batch_size*T_size, -1)
         if self.predict_exp: 
             expression_params = transformer_out[..., vector_idx:].view(batch_size*T_size, -1)
             vector_idx += self.flame_config.n_exp
         else: 
-            exp = sample["gt_exp"][:, :T_size, ...]
+            exp = sample["gt_exp"][:, start_frame:start_frame + T_size, ...]
             expression_params = exp.view(batch_size*T_size, -1)
         
         sample["predicted_exp"] = expression_params.view(batch_size,T_size, -1)
@@ -557,14 +679,46 @@ class FlameFormerDecoder(FaceFormerDecoderBase):
             vertices_neutral, _, _ = self.flame.forward(shape_params[:, 0, ...], zero_exp) # compute neutral shape
             vertices_neutral = vertices_neutral.contiguous().view(vertices_neutral.shape[0], -1)[:, None, ...]
 
-        shape_params = shape_params.view(B * T_size, -1)
-        vertices_out, _, _ = self.flame(shape_params, expression_params, pose_params)
+        # one identity per sequence, the shaped template is only computed once
+        vertices_out, _, _ = self.flame.forward_sequence(shape_params[:, 0, ...], expression_params.reshape(B, T_size, -1), 
+                                                         pose_params.reshape(B, T_size, -1))
         vertices_out = vertices_out.contiguous().view(batch_size, T_size, -1)
         vertices_out = vertices_out - vertices_neutral # compute the offset that is then added to the template shape
         
         return vertices_out
 
 
+def _attention_in_projection(mha, x, q_only=False, kv_only=False):
+    """
+    The query/key/value projections of nn.MultiheadAttention (batch_first, same embedding dims), 
+    split into heads: [B, L, E] -> [B, num_heads, L, head_dim]
+    """
+    B, L, E = x.shape
+    w_q, w_k, w_v = mha.in_proj_weight.chunk(3)
+    b_q, b_k, b_v = mha.in_proj_bias.chunk(3) if mha.in_proj_bias is not None else (None, None, None)
+    split = lambda t: t.view(B, L, mha.num_heads, E // mha.num_heads).transpose(1, 2)
+    q = split(nn.functional.linear(x, w_q, b_q)) if not kv_only else None
+    if q_only: 
+        return q, None, None
+    k = split(nn.functional.linear(x, w_k, b_k))
+    v = split(nn.functional.linear(x, w_v, b_v))
+    return q, k, v
+
+
+def _attention(mha, q, k, v, mask=None):
+    """
+    Scaled dot-product attention followed by the output projection of nn.MultiheadAttention. 
+    mask is additive (-inf for masked out positions) and broadcastable to [B, num_heads, L_q, L_k]
+    """
+    scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(q.shape[-1])
+    if mask is not None:
+        scores = scores + mask
+    out = torch.matmul(scores.softmax(dim=-1), v)
+    B, _, L, _ = out.shape
+    out = out.transpose(1, 2).reshape(B, L, -1)
+    return mha.out_proj(out)
+
+
 # Alignment Bias
 def enc_dec_mask(device, T, S, dataset="vocaset"):
     mask = torch.ones(T, S)
@@ -880,8 +1034,9 @@ class FlameBertDecoder(BertDecoder):
         vertices_neutral = self._neutral_shape(B, expression_params.shape[1], shape_params)
         # vertices_neutral = vertices_neutral.expand(B, T, -1, -1)
 
-        shape_params = shape_params.view(B * T, -1)
-        vertices_out, _, _ = self.flame(shape_params, expression_params, pose_params)
+        # one identity per sequence, the shaped template is only computed once
+        vertices_out, _, _ = self.flame.forward_sequence(shape_params[:, 0, ...], expression_params.reshape(B, T, -1), 
+                                                         pose_params.reshape(B, T, -1))
         vertices_out = vertices_out.contiguous().view(B, T, -1)
         vertex_offsets = vertices_out - vertices_neutral # compute the offset that is then added to the template shape
         vertex_offsets = vertex_offsets.view(B, T, -1)
@@ -1298,4 +1453,30 @@ class LinearAutoRegDecoder(AutoRegressiveDecoder):
 
 
 def get_rec_dict(batch, rec_type): 
-    rec_dict = batch if rec_type is None else batch["reconstruction"][rec_type]
\ No newline at end of file
+    rec_dict = batch if rec_type is None else batch["reconstruction"][rec_type]
+
+
+if __name__ == "__main__":
+    """
+    Check that the cached autoregressive decoding matches the uncached one
+    """
+    cfg = OmegaConf.create({
+        "positional_encoding": {"type": "PeriodicPositionalEncoding", "period": 25, "max_seq_len": 600},
+        "feature_dim": 64, "max_len": 600, "period": 25, "nhead": 4, "num_layers": 2,
+        "vertices_dim": 15, "style_embedding": "onehot_linear", "num_training_subjects": 8,
+    })
+    decoder = FaceFormerDecoder(cfg)
+    nn.init.normal_(decoder.vertex_map.weight, std=0.1)
+    decoder.eval()
+    B, T = 2, 100
+    sample = {
+        "seq_encoder_output": torch.randn(B, T, cfg.feature_dim),
+        "template": torch.randn(B, cfg.vertices_dim),
+        "one_hot": torch.nn.functional.one_hot(torch.tensor([0, 3]), cfg.num_training_subjects).float(),
+    }
+    with torch.no_grad():
+        decoder.use_kv_cache = False
+        out_full = decoder(dict(sample), teacher_forcing=False)["predicted_vertices"]
+        decoder.use_kv_cache = True
+        out_cached = decoder(dict(sample), teacher_forcing=False)["predicted_vertices"]
+    print("Max abs difference: ", (out_full - out_cached).abs().max().item())
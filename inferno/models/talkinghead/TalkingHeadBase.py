@@ -25,6 +25,7 @@ from inferno.models.temporal.Bases import *
 import random
 import omegaconf
 from inferno.utils.batch import check_nan, detach_dict
+from inferno.utils.metric_accumulator import MetricAccumulator, batch_size_of, log_accumulated_metrics
 
 
 class TalkingHeadBase(pl.LightningModule): 
@@ -62,6 +63,11 @@ class TalkingHeadBase(pl.LightningModule):
         else:
             self.code_vec_input_name = "seq_decoder_output"
 
+        # the losses and metrics are accumulated on the device and only reduced when they are logged
+        self._train_step_metrics = MetricAccumulator()
+        self._train_epoch_metrics = MetricAccumulator()
+        self._val_metrics = {}
+
     def on_validation_epoch_start(self):
         super().on_validation_epoch_start()
         validation_loaders = self.trainer.datamodule.val_dataloader()
@@ -158,14 +164,35 @@ class TalkingHeadBase(pl.LightningModule):
 
         losses_and_metrics_to_log = {**losses, **metrics}
         # losses_and_metrics_to_log = {"train_" + k: v.item() for k, v in losses_and_metrics_to_log.items()}
-        losses_and_metrics_to_log = {"train/" + k: v.item() if isinstance(v, (torch.Tensor)) else v if isinstance(v, float) else 0. for k, v in losses_and_metrics_to_log.items()}
+        losses_and_metrics_to_log = _to_loggable("train/", losses_and_metrics_to_log)
         
         if self.logger is not None:
             # self.log_dict(losses_and_metrics_to_log, on_step=False, on_epoch=True, sync_dist=True) # log per epoch, # recommended
-            self.log_dict(losses_and_metrics_to_log, on_step=True, on_epoch=True, sync_dist=True) # log per epoch, # recommended
+            batch_size = batch_size_of(batch)
+            self._train_step_metrics.update(losses_and_metrics_to_log, weight=batch_size)
+            self._train_epoch_metrics.update(losses_and_metrics_to_log, weight=batch_size)
+            self._log_train_step_metrics(batch_idx)
 
         return total_loss
 
+    def _log_train_step_metrics(self, batch_idx):
+        # the step values are averaged over the logging interval (one reduction and host transfer per interval)
+        last_batch = batch_idx + 1 >= self.trainer.num_training_batches
+        if (batch_idx + 1) % self.trainer.log_every_n_steps != 0 and not last_batch:
+            return
+        values = self._train_step_metrics.compute(sync_dist=True)
+        self.logger.log_metrics({k + "_step": v for k, v in values.items()}, step=self.global_step)
+
+    def training_epoch_end(self, outputs):
+        # logged here and not in on_train_epoch_end: the callbacks' on_train_epoch_end runs before the module's 
+        # and ModelCheckpoint monitors 'train/loss_total' there
+        log_accumulated_metrics(self, {0: self._train_epoch_metrics})
+        self._train_step_metrics.reset()
+
+    def on_validation_epoch_end(self):
+        super().on_validation_epoch_end()
+        log_accumulated_metrics(self, self._val_metrics)
+
 
     def _validation_step(self, batch, batch_idx, *args, **kwargs): 
         training = False 
@@ -177,7 +204,7 @@ class TalkingHeadBase(pl.LightningModule):
 
         losses_and_metrics_to_log = {**losses, **metrics}
         # losses_and_metrics_to_log = {"val_" + k: v.item() for k, v in losses_and_metrics_to_log.items()}
-        losses_and_metrics_to_log = {"val/" + k: v.item() if isinstance(v, (torch.Tensor)) else v if isinstance(v, float) else 0. for k, v in losses_and_metrics_to_log.items()}
+        losses_and_metrics_to_log = _to_loggable("val/", losses_and_metrics_to_log)
 
        
         return total_loss, losses_and_metrics_to_log
@@ -186,32 +213,70 @@ class TalkingHeadBase(pl.LightningModule):
         # if "one_hot" not in batch.keys():
         if "one_hot" not in batch.keys() or batch["one_hot"].ndim <= 2: #one-hot specified
             total_loss, losses_and_metrics_to_log =  self._validation_step(batch, batch_idx, *args, **kwargs)
-            if self.logger is not None:
-                self.log_dict(losses_and_metrics_to_log, on_step=False, on_epoch=True, sync_dist=True) # log per epoch, # recommended
-            return total_loss
-        # one hot is not specified, so we iterate over them
-        num_subjects = batch["one_hot"].shape[1]
+        else:
+            # one hot is not specified, so we validate with all the subject conditions
+            total_loss, losses_and_metrics_to_log = self._validation_step_all_subjects(batch, batch_idx, *args, **kwargs)
+
+        if self.logger is not None:
+            # logged per epoch (see on_validation_epoch_end)
+            dataloader_idx = args[0] if len(args) > 0 else 0
+            if dataloader_idx not in self._val_metrics:
+                self._val_metrics[dataloader_idx] = MetricAccumulator()
+            self._val_metrics[dataloader_idx].update(losses_and_metrics_to_log, weight=batch_size_of(batch))
+        return total_loss
+
+    def _validation_step_all_subjects(self, batch, batch_idx, *args, **kwargs):
+        """
+        Validates the batch with every subject condition of batch["one_hot"] [B, S, num_subjects] 
+        and averages the losses and metrics over the subjects. 
+        The subject independent part of the forward pass (preprocessing, GT features, audio features) runs only once. 
+        The subjects are then folded into the batch dimension (subject-major, [S*B, ...]) and decoded 
+        in passes of at most cfg.learning.val_folded_batch_size samples (cfg.learning.batch_size_train by default, 
+        at least one subject per pass). The key is optional and can be added to any learning/batching config
+        (see learning/batching/default.yaml), lower it if the validation runs out of memory with many subjects.
+        The losses are means over the batch, so the mean over a pass of whole subjects equals the mean of their 
+        per-subject losses.
+        """
+        training = False
+        one_hot = batch["one_hot"]
+        B, num_subjects = one_hot.shape[:2]
+        kwargs = dict(kwargs)
+        teacher_forcing = kwargs.pop("teacher_forcing", True)
+        batch = {k: v for k, v in batch.items() if k != "one_hot"}
+        sample = self.forward_input(batch, train=training, validation=True, teacher_forcing=teacher_forcing, **kwargs)
+
+        if self.disentangle_expansion_factor(training, True) == 1:
+            max_batch_size = self.cfg.learning.get('val_folded_batch_size', None)
+            if max_batch_size is None:
+                # a training batch fits into memory (with gradients), the validation passes are kept as large
+                max_batch_size = self.cfg.learning.get('batch_size_train', B)
+            subjects_per_pass = max(1, min(num_subjects, max_batch_size // B))
+        else:
+            # the condition exchange permutes the conditions within the batch, the subjects must not be mixed
+            subjects_per_pass = 1
+
         total_loss = None
         losses_and_metrics_to_log = None
-        one_hot = batch["one_hot"]
-        for i in range(num_subjects):
-            # batch["one_hot"] = one_hot[:, i:i+1, :]
-            batch["one_hot"] = one_hot[:, i, :]
-            one_subject_loss, subject_losses_and_metrics_to_log =  self._validation_step(batch, batch_idx, *args, **kwargs)
+        for s in range(0, num_subjects, subjects_per_pass):
+            subjects = one_hot[:, s:s + subjects_per_pass]
+            S = subjects.shape[1]
+            folded = fold_batch(sample, S)
+            folded["one_hot"] = subjects.transpose(0, 1).reshape(S * B, *subjects.shape[2:])
+            folded = self.forward_output(folded, train=training, validation=True, teacher_forcing=teacher_forcing, **kwargs)
+            pass_loss, losses, metrics = self.compute_loss(folded, training=training, validation=True, **kwargs)
+            # weighted by the number of subjects of the pass
+            pass_losses_and_metrics = {k: v * S for k, v in _to_loggable("val/", {**losses, **metrics}).items()}
             if total_loss is None:
-                total_loss = one_subject_loss
-                losses_and_metrics_to_log = subject_losses_and_metrics_to_log.copy()
+                total_loss = pass_loss * S
+                losses_and_metrics_to_log = pass_losses_and_metrics
             else:
-                total_loss += one_subject_loss
-                for k, v in subject_losses_and_metrics_to_log.items():
+                total_loss = total_loss + pass_loss * S
+                for k, v in pass_losses_and_metrics.items():
                     losses_and_metrics_to_log[k] += v
-        total_loss /= num_subjects
+        total_loss = total_loss / num_subjects
         for k, v in losses_and_metrics_to_log.items():
             losses_and_metrics_to_log[k] /= num_subjects
-
-        if self.logger is not None:
-            self.log_dict(losses_and_metrics_to_log, on_step=False, on_epoch=True, sync_dist=True) # log per epoch, # recommended                
-        return total_loss
+        return total_loss, losses_and_metrics_to_log
 
     def test_step(self, batch, batch_idx, *args, **kwargs):
         training = False 
@@ -231,6 +296,9 @@ class TalkingHeadBase(pl.LightningModule):
         # return total_loss
 
     def forward_audio(self, sample: Dict, train=False, desired_output_length=None, **kwargs: Any) -> Dict:
+        if "audio_feature" in sample.keys(): 
+            # the audio feature has already been computed (for instance once for all samples that share the same audio)
+            return sample
         return self.audio_model(sample, train=train, desired_output_length=desired_output_length, **kwargs)
 
     def encode_sequence(self, sample: Dict, train=False, **kwargs: Any) -> Dict:
@@ -504,6 +572,16 @@ class TalkingHeadBase(pl.LightningModule):
             - audio: (B, T, F)
             # - masked_audio: (B, T, F)
         """
+        sample = self.forward_input(sample, train=train, validation=validation, **kwargs)
+        teacher_forcing = kwargs.pop("teacher_forcing", False)
+        sample = self.forward_output(sample, train=train, validation=validation, teacher_forcing=teacher_forcing, **kwargs)
+        return sample
+
+    def forward_input(self, sample: Dict, train=False, validation=False, **kwargs: Any) -> Dict:
+        """
+        The part of the forward pass that does not depend on the subject condition: 
+        preprocessing, GT rendering and features and the audio features.
+        """
         # T = sample["raw_audio"].shape[1]
         T = sample["processed_audio"].shape[1] if "processed_audio" in sample.keys() else sample["raw_audio"].shape[1]
         if self.max_seq_length < T: # truncate
@@ -521,12 +599,18 @@ class TalkingHeadBase(pl.LightningModule):
 
         sample = self._choose_primary_3D_rec_method(sample)
 
-        teacher_forcing = kwargs.pop("teacher_forcing", False)
+        kwargs.pop("teacher_forcing", None)
         desired_output_length = sample["gt_vertices"].shape[1] if "gt_vertices" in sample.keys() else None
         sample = self.forward_audio(sample, train=train, desired_output_length=desired_output_length, **kwargs)
         # if self.uses_text():
         #     sample = self.forward_text(sample, **kwargs)
         check_nan(sample)
+        return sample
+
+    def forward_output(self, sample: Dict, train=False, validation=False, teacher_forcing=False, **kwargs: Any) -> Dict:
+        """
+        The (subject conditioned) rest of the forward pass: sequence encoding, disentanglement, decoding and rendering.
+        """
         # encode the sequence
         sample = self.encode_sequence(sample, train=train, **kwargs)
         check_nan(sample)
@@ -584,6 +668,12 @@ class TalkingHeadBase(pl.LightningModule):
         return total_loss, losses, metrics
 
 
+def _to_loggable(prefix, losses_and_metrics):
+    # the tensors are kept on the device (no .item() synchronization), other values than floats are logged as 0
+    return {prefix + k: v.detach() if isinstance(v, (torch.Tensor)) else v if isinstance(v, float) else 0. 
+        for k, v in losses_and_metrics.items()}
+
+
 def truncate_sequence_batch(sample: Dict, max_seq_length: int) -> Dict:
     """
     Truncate the sequence to the given length. 
@@ -603,6 +693,27 @@ def truncate_sequence_batch(sample: Dict, max_seq_length: int) -> Dict:
     return sample
 
 
+def fold_batch(sample, factor, batch_size=None):
+    """
+    Repeats the batch factor times along the batch dimension ([B, ...] -> [factor*B, ...], index s*B + b).
+    Tensors and lists of batch_size elements are repeated, other values are shared. 
+    """
+    if batch_size is None:
+        batch_size = sample["audio_feature"].shape[0] if "audio_feature" in sample.keys() else \
+            next(v.shape[0] for v in sample.values() if isinstance(v, torch.Tensor) and v.ndim > 0)
+    folded = {}
+    for key, value in sample.items():
+        if isinstance(value, torch.Tensor) and value.ndim > 0 and value.shape[0] == batch_size:
+            folded[key] = value.repeat(factor, *([1] * (value.ndim - 1)))
+        elif isinstance(value, List) and len(value) == batch_size:
+            folded[key] = value * factor
+        elif isinstance(value, Dict):
+            folded[key] = fold_batch(value, factor, batch_size)
+        else:
+            folded[key] = value
+    return folded
+
+
 def create_unique_permutation(indices):
     B = indices.shape[0]
     while True:
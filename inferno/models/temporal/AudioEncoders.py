@@ -166,6 +166,13 @@ class Wav2Vec2Encoder(TemporalAudioEncoder):
         return []
 
     def _forward(self, sample, train=False, desired_output_length=None): 
+        if not self.trainable and "audio_feature_cached" in sample.keys():
+            # the frozen model has been run offline (see inferno.datasets.FeatureCache), only the dropout is left to apply
+            sample["audio_feature"] = sample["audio_feature_cached"]
+            if self.dropout is not None:
+                sample["audio_feature"] = self.dropout(sample["audio_feature"])
+            return sample
+
         if self.input_processor is not None:
             B = sample["raw_audio"].shape[0]
             T = sample["raw_audio"].shape[1]
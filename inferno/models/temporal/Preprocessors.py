@@ -147,11 +147,19 @@ class FlamePreprocessor(Preprocessor):
             # shape = torch.zeros((B * T, self.cfg.flame.n_exp))
             # template_shape = torch.zeros_like(template_shape)
 
-            verts, landmarks_2D, landmarks_3D = self.flame(
-                shape_params=shape, 
-                expression_params=exp,
-                pose_params=pose
-            )
+            if gt_shape.ndim == 3:
+                verts, landmarks_2D, landmarks_3D = self.flame(
+                    shape_params=shape, 
+                    expression_params=exp,
+                    pose_params=pose
+                )
+            else:
+                # one identity per sequence, the shaped template is only computed once
+                verts, landmarks_2D, landmarks_3D = self.flame.forward_sequence(
+                    shape_params=template_shape_coeffs, 
+                    expression_params=exp.reshape(B, T, -1),
+                    pose_params=pose.reshape(B, T, -1)
+                )
 
             template_verts, _, _ = self.flame(
                 shape_params= template_shape_coeffs,
@@ -371,20 +379,22 @@ class EmocaPreprocessor(Preprocessor):
     def test_time(self):
         return bool(self.cfg.get('test_time', True))
 
-    def forward(self, batch, input_key, *args, output_prefix="gt_", test_time=False, **kwargs):
-        if test_time: # if we are at test time
-            if not self.test_time: # and the preprocessor is not needed for test time 
-                # just return
-                return batch
-        # from inferno_apps.EMOCA.utils.io import test
-        images = batch[input_key]
+    # the per-frame codes that can be precomputed offline (see inferno.datasets.FeatureCache)
+    cached_codes = ['shapecode', 'expcode', 'posecode', 'cam', 'texcode', 'lightcode', 'detailcode']
 
-        B, T, C, H, W = images.shape
+    @staticmethod
+    def cached_code_key(output_prefix, code):
+        return output_prefix + "cached_" + code
+
+    def encode(self, images):
+        """
+        Runs the EMOCA encoder on images [B*T, C, H, W] (in chunks of max_b) and returns the dict of codes.
+        """
+        BT = images.shape[0]
         batch_ = {} 
-        BT = B*T
 
         if BT < self.max_b:
-            batch_['image'] = images.view(B*T, C, H, W)
+            batch_['image'] = images
             values = self.model.encode(batch_, training=False)
         else:
             batch_ = {} 
@@ -392,7 +402,7 @@ class EmocaPreprocessor(Preprocessor):
 
             outputs = []
             for i in range(0, BT, self.max_b):
-                batch_['image'] = images.view(B*T, C, H, W)[i:i+self.max_b]
+                batch_['image'] = images[i:i+self.max_b]
                 outputs.append(self.model.encode(batch_, training=False))
             
             # combine into a single output
@@ -408,6 +418,45 @@ class EmocaPreprocessor(Preprocessor):
                         values[k][k2] = torch.cat([o[k][k2] for o in outputs], dim=0)
                 else:
                     raise NotImplementedError("Not implemented for type {}".format(type(outputs[0][k])))
+        return values
+
+    def _get_cached_codes(self, batch, output_prefix):
+        if self.render or self.cached_code_key(output_prefix, 'shapecode') not in batch.keys():
+            # (the rendering needs the images, the cached codes are only used without it)
+            return None
+        values = {}
+        for code in self.cached_codes:
+            key = self.cached_code_key(output_prefix, code)
+            if key in batch.keys():
+                values[code] = batch[key].reshape(-1, batch[key].shape[-1]).clone()
+        return values
+
+    def _flame_vertices(self, values, BT):
+        # the only output of the decoder used without rendering are the FLAME vertices
+        verts = []
+        for i in range(0, BT, self.max_b):
+            _flame_res = self.model.deca.flame(shape_params=values['shapecode'][i:i+self.max_b], 
+                                               expression_params=values['expcode'][i:i+self.max_b], 
+                                               pose_params=values['posecode'][i:i+self.max_b])
+            verts += [_flame_res[0]]
+        return torch.cat(verts, dim=0)
+
+    def forward(self, batch, input_key, *args, output_prefix="gt_", test_time=False, **kwargs):
+        if test_time: # if we are at test time
+            if not self.test_time: # and the preprocessor is not needed for test time 
+                # just return
+                return batch
+        # from inferno_apps.EMOCA.utils.io import test
+        values = self._get_cached_codes(batch, output_prefix)
+        cached = values is not None
+        if cached:
+            # the codes have been precomputed, the encoder is skipped
+            B, T = batch[self.cached_code_key(output_prefix, 'shapecode')].shape[:2]
+        else:
+            images = batch[input_key]
+            B, T, C, H, W = images.shape
+            values = self.encode(images.view(B*T, C, H, W))
+        BT = B*T
 
         # # vals, visdict = decode(deca, batch, vals, training=False)
         # values = self.model.encode(batch_, training=False)
@@ -430,7 +479,9 @@ class EmocaPreprocessor(Preprocessor):
             values['shapecode'] = avg_shapecode.view(B, 1, -1)
             values['shapecode'] = values['shapecode'].expand(B, T, values['shapecode'].shape[2]).view(B*T, -1)
 
-        if BT < self.max_b:
+        if cached:
+            values['verts'] = self._flame_vertices(values, BT)
+        elif BT < self.max_b:
             values = self.model.decode(values, training=False, render=self.render)
         else:
             outputs = []
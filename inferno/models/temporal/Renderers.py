@@ -135,7 +135,11 @@ class FlameRenderer(Renderer):
         self.output_image_keyword = cfg.get("output_image_keyword", "video")
 
 
-    def forward(self, sample): 
+    def forward(self, sample, roi_offsets=None, roi_size=None):
+        """
+        If roi_offsets ([B, (T,) 2] integer pixel offsets (x, y)) are given, only the roi_size x roi_size window
+        of the image at these offsets is rasterized, the returned images and mask are of the window size.
+        """
         verts = sample["verts"]
         albedo = sample["albedo"]
         if self.project_landmarks:
@@ -197,7 +201,13 @@ class FlameRenderer(Renderer):
             if landmarks2d_mediapipe is not None:
                 predicted_landmarks_mediapipe[:, :, 1:] = -predicted_landmarks_mediapipe[:, :, 1:]
 
-        outputs = self.render(verts, trans_verts, albedo, lightcode)
+        if roi_offsets is None:
+            outputs = self.render(verts, trans_verts, albedo, lightcode)
+        else:
+            roi_verts = full_image_to_roi(trans_verts, roi_offsets.reshape(-1, 2), self.render.image_size, roi_size)
+            outputs = self.render(verts, roi_verts, albedo, lightcode, rasterizer=Pytorch3dRasterizer(roi_size))
+            # the renderer shifts the depth of the vertices in place, keep the returned ones the same as without the window
+            trans_verts = trans_verts + trans_verts.new_tensor([0., 0., 10.])
         effective_batch_size = verts.shape[0]
 
         # mask
@@ -277,6 +287,13 @@ class FixedViewFlameRenderer(FlameRenderer):
             self.mouth_window_margin = cfg.get("mouth_window_margin", 12)
             self.mouth_landmark_start_idx = 48
             self.mouth_landmark_stop_idx = 68
+        # rasterize only the window around the mouth crop instead of the full frames
+        # (the full frame video is then not produced, it cannot be combined with losses on the full frames)
+        self.mouth_roi_rendering = self.cut_out_mouth and cfg.get("mouth_roi_rendering", False)
+        if self.mouth_roi_rendering:
+            assert self.project_landmarks, "Mouth ROI rendering needs the projected landmarks to find the mouth window"
+            # the crop spans at most the crop size in pixels, the bicubic sampling reads 2 more pixels on each side
+            self.mouth_roi_size = min(max(self.mouth_crop_height, self.mouth_crop_width) + 4, cfg.image_size)
 
     def set_shape_model(self, shape_model):
         self.shape_model = shape_model
@@ -378,14 +395,20 @@ class FixedViewFlameRenderer(FlameRenderer):
         if self.project_landmarks:
             rendering_sample["predicted_landmarks2d_flame_space"] = landmarks_2d_posed
 
-        rendering_sample = super().forward(rendering_sample)
+        if self.mouth_roi_rendering:
+            # the mouth crop windows are found first and only they get rasterized
+            mouth_grids, roi_offsets = self._mouth_roi_windows(landmarks_2d_posed, rendering_sample["cam"], B, T, C)
+            rendering_sample = super().forward(rendering_sample, roi_offsets=roi_offsets, roi_size=self.mouth_roi_size)
+        else:
+            rendering_sample = super().forward(rendering_sample)
         
         out_vid_name = output_prefix + self.output_image_keyword
         out_landmark_name = output_prefix + "landmarks_2d"
         out_verts_name = output_prefix + "trans_verts"
         assert out_vid_name not in sample, f"Key '{out_vid_name}' already exists in sample. Please choose a different output_prefix to not overwrite and existing value"
         assert out_landmark_name not in sample, f"Key '{out_landmark_name}' already exists in sample. Please choose a different output_prefix to not overwrite and existing value"
-        sample[out_vid_name] = {}
+        if not self.mouth_roi_rendering:
+            sample[out_vid_name] = {}
         sample[out_landmark_name] = {}
         if self.cut_out_mouth: 
             # out_mouth_vid_name = output_prefix + "mouth_video"
@@ -397,14 +420,19 @@ class FixedViewFlameRenderer(FlameRenderer):
             predicted_vid =  rendering_sample["predicted_" + self.output_image_keyword][:, ci::C, ...]
             if self.apply_mask: 
                 predicted_vid = predicted_vid * rendering_sample["predicted_mask"][:, ci::C, ...]
-            sample[out_vid_name][cam_name] = predicted_vid
+            if not self.mouth_roi_rendering:
+                sample[out_vid_name][cam_name] = predicted_vid
             
             # sample[out_name][cam_name] = sample[out_name][cam_name].view(B, T, *sample[out_name][cam_name].shape[1:])
             sample[out_verts_name][cam_name] = rendering_sample["trans_verts"][:, ci::C, ...]
             if self.project_landmarks:
                 sample[out_landmark_name][cam_name] = rendering_sample["predicted_landmarks"][:, ci::C, ...]
 
-            if self.cut_out_mouth: 
+            if self.mouth_roi_rendering:
+                # the rendered video only covers the mouth windows
+                sample[out_mouth_vid_name][cam_name] = crop_with_grid(
+                    predicted_vid, mouth_grids[ci], convert_grayscale=self.mouth_grayscale)
+            elif self.cut_out_mouth: 
                 # sample[out_mouth_vid_name][cam_name] = []
                 # for bi in range(B):
                 #     sample[out_mouth_vid_name][cam_name] += [self.cut_mouth(sample[out_vid_name][cam_name][bi], sample[out_landmark_name][cam_name][bi])]
@@ -436,6 +464,33 @@ class FixedViewFlameRenderer(FlameRenderer):
         # plt.show()
         return sample
 
+    def _mouth_roi_windows(self, landmarks, cams, B, T, C):
+        """
+        Projects the posed landmarks [B, T * #num cams, 68, 3] the same way as FlameRenderer.forward and finds 
+        the mouth crop windows before rendering. Returns the per camera sampling grids [B, T, crop_h, crop_w, 2] 
+        relative to the windows and the window offsets [B, T * #num cams, 2] in the order of the rendering batch.
+        """
+        image_size = self.render.image_size
+        landmarks = util.batch_orth_proj(landmarks.view(B * T * C, *landmarks.shape[2:]), 
+                                         cams.reshape(B * T * C, -1))[:, :, :2]
+        landmarks[:, :, 1:] = -landmarks[:, :, 1:]
+        landmarks = landmarks.view(B, T, C, *landmarks.shape[1:])
+        mouth_grids = []
+        roi_offsets = []
+        for ci in range(C):
+            grid = mouth_crop_grid(landmarks[:, :, ci], image_size, image_size, 
+                                   mouth_window_margin=self.mouth_window_margin, 
+                                   mouth_landmark_start_idx=self.mouth_landmark_start_idx, 
+                                   mouth_landmark_stop_idx=self.mouth_landmark_stop_idx, 
+                                   mouth_crop_height=self.mouth_crop_height, 
+                                   mouth_crop_width=self.mouth_crop_width,
+                                   )
+            offsets, grid = mouth_roi_window(grid, image_size, self.mouth_roi_size)
+            mouth_grids += [grid]
+            roi_offsets += [offsets]
+        roi_offsets = torch.stack(roi_offsets, dim=2).view(B, T * C, 2)
+        return mouth_grids, roi_offsets
+
     def cut_mouth_vectorized(self, images, landmarks, convert_grayscale=True):
         return cut_mouth_vectorized(images, landmarks, convert_grayscale=convert_grayscale, 
                                     mouth_window_margin=self.mouth_window_margin, 
@@ -718,9 +773,32 @@ def cut_mouth_vectorized(images,
                          mouth_crop_width,
                          convert_grayscale=True
                          ):
-            
+    grid = mouth_crop_grid(landmarks, images.shape[-2], images.shape[-1], 
+                           mouth_window_margin=mouth_window_margin, 
+                           mouth_landmark_start_idx=mouth_landmark_start_idx, 
+                           mouth_landmark_stop_idx=mouth_landmark_stop_idx, 
+                           mouth_crop_height=mouth_crop_height, 
+                           mouth_crop_width=mouth_crop_width,
+                           )
+    return crop_with_grid(images, grid, convert_grayscale=convert_grayscale)
+
+
+def mouth_crop_grid(landmarks, 
+                    image_height, 
+                    image_width, 
+                    mouth_window_margin, 
+                    mouth_landmark_start_idx, 
+                    mouth_landmark_stop_idx,
+                    mouth_crop_height, 
+                    mouth_crop_width,
+                    ):
+    """
+    Returns the grid_sample grid [B, T, mouth_crop_height, mouth_crop_width, 2] (align_corners=True) of the mouth crops 
+    of an image sequence, centered at the temporally smoothed mouth landmarks [B, T, 68, 2] (in [-1, 1] image space).
+    """
+    device = landmarks.device
     with torch.no_grad():
-        image_size = images.shape[-1] / 2
+        image_size = image_width / 2
 
         landmarks = landmarks * image_size + image_size
         # #1) smooth the landmarks with temporal convolution
@@ -732,7 +810,7 @@ def cut_mouth_vectorized(images,
         # change chape to (N, 136, T)
         # landmarks_t = landmarks_t.unsqueeze(0)
         # smooth with temporal convolution
-        temporal_filter = torch.ones(mouth_window_margin, device=images.device) / mouth_window_margin
+        temporal_filter = torch.ones(mouth_window_margin, device=device) / mouth_window_margin
         # pad the the landmarks 
         landmarks_t_padded = F.pad(landmarks_t, (mouth_window_margin // 2, mouth_window_margin // 2), mode='replicate')
         # convolve each channel separately with the temporal filter
@@ -762,25 +840,32 @@ def cut_mouth_vectorized(images,
         height = mouth_crop_height//2
         width = mouth_crop_width//2
 
-        torch.arange(0, mouth_crop_width, device=images.device)
+        torch.arange(0, mouth_crop_width, device=device)
 
-        grid = torch.stack(torch.meshgrid(torch.linspace(-height, height, mouth_crop_height).to(images.device) / (images.shape[-2] /2),
-                                        torch.linspace(-width, width, mouth_crop_width).to(images.device) / (images.shape[-1] /2) ), 
+        grid = torch.stack(torch.meshgrid(torch.linspace(-height, height, mouth_crop_height).to(device) / (image_height /2),
+                                        torch.linspace(-width, width, mouth_crop_width).to(device) / (image_width /2) ), 
                                         dim=-1)
         grid = grid[..., [1, 0]]
-        grid = grid.unsqueeze(0).unsqueeze(0).repeat(*images.shape[:2], 1, 1, 1)
+        grid = grid.unsqueeze(0).unsqueeze(0).repeat(*landmarks.shape[:2], 1, 1, 1)
 
-        center_x_t -= images.shape[-1] / 2
-        center_y_t -= images.shape[-2] / 2
+        center_x_t -= image_width / 2
+        center_y_t -= image_height / 2
 
-        center_x_t /= images.shape[-1] / 2
-        center_y_t /= images.shape[-2] / 2
+        center_x_t /= image_width / 2
+        center_y_t /= image_height / 2
 
         center_xy =  torch.cat([center_x_t, center_y_t ], dim=-1).unsqueeze(-2).unsqueeze(-2)
         if center_xy.ndim != grid.ndim:
             center_xy = center_xy.unsqueeze(-2)
         assert grid.ndim == center_xy.ndim, f"grid and center_xy have different number of dimensions: {grid.ndim} and {center_xy.ndim}"
         grid = grid + center_xy
+    return grid
+
+
+def crop_with_grid(images, grid, convert_grayscale=True):
+    """
+    Samples the crops of the image sequence [B, T, C, H, W] given by the grid [B, T, h, w, 2] (see mouth_crop_grid)
+    """
     B, T = images.shape[:2]
     images = images.view(B*T, *images.shape[2:])
     grid = grid.view(B*T, *grid.shape[2:])
@@ -825,3 +910,65 @@ def cut_mouth_vectorized(images,
     # plt.imshow(image_crops[1, 20].permute(1,2,0).cpu().numpy())
     # plt.show()
     return image_crops
+
+
+def mouth_roi_window(grid, image_size, roi_size):
+    """
+    Finds the roi_size x roi_size windows (of an image_size x image_size image) that contain all the pixels
+    read by sampling the crop grids [B, T, h, w, 2] (see crop_with_grid), roi_size has to be at least 
+    the crop size (in pixels) + 4 or the image size. 
+    Returns the integer pixel offsets (x, y) of the windows [B, T, 2] and the grids relative to the windows. 
+    The windows lie inside the image, so cropping a window with its grid gives the same crop as cropping the full image.
+    """
+    with torch.no_grad():
+        # pixel coordinates of the samples (align_corners=True)
+        pixels = (grid + 1) / 2 * (image_size - 1)
+        # the bicubic kernel reads 1 pixel before the sample position (and 2 after it)
+        start = torch.floor(pixels.flatten(-3, -2).amin(dim=-2)) - 1
+        offsets = start.clamp(0, image_size - roi_size)
+        roi_grid = (pixels - offsets[..., None, None, :]) / (roi_size - 1) * 2 - 1
+    return offsets, roi_grid
+
+
+def full_image_to_roi(trans_verts, offsets, image_size, roi_size):
+    """
+    Maps the projected vertices [N, V, 3] from the image space of the full image to the one of the 
+    roi_size x roi_size windows at the pixel offsets [N, 2], the pixel centers of the windows stay the ones 
+    of the full image. The depth is scaled by the same factor, which keeps the normals and the depth order.
+    """
+    scale = image_size / roi_size
+    xy = (trans_verts[..., :2] + 1 - 2 * offsets[:, None, :] / image_size) * scale - 1
+    return torch.cat([xy, trans_verts[..., 2:] * scale], dim=-1)
+
+
+def check_and_benchmark_mouth_roi_rendering(renderer, sample, num_runs=10, **kwargs):
+    """
+    Compares the mouth videos of a FixedViewFlameRenderer (with cut_out_mouth) rendered with and without 
+    mouth_roi_rendering and measures the speed of both. The sample is the input of the renderer's forward.
+    """
+    import time
+    import copy
+    roi_size = min(max(renderer.mouth_crop_height, renderer.mouth_crop_width) + 4, renderer.render.image_size)
+    mouth_roi_rendering = renderer.mouth_roi_rendering
+    results = {}
+    try:
+        for roi in [False, True]:
+            renderer.mouth_roi_rendering = roi
+            renderer.mouth_roi_size = roi_size
+            renderer(copy.copy(sample), **kwargs) # warmup
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.time()
+            for i in range(num_runs):
+                out = renderer(copy.copy(sample), **kwargs)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            results[roi] = (out, (time.time() - start) / num_runs)
+    finally:
+        renderer.mouth_roi_rendering = mouth_roi_rendering
+    out_key = kwargs.get("output_prefix", "predicted_") + "mouth_" + renderer.output_image_keyword
+    for cam_name in results[False][0][out_key].keys():
+        diff = (results[False][0][out_key][cam_name] - results[True][0][out_key][cam_name]).abs()
+        print(f"{cam_name}: max abs diff {diff.max().item():.2e}, mean abs diff {diff.mean().item():.2e}")
+    print(f"crop after render: {results[False][1] * 1000:.1f} ms, mouth ROI rendering: {results[True][1] * 1000:.1f} ms")
+    return results
@@ -29,6 +29,10 @@ class VectorQuantizer(MotionQuantizer):
 
         self.embedding = nn.Embedding(self.codebook_size, self.vector_dim)
         self.embedding.weight.data.uniform_(-1.0 / self.codebook_size, 1.0 / self.codebook_size)
+        # the dense one-hot encodings [B*T, codebook_size] are only put into the batch if requested
+        self.return_min_encodings = cfg.get('return_min_encodings', False)
+        # number of vectors whose distances to the codebook are computed at once (bounds the memory)
+        self.distance_chunk_size = cfg.get('distance_chunk_size', 4096)
 
     def forward(self, batch, input_key="encoded_features", output_key="quantized_features", step=None):
         """
@@ -45,34 +49,12 @@ class VectorQuantizer(MotionQuantizer):
         z = batch[input_key]
         z = z.permute(0, 2, 1).contiguous()
         z_flattened = z.view(-1, self.vector_dim)
-        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
-
-        d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
-            torch.sum(self.embedding.weight**2, dim=1) - 2 * \
-            torch.matmul(z_flattened, self.embedding.weight.t())
-
-        ## could possible replace this here
-        # #\start...
-        # find closest encodings
-        min_encoding_indices = torch.argmin(d, dim=1).unsqueeze(1)
-
-        min_encodings = torch.zeros(
-            min_encoding_indices.shape[0], self.codebook_size).to(z)
-        min_encodings.scatter_(1, min_encoding_indices, 1)
 
-        # dtype min encodings: torch.float32
-        # min_encodings shape: torch.Size([2048, 512])
-        # min_encoding_indices.shape: torch.Size([2048, 1])
+        # find closest encodings (the distances are computed in chunks, the full [B*T, codebook_size] matrix is never stored)
+        min_encoding_indices = self.closest_indices(z_flattened)
 
-        # get quantized latent vectors
-        z_q = torch.matmul(min_encodings, self.embedding.weight).view(z.shape)
-        #.........\end
-
-        # with:
-        # .........\start
-        #min_encoding_indices = torch.argmin(d, dim=1)
-        #z_q = self.embedding(min_encoding_indices)
-        # ......\end......... (TODO)
+        # get quantized latent vectors (an index gather, same values and gradients as the one-hot matmul)
+        z_q = self.embedding(min_encoding_indices).view(z.shape)
 
         # compute loss for embedding
         codebook_alignment = torch.mean((z_q.detach()-z)**2)
@@ -87,7 +69,7 @@ class VectorQuantizer(MotionQuantizer):
         z_q = z + (z_q - z).detach()
 
         # perplexity
-        e_mean = torch.mean(min_encodings, dim=0)
+        e_mean = torch.bincount(min_encoding_indices, minlength=self.codebook_size).to(z.dtype) / min_encoding_indices.shape[0]
         perplexity = torch.exp(-torch.sum(e_mean * torch.log(e_mean + 1e-10)))
 
         # reshape back to match original input shape
@@ -95,13 +77,34 @@ class VectorQuantizer(MotionQuantizer):
 
         batch[output_key] = z_q
         batch["perplexity"] = perplexity
-        batch["min_encodings"] = min_encodings
-        batch["min_encoding_indices"] = min_encoding_indices
+        if self.return_min_encodings:
+            batch["min_encodings"] = self.indices_to_one_hot(min_encoding_indices).to(z)
+        batch["min_encoding_indices"] = min_encoding_indices.unsqueeze(1)
         batch["codebook_alignment"] = codebook_alignment
         batch["codebook_commitment"] = codebook_commitment
         return batch
         # return z_q, loss, (perplexity, min_encodings, min_encoding_indices)
 
+    def closest_indices(self, z_flattened):
+        """
+        Returns the indices [N] of the closest codebook vectors of z_flattened [N, vector_dim]
+        """
+        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
+        e_sq = torch.sum(self.embedding.weight**2, dim=1)
+        chunk_size = self.distance_chunk_size or z_flattened.shape[0]
+        indices = []
+        for i in range(0, z_flattened.shape[0], chunk_size):
+            z_chunk = z_flattened[i:i + chunk_size]
+            d = torch.sum(z_chunk ** 2, dim=1, keepdim=True) + e_sq - 2 * \
+                torch.matmul(z_chunk, self.embedding.weight.t())
+            indices += [torch.argmin(d, dim=1)]
+        return torch.cat(indices, dim=0) if len(indices) != 1 else indices[0]
+
+    def indices_to_one_hot(self, indices):
+        min_encodings = torch.zeros(indices.shape[0], self.codebook_size, device=indices.device)
+        min_encodings.scatter_(1, indices.view(-1, 1), 1)
+        return min_encodings
+
     def get_distance(self, z):
         z = z.permute(0, 2, 1).contiguous()
         z_flattened = z.view(-1, self.vector_dim)
@@ -115,13 +118,8 @@ class VectorQuantizer(MotionQuantizer):
 
     def get_codebook_entry(self, indices, shape):
         # shape specifying (batch, height, width, channel)
-        # TODO: check for more easy handling with nn.Embedding
-        min_encodings = torch.zeros(indices.shape[0], self.codebook_size).to(indices)
-        min_encodings.scatter_(1, indices[:,None], 1)
-
         # get quantized latent vectors
-        #print(min_encodings.shape, self.embedding.weight.shape)
-        z_q = torch.matmul(min_encodings.float(), self.embedding.weight)
+        z_q = self.embedding(indices.view(-1))
 
         if shape is not None:
             z_q = z_q.view(shape)
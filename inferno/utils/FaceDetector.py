@@ -43,6 +43,22 @@ class FaceDetector(ABC):
     def __call__(self, *args, **kwargs):
         self.run(*args, **kwargs)
 
+    def run_batch(self, images, with_landmarks=False, detected_faces=None):
+        """
+        Runs the detector on a batch of images. 
+        Input: 
+            images: a batch of images, shape (N, H, W, 3), uint8, range [0, 255], rgb
+            detected_faces: optional list (one entry per image) of already detected faces
+        Returns:
+            a list with one entry per image, each in the same format as the output of run()
+        The default implementation processes the images one by one (in order, which keeps the tracking 
+        of video-based detectors intact). Detectors capable of real batched inference should override it.
+        """
+        if detected_faces is None:
+            detected_faces = [None] * len(images)
+        return [self.run(images[i], with_landmarks=with_landmarks, detected_faces=detected_faces[i]) 
+            for i in range(len(images))]
+
 
     def landmarks_from_batch_no_face_detection(self, images): 
         """
@@ -125,6 +141,20 @@ class FAN(FaceDetector):
             else:
                 return boxes, 'kpt68'
 
+    @torch.no_grad()
+    def run_batch(self, images, with_landmarks=False, detected_faces=None):
+        '''
+        images: 0-255, uint8, rgb, [N, h, w, 3]
+        The face detection (the expensive part) runs on the whole batch at once, 
+        the landmarks are then regressed for the detected faces of each image.
+        '''
+        if detected_faces is None:
+            image_batch = torch.from_numpy(np.ascontiguousarray(images)).to(self.model.device)
+            image_batch = image_batch.permute(0, 3, 1, 2).float()
+            detected_faces = self.model.face_detector.detect_from_batch(image_batch)
+            del image_batch
+        return super().run_batch(images, with_landmarks=with_landmarks, detected_faces=detected_faces)
+
     @torch.no_grad()
     def landmarks_from_batch_no_face_detection(self, images):
         out = self.model.face_alignment_net(images).detach()
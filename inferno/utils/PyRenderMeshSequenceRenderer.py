@@ -25,6 +25,18 @@ import pyrender
 import cv2
 
 
+# the in-place vertex buffer update of render_sequence relies on private attributes of pyrender, 
+# it is only used with the pyrender versions it was written against (otherwise the mesh is rebuilt every frame)
+_PYRENDER_BUFFER_UPDATE_VERSIONS = ((0, 1),)
+
+
+def _pyrender_version():
+    try:
+        return tuple(int(v) for v in pyrender.__version__.split(".")[:2])
+    except (AttributeError, ValueError):
+        return None
+
+
 class PyRenderMeshSequenceRenderer(object): 
 
     def __init__(self, 
@@ -120,6 +132,189 @@ class PyRenderMeshSequenceRenderer(object):
         self.rot = rot 
         self.t_center = t_center
 
+        self.base_colors = {True: np.array([0.75, 0.75, 0.75]), False: np.array([0.75, 0.0, 0.0])} # only used by the rasterizer backend
+        self._offscreen_renderer = None
+        self._rasterizer = None
+
+    def _get_offscreen_renderer(self):
+        # creating the GL context is expensive, create it once and keep it
+        if self._offscreen_renderer is None:
+            self._offscreen_renderer = pyrender.OffscreenRenderer(viewport_width=self.frustum['width'], viewport_height=self.frustum['height'])
+        return self._offscreen_renderer
+
+    def delete(self):
+        if self._offscreen_renderer is not None:
+            self._offscreen_renderer.delete()
+            self._offscreen_renderer = None
+
+    def _transform_vertices(self, verts, rot=None, t_center=None):
+        """
+        verts: (N, V, 3), rotated around the center (which is the center of the first rendered frame unless specified)
+        """
+        if self.rot is None: 
+            self.rot = np.zeros(3)
+        rot = rot if rot is not None else self.rot
+        if self.t_center is None:
+            self.t_center = np.mean(verts[0], axis=0)
+        t_center = t_center if t_center is not None else self.t_center
+        R = cv2.Rodrigues(np.asarray(rot, dtype=np.float64))[0]
+        return (verts - t_center) @ R.T.astype(verts.dtype) + t_center
+
+    def _vertex_normals(self, verts):
+        """
+        verts: (N, V, 3), returns angle weighted vertex normals (N, V, 3), computed the same way as the 
+        trimesh normals of render() (pyrender.Mesh.from_trimesh with smooth=True)
+        """
+        faces = self.template.faces
+        corners = verts.astype(np.float64)[:, faces] # (N, F, 3, 3)
+        face_normals = np.cross(corners[:, :, 1] - corners[:, :, 0], corners[:, :, 2] - corners[:, :, 0])
+        face_normals /= np.maximum(np.linalg.norm(face_normals, axis=-1, keepdims=True), 1e-12)
+        # the angle of each face corner weights the face's contribution to the corner's vertex
+        edges_1 = corners[:, :, [1, 2, 0]] - corners
+        edges_2 = corners[:, :, [2, 0, 1]] - corners
+        edges_1 /= np.maximum(np.linalg.norm(edges_1, axis=-1, keepdims=True), 1e-12)
+        edges_2 /= np.maximum(np.linalg.norm(edges_2, axis=-1, keepdims=True), 1e-12)
+        angles = np.arccos(np.clip(np.sum(edges_1 * edges_2, axis=-1), -1., 1.)) # (N, F, 3)
+        normals = np.zeros(verts.shape, dtype=np.float64)
+        for i in range(3):
+            np.add.at(normals, (slice(None), faces[:, i]), face_normals * angles[:, :, i:i + 1])
+        normals /= np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-12)
+        return normals
+
+    def _can_update_vertex_buffer(self, primitive):
+        if _pyrender_version() not in _PYRENDER_BUFFER_UPDATE_VERSIONS:
+            return False
+        return hasattr(primitive, "_vaid") and hasattr(primitive, "_buffers") \
+            and hasattr(self._get_offscreen_renderer(), "_platform")
+
+    def _update_vertex_buffer(self, primitive, positions, normals):
+        """
+        Replaces the positions and normals of a primitive that has already been uploaded to the GL context 
+        (the index buffer and the rest of the GL state stay). 
+        Returns False if this pyrender does not allow it, the caller then has to rebuild the mesh.
+        """
+        if not self._can_update_vertex_buffer(primitive):
+            return False
+        from OpenGL.GL import glBindBuffer, glBufferSubData, GL_ARRAY_BUFFER
+        primitive.positions = positions
+        primitive.normals = normals
+        if primitive._vaid is None:
+            # not uploaded yet (the previous render failed), the next render uploads the new data
+            return True
+        # interleaved positions and normals, the vertex buffer layout of pyrender.Primitive._add_to_context
+        data = np.ascontiguousarray(np.hstack((primitive.positions, primitive.normals)).astype(np.float32).ravel())
+        platform = self._get_offscreen_renderer()._platform
+        platform.make_current()
+        glBindBuffer(GL_ARRAY_BUFFER, primitive._buffers[0])
+        glBufferSubData(GL_ARRAY_BUFFER, 0, data.nbytes, data)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        platform.make_uncurrent()
+        return True
+
+    def render_sequence(self, verts, rot=None, t_center=None, valid=True, backend="pyrender", batch_size=32):
+        """
+        verts: (T, V, 3) or (T, V*3), numpy array or torch tensor
+
+        Returns a generator of the rendered frames (ndarray type uint8, (H, W, 3)), meant to be streamed into 
+        a video writer (see inferno_apps.TalkingHead.utils.video.save_video_frames). The vertices are moved to the CPU 
+        and prepared 'batch_size' frames at a time.
+        backend: 
+            'pyrender' - the same output as render() but one offscreen renderer and one mesh node are used for 
+                the whole sequence, the mesh is uploaded once and only its vertex buffer (positions and normals) 
+                is updated from frame to frame (with other pyrender versions than 0.1.x the mesh is rebuilt every frame)
+            'rasterizer' - Pytorch3dRasterizer on the device of 'verts', 'batch_size' frames at a time, 
+                approximate (diffuse only) shading, does not need an OpenGL context
+        """
+        T = verts.shape[0]
+        verts = verts.reshape(T, -1, 3)
+        if backend == "rasterizer":
+            import torch
+            if not isinstance(verts, torch.Tensor):
+                verts = torch.from_numpy(np.asarray(verts))
+            for start in range(0, T, batch_size):
+                yield from self._rasterize_batch(verts[start:start + batch_size], rot, t_center, valid)
+            return
+        if backend != "pyrender":
+            raise ValueError(f"Unknown render backend '{backend}'")
+
+        material = self.primitive_material_gray if valid else self.primitive_material_red
+        primitive = None
+        mesh_node = None
+        try:
+            for start in range(0, T, batch_size):
+                verts_batch = verts[start:start + batch_size]
+                if not isinstance(verts_batch, np.ndarray):
+                    verts_batch = verts_batch.detach().cpu().numpy()
+                verts_batch = self._transform_vertices(verts_batch, rot, t_center)
+                normals_batch = self._vertex_normals(verts_batch)
+                for frame_verts, frame_normals in zip(verts_batch, normals_batch):
+                    if primitive is None or not self._update_vertex_buffer(primitive, frame_verts, frame_normals):
+                        # the first frame, or a pyrender without the in-place update (a new mesh every frame)
+                        if mesh_node is not None:
+                            self.scene.remove_node(mesh_node)
+                        primitive = pyrender.Primitive(positions=frame_verts, normals=frame_normals, 
+                            indices=self.template.faces, material=material, mode=pyrender.constants.GLTF.TRIANGLES)
+                        mesh_node = self.scene.add(pyrender.Mesh(primitives=[primitive]), pose=np.eye(4))
+                    yield self._render_scene()
+        finally:
+            if mesh_node is not None:
+                self.scene.remove_node(mesh_node)
+
+    def _render_mesh(self, render_mesh):
+        mesh_node = self.scene.add(render_mesh, pose=np.eye(4))
+        color = self._render_scene()
+        self.scene.remove_node(mesh_node)
+        return color
+
+    def _render_scene(self):
+        try:
+            color, _ = self._get_offscreen_renderer().render(self.scene, flags=self.flags)
+        except:
+            print('pyrender: Failed rendering frame')
+            color = np.zeros((int(self.frustum['height']), int(self.frustum['width']), 3), dtype='uint8')
+        return color.astype(np.uint8)
+
+    def _rasterize_batch(self, verts, rot, t_center, valid):
+        import torch
+        from inferno.models.Renderer import Pytorch3dRasterizer
+        from inferno.utils.DecaUtils import face_vertices
+        assert self.width == self.height, "The rasterizer backend can only render square images"
+        if self._rasterizer is None:
+            self._rasterizer = Pytorch3dRasterizer(image_size=int(self.width))
+        device = verts.device
+        N = verts.shape[0]
+        if self.t_center is None:
+            self.t_center = verts[0].detach().cpu().numpy().mean(axis=0)
+        t_center = torch.as_tensor(t_center if t_center is not None else self.t_center, dtype=verts.dtype, device=device)
+        rot = rot if rot is not None else (self.rot if self.rot is not None else np.zeros(3))
+        R = torch.as_tensor(cv2.Rodrigues(np.asarray(rot, dtype=np.float64))[0], dtype=verts.dtype, device=device)
+        verts = (verts - t_center) @ R.T + t_center
+
+        faces = torch.as_tensor(self.template.faces, dtype=torch.long, device=device)[None].expand(N, -1, -1)
+        face_verts = face_vertices(verts, faces)
+        face_normals = torch.cross(face_verts[:, :, 1] - face_verts[:, :, 0], face_verts[:, :, 2] - face_verts[:, :, 0], dim=-1)
+        normals = torch.zeros_like(verts)
+        for i in range(3):
+            normals.index_add_(1, faces[0, :, i], face_normals)
+        normals = torch.nn.functional.normalize(normals, dim=-1)
+
+        # project with the intrinsics of the pyrender camera (placed at z=1, looking down the -z axis) 
+        # to the normalized image space of the rasterizer (x right, y down, z depth)
+        depth = 1. - verts[..., 2:3]
+        x = verts[..., 0:1] * float(self.camera_params['f'][0]) / depth / (self.width / 2)
+        y = -verts[..., 1:2] * float(self.camera_params['f'][1]) / depth / (self.height / 2)
+        rendered = self._rasterizer(torch.cat([x, y, depth], dim=-1), faces, face_vertices(normals, faces))
+
+        normal_images = torch.nn.functional.normalize(rendered[:, :3], dim=1)
+        mask = rendered[:, 3:]
+        # ambient + diffuse from the frontal directional lights
+        shading = 0.2 + 0.8 * normal_images[:, 2:3].clamp(min=0)
+        base_color = torch.as_tensor(self.base_colors[valid], dtype=shading.dtype, device=device).view(1, 3, 1, 1)
+        bg_color = torch.as_tensor(np.clip(np.array(self.bg_color) / 255., 0, 1), dtype=shading.dtype, device=device).view(1, 3, 1, 1)
+        images = mask * base_color * shading + (1 - mask) * bg_color
+        images = (images.clamp(0, 1) * 255).byte().permute(0, 2, 3, 1).cpu().numpy()
+        for image in images:
+            yield image
 
     def render(self, verts, rot=None, t_center=None, valid=True):
         """
@@ -147,15 +342,4 @@ class PyRenderMeshSequenceRenderer(object):
         self.render_mesh = pyrender.Mesh.from_trimesh(mesh, 
             material=self.primitive_material_gray if valid else self.primitive_material_red,
             smooth=True)
-        self.mesh_node = self.scene.add(self.render_mesh, pose=np.eye(4))
-
-        try:
-            r = pyrender.OffscreenRenderer(viewport_width=self.frustum['width'], viewport_height=self.frustum['height'])
-            color, _ = r.render(self.scene, flags=self.flags)
-        except:
-            print('pyrender: Failed rendering frame')
-            color = np.zeros((int(self.frustum['height']), int(self.frustum['width']), 3), dtype='uint8')
-        
-        self.scene.remove_node(self.mesh_node)
-
-        return color.astype(np.uint8) 
\ No newline at end of file
+        return self._render_mesh(self.render_mesh) 
\ No newline at end of file
@@ -0,0 +1,281 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import os
+import time
+from pathlib import Path
+import numpy as np
+
+
+def _squared_distances(queries, points, points_sq_norms=None):
+    # |q - p|^2 = |q|^2 - 2 q.p + |p|^2 (clipped, the expansion can go slightly negative)
+    if points_sq_norms is None:
+        points_sq_norms = np.einsum("ij,ij->i", points, points)
+    d = np.einsum("ij,ij->i", queries, queries)[:, None] - 2. * queries @ points.T + points_sq_norms[None, :]
+    return np.maximum(d, 0.)
+
+
+def _merge_topk(best_d, best_i, d, i, k):
+    # merges candidate distances/indices [B, n] into the current top k [B, k] (kept sorted)
+    d = np.concatenate([best_d, d], axis=1)
+    i = np.concatenate([best_i, i], axis=1)
+    if d.shape[1] > k:
+        part = np.argpartition(d, k - 1, axis=1)[:, :k]
+        d = np.take_along_axis(d, part, axis=1)
+        i = np.take_along_axis(i, part, axis=1)
+    order = np.argsort(d, axis=1, kind="stable")
+    return np.take_along_axis(d, order, axis=1), np.take_along_axis(i, order, axis=1)
+
+
+class ExactIndex(object):
+    """
+    Brute force (blocked) nearest neighbour search. The reference for the approximate indices.
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+
+    @property
+    def ntotal(self):
+        return self.vectors.shape[0]
+
+    def add(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        self.vectors = np.concatenate([self.vectors, vectors], axis=0)
+
+    def search(self, queries, k, batch_size=1024, block_size=65536):
+        """
+        Returns the euclidean distances and the indices [num_queries, k] of the k nearest neighbours (sorted)
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        k = min(k, self.ntotal)
+        sq_norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+        distances = np.zeros((queries.shape[0], k), dtype=np.float32)
+        indices = np.zeros((queries.shape[0], k), dtype=np.int64)
+        for qs in range(0, queries.shape[0], batch_size):
+            q = queries[qs:qs + batch_size]
+            best_d = np.zeros((q.shape[0], 0), dtype=np.float32)
+            best_i = np.zeros((q.shape[0], 0), dtype=np.int64)
+            for ps in range(0, self.ntotal, block_size):
+                d = _squared_distances(q, self.vectors[ps:ps + block_size], sq_norms[ps:ps + block_size])
+                i = np.broadcast_to(np.arange(ps, ps + d.shape[1]), d.shape)
+                best_d, best_i = _merge_topk(best_d, best_i, d, i, k)
+            distances[qs:qs + batch_size] = np.sqrt(best_d)
+            indices[qs:qs + batch_size] = best_i
+        return distances, indices
+
+
+class IVFIndex(object):
+    """
+    Inverted file index (IVF-Flat): the vectors are partitioned into num_lists clusters by k-means
+    and a query is only compared to the vectors of its num_probes closest clusters.
+    Vectors can be added incrementally after training (they are assigned to the existing clusters),
+    the index is saved to / loaded from a single .npz file.
+    """
+
+    def __init__(self, dim, num_lists=None, num_probes=16, seed=0):
+        self.dim = dim
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.seed = seed
+        self.centroids = None
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.assignments = np.zeros((0,), dtype=np.int64)
+        self._lists = None
+
+    @property
+    def ntotal(self):
+        return self.vectors.shape[0]
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, vectors, num_iterations=20, max_points_per_list=256, batch_size=65536):
+        """
+        Runs k-means on (a random subset of) the vectors to find the cluster centroids
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        rng = np.random.RandomState(self.seed)
+        if self.num_lists is None:
+            self.num_lists = int(max(1, min(4 * np.sqrt(vectors.shape[0]), vectors.shape[0] // 39)))
+        num_lists = min(self.num_lists, vectors.shape[0])
+        num_samples = min(vectors.shape[0], num_lists * max_points_per_list)
+        samples = vectors[np.sort(rng.choice(vectors.shape[0], num_samples, replace=False))]
+
+        centroids = samples[rng.choice(num_samples, num_lists, replace=False)].copy()
+        for it in range(num_iterations):
+            assignments = self._assign(samples, centroids, batch_size)
+            sums = np.zeros_like(centroids, dtype=np.float64)
+            np.add.at(sums, assignments, samples)
+            counts = np.bincount(assignments, minlength=num_lists)
+            empty = counts == 0
+            centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+            if empty.any():
+                # re-seed empty clusters with random points
+                centroids[empty] = samples[rng.choice(num_samples, int(empty.sum()), replace=False)]
+        self.centroids = centroids
+        self.num_lists = num_lists
+        if self.ntotal > 0:
+            self.assignments = self._assign(self.vectors, self.centroids, batch_size)
+        self._lists = None
+
+    @staticmethod
+    def _assign(vectors, centroids, batch_size=65536):
+        sq_norms = np.einsum("ij,ij->i", centroids, centroids)
+        assignments = np.zeros(vectors.shape[0], dtype=np.int64)
+        for s in range(0, vectors.shape[0], batch_size):
+            assignments[s:s + batch_size] = _squared_distances(vectors[s:s + batch_size], centroids, sq_norms).argmin(axis=1)
+        return assignments
+
+    def add(self, vectors):
+        """
+        Adds vectors to the index, their ids continue from the current ntotal. Trains the index first if needed.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if not self.is_trained:
+            self.train(vectors)
+        self.assignments = np.concatenate([self.assignments, self._assign(vectors, self.centroids)])
+        self.vectors = np.concatenate([self.vectors, vectors], axis=0)
+        self._lists = None
+
+    def _get_lists(self):
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            bounds = np.searchsorted(self.assignments[order], np.arange(self.num_lists + 1))
+            self._lists = [order[bounds[l]:bounds[l + 1]] for l in range(self.num_lists)]
+        return self._lists
+
+    def search(self, queries, k, num_probes=None, batch_size=4096):
+        """
+        Returns the (approximate) euclidean distances and indices [num_queries, k] of the k nearest neighbours (sorted).
+        If fewer than k vectors are found in the probed lists, the remaining entries are -1 (with infinite distance).
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        num_probes = min(num_probes or self.num_probes, self.num_lists)
+        lists = self._get_lists()
+        sq_norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+        centroid_sq_norms = np.einsum("ij,ij->i", self.centroids, self.centroids)
+
+        distances = np.zeros((queries.shape[0], k), dtype=np.float32)
+        indices = np.zeros((queries.shape[0], k), dtype=np.int64)
+        for qs in range(0, queries.shape[0], batch_size):
+            q = queries[qs:qs + batch_size]
+            B = q.shape[0]
+            probes = np.argpartition(_squared_distances(q, self.centroids, centroid_sq_norms), num_probes - 1, axis=1)[:, :num_probes]
+            best_d = np.full((B, k), np.inf, dtype=np.float32)
+            best_i = np.full((B, k), -1, dtype=np.int64)
+            # process list by list: all the queries that probe a list are compared to its vectors in one go
+            query_ids = np.repeat(np.arange(B), num_probes)
+            probe_lists = probes.reshape(-1)
+            order = np.argsort(probe_lists, kind="stable")
+            bounds = np.searchsorted(probe_lists[order], np.arange(self.num_lists + 1))
+            for l in range(self.num_lists):
+                members = lists[l]
+                if bounds[l] == bounds[l + 1] or len(members) == 0:
+                    continue
+                qi = query_ids[order[bounds[l]:bounds[l + 1]]]
+                d = _squared_distances(q[qi], self.vectors[members], sq_norms[members]).astype(np.float32)
+                i = np.broadcast_to(members, d.shape)
+                best_d[qi], best_i[qi] = _merge_topk(best_d[qi], best_i[qi], d, i, k)
+            distances[qs:qs + B] = np.sqrt(best_d)
+            indices[qs:qs + B] = best_i
+        return distances, indices
+
+    def matches(self, vectors, num_samples=1024):
+        """
+        Checks (on a strided sample of the rows) that the vectors in the index are the first ntotal of the given ones, 
+        i.e. that the index was built from the same features and can be reused (and topped up with the rest).
+        """
+        vectors = np.asarray(vectors).reshape(vectors.shape[0], -1)
+        if vectors.shape[1] != self.dim or vectors.shape[0] < self.ntotal:
+            return False
+        rows = np.unique(np.linspace(0, self.ntotal - 1, min(num_samples, self.ntotal)).astype(np.int64))
+        return np.array_equal(self.vectors[rows], np.asarray(vectors[rows], dtype=np.float32))
+
+    def save(self, filename):
+        filename = Path(filename)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        tmp = filename.parent / (filename.stem + ".tmp.npz")
+        np.savez(tmp, dim=self.dim, num_lists=self.num_lists, num_probes=self.num_probes, seed=self.seed,
+                 centroids=self.centroids, vectors=self.vectors, assignments=self.assignments)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            index = cls(int(data["dim"]), int(data["num_lists"]), int(data["num_probes"]), int(data["seed"]))
+            index.centroids = data["centroids"]
+            index.vectors = data["vectors"]
+            index.assignments = data["assignments"]
+        return index
+
+
+def create_ann_index(index_type, dim, **kwargs):
+    if index_type == "exact":
+        return ExactIndex(dim)
+    elif index_type == "ivf":
+        return IVFIndex(dim, **kwargs)
+    raise ValueError(f"Invalid ANN index type '{index_type}'")
+
+
+def recall_at_k(approx_indices, exact_indices):
+    """
+    Fraction of the exact k nearest neighbours that the approximate search found
+    """
+    hits = [len(np.intersect1d(a, e)) for a, e in zip(approx_indices, exact_indices)]
+    return float(np.sum(hits)) / exact_indices.size
+
+
+def benchmark_ann_index(vectors=None, num_points=50000, dim=256, num_queries=1000, k=100, num_probes=(1, 4, 16, 64), seed=0):
+    """
+    Measures the recall of IVFIndex against the exact search (and the speed of both) for several numbers of probes.
+    Uses random clustered data unless vectors (e.g. the cached EmoNet features) are given.
+    """
+    rng = np.random.RandomState(seed)
+    if vectors is None:
+        centers = rng.randn(100, dim).astype(np.float32) * 3.
+        vectors = centers[rng.randint(0, 100, num_points)] + rng.randn(num_points, dim).astype(np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = vectors[rng.choice(vectors.shape[0], min(num_queries, vectors.shape[0]), replace=False)]
+
+    exact = ExactIndex(vectors.shape[1])
+    exact.add(vectors)
+    start = time.time()
+    _, exact_indices = exact.search(queries, k)
+    exact_time = time.time() - start
+    print(f"   exact: {queries.shape[0] / exact_time:9.1f} queries/s")
+
+    ivf = IVFIndex(vectors.shape[1])
+    start = time.time()
+    ivf.add(vectors)
+    print(f"     ivf: built in {time.time() - start:.2f}s ({ivf.num_lists} lists)")
+    results = {}
+    for p in num_probes:
+        start = time.time()
+        _, indices = ivf.search(queries, k, num_probes=p)
+        t = time.time() - start
+        results[p] = {"recall": recall_at_k(indices, exact_indices), "queries_per_second": queries.shape[0] / t}
+        print(f"ivf p={p:3d}: {results[p]['queries_per_second']:9.1f} queries/s, recall@{k} {results[p]['recall']:.4f}")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_ann_index()
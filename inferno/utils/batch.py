@@ -1,12 +1,12 @@
 import torch 
 from typing import Dict
 
-def dict_to_device(d, device): 
+def dict_to_device(d, device, non_blocking=False): 
     for k, v in d.items():
         if isinstance(v, torch.Tensor):
-            d[k] = v.to(device)
+            d[k] = v.to(device, non_blocking=non_blocking)
         elif isinstance(v, dict):
-            d[k] = dict_to_device(v, device)
+            d[k] = dict_to_device(v, device, non_blocking=non_blocking)
         else: 
             pass
     return d
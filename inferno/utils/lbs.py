@@ -181,9 +181,6 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
             The joints of the model
     '''
 
-    batch_size = max(betas.shape[0], pose.shape[0])
-    device = betas.device
-
     # Add shape contribution
     v_shaped = v_template + blend_shapes(betas, shapedirs)
 
@@ -191,6 +188,30 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
     # NxJx3 array
     J = vertices2joints(J_regressor, v_shaped)
 
+    return lbs_shaped(v_shaped, J, pose, posedirs, parents, lbs_weights, pose2rot=pose2rot, dtype=dtype, 
+                      detach_pose_correctives=detach_pose_correctives)
+
+
+def lbs_shaped(v_shaped, J, pose, posedirs, parents, lbs_weights, pose2rot=True, dtype=torch.float32, 
+               detach_pose_correctives=False):
+    ''' The pose dependent part of lbs: adds the pose blend shapes to already shaped vertices and skins them
+
+        Parameters
+        ----------
+        v_shaped : torch.tensor BxVx3
+            The template with the shape (and expression) blend shapes applied
+        J : torch.tensor BxJx3
+            The joints regressed from v_shaped
+        (the other parameters are the same as in lbs)
+
+        Returns
+        -------
+        verts: torch.tensor BxVx3
+        joints: torch.tensor BxJx3
+    '''
+    batch_size = max(v_shaped.shape[0], pose.shape[0])
+    device = v_shaped.device
+
     # 3. Add pose blend shapes
     # N x J x 3 x 3
     ident = torch.eye(3, dtype=dtype, device=device)
@@ -220,7 +241,7 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
     # W is N x V x (J + 1)
     W = lbs_weights.unsqueeze(dim=0).expand([batch_size, -1, -1])
     # (N x V x (J + 1)) x (N x (J + 1) x 16)
-    num_joints = J_regressor.shape[0]
+    num_joints = J.shape[1]
     T = torch.matmul(W, A.view(batch_size, num_joints, 16)) \
         .view(batch_size, -1, 4, 4)
 
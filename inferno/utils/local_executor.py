@@ -0,0 +1,173 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import os
+import time
+import inspect
+import datetime
+import traceback
+import multiprocessing as mp
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# the datamodule of the current worker process (set once by the pool initializer)
+_worker_datamodule = None
+
+
+def stage_marker_path(marker_dir, stage, idx):
+    return Path(marker_dir) / stage / f"{int(idx):08d}.done"
+
+
+def is_stage_done(marker_dir, stage, idx):
+    return stage_marker_path(marker_dir, stage, idx).is_file()
+
+
+def _mark_stage_done(marker_dir, stage, idx, info):
+    marker = stage_marker_path(marker_dir, stage, idx)
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    tmp = marker.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp, "w") as f:
+        f.write(info)
+    os.replace(tmp, marker)
+
+
+def _init_worker(datamodule, slots, threads_per_worker):
+    global _worker_datamodule
+    slot = slots.get()
+    # the worker only sees its own GPU (as cuda:0), CPU workers see none
+    os.environ["CUDA_VISIBLE_DEVICES"] = "" if slot is None else str(slot)
+    if threads_per_worker is not None:
+        import torch
+        torch.set_num_threads(threads_per_worker)
+    _worker_datamodule = datamodule
+
+
+def _process_video_stages(idx, stages, marker_dir):
+    dm = _worker_datamodule
+    # all the boolean switches of _process_video, only the current stage is turned on
+    flags = [name for name, p in inspect.signature(dm._process_video).parameters.items() if isinstance(p.default, bool)]
+    times = {}
+    for stage in stages:
+        if is_stage_done(marker_dir, stage, idx):
+            continue
+        start = time.time()
+        try:
+            dm._process_video(idx, **{flag: flag == stage for flag in flags})
+        except Exception:
+            return idx, times, stage, traceback.format_exc()
+        times[stage] = time.time() - start
+        _mark_stage_done(marker_dir, stage, idx, f"{dm.video_list[idx]}\n{times[stage]:.3f}\n")
+    return idx, times, None, None
+
+
+def _implicit_stages(datamodule):
+    """
+    The switches of _process_video that are on by default but not exposed by _process_shard. A cluster job 
+    (_process_shard) always runs them, so the local run has to as well, otherwise the outputs would differ.
+    """
+    if not hasattr(datamodule, "_process_shard"):
+        return []
+    shard_params = inspect.signature(datamodule._process_shard).parameters
+    return [name for name, p in inspect.signature(datamodule._process_video).parameters.items() 
+            if p.default is True and name not in shard_params]
+
+
+def _default_slots(gpus, workers_per_gpu, num_cpu_workers):
+    if gpus is None:
+        import torch
+        gpus = list(range(torch.cuda.device_count()))
+    slots = [gpu for gpu in gpus for _ in range(workers_per_gpu)]
+    if len(slots) == 0:
+        slots = [None] * (num_cpu_workers or max(1, (os.cpu_count() or 1) // 4))
+    return slots
+
+
+def _format_time(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def process_videos_locally(datamodule, video_indices, stages, marker_dir,
+                           gpus=None, workers_per_gpu=1, num_cpu_workers=None, threads_per_worker=None):
+    """
+    Runs the processing stages of FaceVideoDataModule._process_video over the given videos on the local machine,
+    using a pool of worker processes instead of one cluster job per shard (see inferno.utils.condor).
+    :param datamodule: the prepared datamodule, it is sent to each worker once (its models are created lazily in the workers)
+    :param video_indices: indices of the videos to process (the pool balances them dynamically over the workers)
+    :param stages: names of the boolean switches of _process_video to run (e.g. ["extract_audio", "detect_landmarks"]), 
+        they run in the order of _process_video. The switches that _process_shard does not expose and that are on 
+        by default (e.g. recognize_faces of MEAD and CelebVHQ) are always added, as the cluster jobs always run them.
+    :param marker_dir: a completion marker is written per video and stage, finished work is skipped when rerun
+    :param gpus: GPU ids to use (all visible GPUs by default), each worker is pinned to one of them
+    :param workers_per_gpu: number of worker processes sharing one GPU
+    :param num_cpu_workers: number of workers if there are no GPUs
+    :param threads_per_worker: torch CPU threads of each worker (avoids oversubscribing the CPU)
+    Returns the list of (video index, stage, traceback) of the failed videos.
+    """
+    flags = [name for name, p in inspect.signature(datamodule._process_video).parameters.items() if isinstance(p.default, bool)]
+    for stage in stages:
+        if stage not in flags:
+            raise ValueError(f"Unknown processing stage '{stage}', available stages: {flags}")
+    implicit = [stage for stage in _implicit_stages(datamodule) if stage not in stages]
+    if len(implicit) > 0:
+        print(f"Adding the stages {implicit}, _process_shard always runs them")
+    # the same order as in _process_video (and therefore in the cluster jobs)
+    stages = sorted(set(stages) | set(implicit), key=flags.index)
+
+    video_indices = [int(idx) for idx in video_indices]
+    todo = [idx for idx in video_indices if not all(is_stage_done(marker_dir, stage, idx) for stage in stages)]
+    print(f"Processing {len(todo)} videos ({len(video_indices) - len(todo)} already finished), stages: {stages}")
+    if len(todo) == 0:
+        return []
+
+    slots = _default_slots(gpus, workers_per_gpu, num_cpu_workers)
+    num_workers = min(len(slots), len(todo))
+    ctx = mp.get_context("spawn") # CUDA cannot be used in forked processes
+    slot_queue = ctx.Queue()
+    for slot in slots[:num_workers]:
+        slot_queue.put(slot)
+    print(f"Starting {num_workers} workers on " + (f"GPUs {sorted(set(s for s in slots[:num_workers]))}"
+        if slots[0] is not None else "CPU"))
+
+    failures = []
+    stage_times = {stage: [] for stage in stages}
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx, initializer=_init_worker,
+                             initargs=(datamodule, slot_queue, threads_per_worker)) as pool:
+        futures = [pool.submit(_process_video_stages, idx, stages, marker_dir) for idx in todo]
+        for done, future in enumerate(as_completed(futures), 1):
+            idx, times, failed_stage, error = future.result()
+            for stage, t in times.items():
+                stage_times[stage] += [t]
+            if error is not None:
+                failures += [(idx, failed_stage, error)]
+                print(f"[WARNING] Video {idx} failed in stage '{failed_stage}':\n{error}")
+            elapsed = time.time() - start
+            rate = done / elapsed
+            print(f"[{done}/{len(todo)}] {rate:.3f} videos/s, elapsed {_format_time(elapsed)}, "
+                  f"ETA {_format_time((len(todo) - done) / rate)}")
+
+    elapsed = time.time() - start
+    print(f"Processed {len(todo)} videos in {_format_time(elapsed)} ({len(todo) / elapsed:.3f} videos/s), "
+          f"{len(failures)} failed")
+    for stage in stages:
+        if len(stage_times[stage]) > 0:
+            print(f"  {stage}: {len(stage_times[stage])} videos, "
+                  f"{sum(stage_times[stage]) / len(stage_times[stage]):.2f} s/video per worker")
+    return failures
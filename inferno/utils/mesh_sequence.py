@@ -0,0 +1,90 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+from pathlib import Path
+import numpy as np
+
+
+def _to_numpy(array):
+    if not isinstance(array, np.ndarray):
+        array = array.detach().cpu().numpy()
+    return array
+
+
+def save_mesh_sequence(filename, vertices, faces, fps=25, dtype=np.float32):
+    """
+    Saves a mesh sequence with a fixed topology: the faces are stored once, the vertices of all frames
+    as one (T, V, 3) array of 'dtype' (float32 or float16). The format is given by the extension:
+    .npz (numpy archive) or .hdf5/.h5 (one chunk per frame, so that single frames can be read without loading the rest).
+    """
+    filename = Path(filename)
+    T = vertices.shape[0]
+    vertices = _to_numpy(vertices).reshape(T, -1, 3).astype(dtype)
+    faces = _to_numpy(faces).astype(np.int32)
+    if filename.suffix == ".npz":
+        np.savez(filename, vertices=vertices, faces=faces, fps=np.array(fps))
+    elif filename.suffix in [".hdf5", ".h5"]:
+        import h5py
+        with h5py.File(filename, "w") as f:
+            f.create_dataset("vertices", data=vertices, chunks=(1,) + vertices.shape[1:])
+            f.create_dataset("faces", data=faces)
+            f.attrs["fps"] = fps
+    else:
+        raise ValueError(f"Unsupported mesh sequence format '{filename.suffix}'")
+
+
+def load_mesh_sequence(filename, start_frame=None, end_frame=None):
+    """
+    Loads a mesh sequence saved by save_mesh_sequence. Returns (vertices (T, V, 3), faces (F, 3), fps).
+    """
+    filename = Path(filename)
+    if filename.suffix == ".npz":
+        with np.load(filename) as data:
+            return data["vertices"][start_frame:end_frame], data["faces"], data["fps"].item()
+    elif filename.suffix in [".hdf5", ".h5"]:
+        import h5py
+        with h5py.File(filename, "r") as f:
+            return f["vertices"][start_frame:end_frame], f["faces"][()], f.attrs["fps"]
+    raise ValueError(f"Unsupported mesh sequence format '{filename.suffix}'")
+
+
+def save_mdd(filename, vertices, fps=25):
+    """
+    Saves the vertices (T, V, 3) as an MDD point cache (big-endian: number of frames, number of points,
+    frame times, then the float32 point positions frame by frame), which can be applied in DCC tools
+    (Blender, Maya, 3ds Max, ...) on top of a mesh with the same topology (such as an OBJ of the first frame).
+    """
+    T = vertices.shape[0]
+    vertices = _to_numpy(vertices).reshape(T, -1, 3)
+    times = np.arange(T, dtype=np.float32) / fps
+    with open(filename, "wb") as f:
+        f.write(np.array([T, vertices.shape[1]], dtype=">i4").tobytes())
+        f.write(times.astype(">f4").tobytes())
+        f.write(vertices.astype(">f4").tobytes())
+
+
+def load_mdd(filename):
+    """
+    Loads an MDD point cache, returns the vertices (T, V, 3) and the frame times (T,)
+    """
+    with open(filename, "rb") as f:
+        T, V = np.frombuffer(f.read(8), dtype=">i4")
+        times = np.frombuffer(f.read(4 * T), dtype=">f4").astype(np.float32)
+        vertices = np.frombuffer(f.read(4 * T * V * 3), dtype=">f4").astype(np.float32).reshape(T, V, 3)
+    return vertices, times
@@ -0,0 +1,127 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import numbers
+import torch
+import torch.distributed as dist
+
+
+class MetricAccumulator(object):
+    """
+    Keeps weighted running sums of scalar losses and metrics. Tensor values stay on their device (no .item() 
+    and no host-device synchronization per step), the means are reduced across DDP ranks and transferred to 
+    the host only when compute() is called (at logging intervals). 
+    Python numbers (epoch, step, ...) are summed on the host and None values count as 0.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._sums = {}
+        self._host_sums = {}
+        self._weights = {}
+        self.num_updates = 0
+
+    def __len__(self):
+        return len(self._weights)
+
+    def update(self, values, weight=1.):
+        for key, value in values.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach()
+                if value.numel() != 1:
+                    value = value.float().mean()
+                value = value.reshape(()).float() * weight
+                self._sums[key] = self._sums[key] + value if key in self._sums else value
+            elif isinstance(value, numbers.Number) or value is None:
+                self._host_sums[key] = self._host_sums.get(key, 0.) + float(value or 0.) * weight
+            else:
+                raise ValueError(f"Invalid type '{type(value)}' of value '{key}'")
+            self._weights[key] = self._weights.get(key, 0.) + weight
+        self.num_updates += 1
+
+    def _device(self, distributed):
+        if len(self._sums) > 0:
+            return next(iter(self._sums.values())).device
+        if distributed and dist.get_backend() == "nccl":
+            return torch.device("cuda", torch.cuda.current_device())
+        return torch.device("cpu")
+
+    def compute(self, sync_dist=False, reset=True):
+        """
+        Returns the dict of weighted means (python floats). With sync_dist, the sums are reduced over all 
+        the DDP ranks (all the ranks must call compute at the same time).
+        """
+        distributed = sync_dist and dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+        keys = set(self._weights.keys())
+        if distributed:
+            # the ranks can log different keys (for instance a loss that is None on one of them)
+            all_keys = [None] * dist.get_world_size()
+            dist.all_gather_object(all_keys, sorted(keys))
+            keys = set(k for rank_keys in all_keys for k in rank_keys)
+        keys = sorted(keys)
+        if len(keys) == 0:
+            return {}
+
+        device = self._device(distributed)
+        zero = torch.zeros((), device=device)
+        sums = torch.stack([self._sums.get(k, zero).to(device) for k in keys]) 
+        host = torch.tensor([[self._host_sums.get(k, 0.) for k in keys], [self._weights.get(k, 0.) for k in keys]], 
+                            device=device, dtype=sums.dtype)
+        # one reduction and one transfer for all the values
+        totals = torch.stack([sums + host[0], host[1]])
+        if distributed:
+            dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+        totals = totals.cpu().tolist()
+        if reset:
+            self.reset()
+        return {k: s / w for k, s, w in zip(keys, totals[0], totals[1]) if w > 0}
+
+
+def _first_batch_size(batch):
+    for value in batch.values():
+        if isinstance(value, torch.Tensor) and value.ndim > 0:
+            return value.shape[0]
+        if isinstance(value, dict):
+            size = _first_batch_size(value)
+            if size is not None:
+                return size
+    return None
+
+
+def batch_size_of(batch):
+    """
+    The batch size of a (nested) dict batch: the leading dimension of its first tensor (1 if there is none)
+    """
+    return _first_batch_size(batch) or 1
+
+
+def log_accumulated_metrics(module, accumulators, sync_dist=True):
+    """
+    Logs the epoch means of per-dataloader accumulators ({dataloader_idx: MetricAccumulator}) of a LightningModule
+    from an epoch end hook. With several dataloaders the keys get Lightning's '/dataloader_idx_<i>' suffix.
+    """
+    for dataloader_idx in sorted(accumulators.keys()):
+        values = accumulators[dataloader_idx].compute(sync_dist=sync_dist)
+        if len(accumulators) > 1:
+            values = {f"{k}/dataloader_idx_{dataloader_idx}": v for k, v in values.items()}
+        if module.logger is not None and len(values) > 0:
+            module.log_dict(values, on_step=False, on_epoch=True, sync_dist=False)
+    accumulators.clear()
@@ -0,0 +1,101 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import queue
+import threading
+
+
+class _EndOfStream(object):
+    pass
+
+
+class _StageFailure(object):
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def run_pipeline(source, stages, max_queue_size=4, poll_interval=0.1):
+    """
+    Runs a chain of processing stages over the items of 'source' (any iterable, such as a generator of frame batches).
+    The source and each stage run in their own thread and are connected by bounded queues, so the stages
+    overlap (decoding, GPU work, compositing, ...) while at most 'max_queue_size' items wait between two stages.
+    Each stage is a function item -> item. Yields the outputs of the last stage in the order of the source.
+    An exception in any of the stages is re-raised in the consumer.
+    """
+    queues = [queue.Queue(max_queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=poll_interval)
+            except queue.Empty:
+                continue
+        return _EndOfStream()
+
+    def produce():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+            put(queues[0], _EndOfStream())
+        except BaseException as e:
+            put(queues[0], _StageFailure(e))
+
+    def work(stage, q_in, q_out):
+        while True:
+            item = get(q_in)
+            if isinstance(item, (_EndOfStream, _StageFailure)):
+                put(q_out, item)
+                return
+            try:
+                result = stage(item)
+            except BaseException as e:
+                put(q_out, _StageFailure(e))
+                return
+            if not put(q_out, result):
+                return
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=work, args=(stage, queues[i], queues[i + 1]), daemon=True)
+                for i, stage in enumerate(stages)]
+    for t in threads:
+        t.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if isinstance(item, _EndOfStream):
+                break
+            if isinstance(item, _StageFailure):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
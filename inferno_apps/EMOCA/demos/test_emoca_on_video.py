@@ -23,7 +23,10 @@ import inferno
 from pathlib import Path
 from tqdm import auto
 import argparse
-from inferno_apps.EMOCA.utils.io import save_obj, save_images, save_codes, test
+from inferno_apps.EMOCA.utils.io import save_obj, save_images, save_codes, test, torch_img_to_np
+from inferno.utils.lightning_logging import _fix_image
+import numpy as np
+import torch
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -51,6 +54,8 @@ def reconstruct_video(args):
     processed_subfolder = args.processed_subfolder
 
     mode = args.mode
+    if args.streaming:
+        return reconstruct_video_streaming(args)
     # mode = 'detail'
     # mode = 'coarse'
    
@@ -58,7 +63,7 @@ def reconstruct_video(args):
     # processed_subfolder="processed_2022_Jan_15_02-43-06"
     # processed_subfolder=None
     dm = TestFaceVideoDM(input_video, output_folder, processed_subfolder=processed_subfolder, 
-        batch_size=4, num_workers=4)
+        batch_size=4, num_workers=4, detection_batch_size=args.detection_batch_size)
     dm.prepare_data()
     dm.setup()
     processed_subfolder = Path(dm.output_dir).name
@@ -128,6 +133,57 @@ def reconstruct_video(args):
     print("Done")
 
 
+def reconstruct_video_streaming(args):
+    """
+    Streaming version of reconstruct_video. Decoding, detection, reconstruction, compositing and encoding 
+    of the output video run as one in-memory pipeline, no frames, detections or per-frame results are written to disk. 
+    Only the reconstruction video is produced (save_images, save_codes and save_mesh are ignored).
+    """
+    input_video = args.input_video
+    output_folder = args.output_folder
+    model_name = args.model_name
+    image_type = args.image_type
+    visdict_key = {
+        "geometry_detail": "geometry_detail", 
+        "geometry_coarse": "geometry_coarse", 
+        "out_im_detail": "output_images_detail", 
+        "out_im_coarse": "output_images_coarse",
+    }[image_type]
+
+    if args.save_images or args.save_codes or args.save_mesh:
+        print("[WARNING] The streaming mode only creates the reconstruction video, per-frame results will not be saved.")
+
+    dm = TestFaceVideoDM(input_video, output_folder, processed_subfolder=args.processed_subfolder, 
+        batch_size=4, num_workers=4, detection_batch_size=args.detection_batch_size)
+    processed_subfolder = Path(dm.output_dir).name
+
+    emoca, conf = load_model(args.path_to_models, model_name, args.mode)
+    emoca.cuda()
+    emoca.eval()
+
+    if Path(output_folder).is_absolute():
+        outfolder = output_folder
+    else:
+        outfolder = str(Path(output_folder) / processed_subfolder / Path(input_video).stem / "results" / model_name)
+
+    def process_fn(batch):
+        with torch.no_grad():
+            vals, visdict = test(emoca, batch)
+        vis_ims = np.stack([_fix_image(torch_img_to_np(im)) for im in visdict[visdict_key]], axis=0)
+        mask_ims = np.stack([_fix_image(torch_img_to_np(im)) for im in visdict["geometry_coarse"]], axis=0)
+        return vis_ims, mask_ims
+
+    video_file, video_file_with_sound = dm.reconstruct_video_streaming(process_fn, rec_method=model_name, 
+            image_type=image_type, cat_dim=args.cat_dim, include_transparent=bool(args.include_transparent), 
+            include_original=args.include_original, 
+            include_rec=args.include_rec,
+            black_background=args.black_background, 
+            use_mask=args.use_mask, 
+            out_folder=outfolder)
+    print("Video saved to: ", video_file_with_sound)
+    print("Done")
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_video', type=str, default=str(Path(inferno.__file__).parents[1] / "data/EMOCA_test_example_data/videos/82-25-854x480_affwild2.mp4"), 
@@ -156,6 +212,11 @@ def parse_args():
         help="Apart from the reconstruction video, also a video with the transparent mesh will be added")
     parser.add_argument('--black_background', type=str2bool, default=False, help="If true, the background of the reconstruction video will be black")
     parser.add_argument('--use_mask', type=str2bool, default=True, help="If true, the background of the reconstruction video will be black")
+    parser.add_argument('--streaming', type=str2bool, default=False, 
+        help="If true, the video is processed in memory as a pipeline (decode, detect, reconstruct, composite, encode) " \
+            "without unpacking frames and detections to disk. Only the reconstruction video is produced.")
+    parser.add_argument('--detection_batch_size', type=int, default=None, 
+        help="If set, the faces are detected in batches of this many frames (on the GPU if the detector supports it)")
     parser.add_argument('--logger', type=str, default="", choices=["", "wandb"], help="Specify how to log the results if at all.")
     
     args = parser.parse_args()
@@ -20,6 +20,12 @@ def main():
 
     processed_subfolder = "processed_orig"
 
+    # the last argument: detect the faces in batches of this many frames (0 or missing - frame by frame)
+    if len(sys.argv) > 11:
+        detection_batch_size = int(sys.argv[11]) or None
+    else: 
+        detection_batch_size = None
+
     # Create the dataset
     dm = CelebVHQDataModule(
             root_dir, output_dir, processed_subfolder,
@@ -28,6 +34,7 @@ def main():
             bb_center_shift_y=-0.1, # in relative numbers (i.e. -0.1 for 10% shift upwards, ...)
             # processed_video_size=256,
             processed_video_size=384,
+            detection_batch_size=detection_batch_size,
     )
 
     # Create the dataloader
@@ -89,18 +96,26 @@ def main():
         # segmentations_to_hdf5 = False
 
 
-    dm._process_shard(
-        videos_per_shard, 
-        shard_idx, 
-        extract_audio=extract_audio,
-        restore_videos=restore_videos, 
-        detect_landmarks=detect_landmarks, 
-        segment_videos=segment_videos, 
-        detect_aligned_landmarks=detect_aligned_landmarks,
-        reconstruct_faces=reconstruct_faces,
-        recognize_emotions=recognize_emotions,
-        segmentations_to_hdf5=segmentations_to_hdf5
-    )
+    if shard_idx < 0: 
+        # no cluster, process all the videos on this machine (see inferno.utils.local_executor)
+        stages = [("extract_audio", extract_audio), ("restore_videos", restore_videos), 
+                  ("detect_landmarks", detect_landmarks), ("segment_videos", segment_videos), 
+                  ("detect_aligned_landmarks", detect_aligned_landmarks), ("reconstruct_faces", reconstruct_faces), 
+                  ("recognize_emotions", recognize_emotions), ("segmentations_to_hdf5", segmentations_to_hdf5)]
+        dm._process_locally([stage for stage, enabled in stages if enabled])
+    else:
+        dm._process_shard(
+            videos_per_shard, 
+            shard_idx, 
+            extract_audio=extract_audio,
+            restore_videos=restore_videos, 
+            detect_landmarks=detect_landmarks, 
+            segment_videos=segment_videos, 
+            detect_aligned_landmarks=detect_aligned_landmarks,
+            reconstruct_faces=reconstruct_faces,
+            recognize_emotions=recognize_emotions,
+            segmentations_to_hdf5=segmentations_to_hdf5
+        )
     
     # dm.setup()
 
@@ -18,10 +18,17 @@ def main():
     processed_subfolder = "processed2"
     # processed_subfolder = None
 
+    # the last argument: detect the faces in batches of this many frames (0 or missing - frame by frame)
+    if len(sys.argv) > 9:
+        detection_batch_size = int(sys.argv[9]) or None
+    else: 
+        detection_batch_size = None
+
     # Create the dataset
     dm = LRS3DataModule(root_dir, output_dir, processed_subfolder,
         face_detector_threshold=0.05,
         landmarks_from=None,
+        detection_batch_size=detection_batch_size,
         )
 
     # Create the dataloader
@@ -65,14 +72,21 @@ def main():
     else: 
         recognize_emotions = True
 
-    dm._process_shard(videos_per_shard, shard_idx, 
-        extract_audio=extract_audio,
-        restore_videos=restore_videos, 
-        detect_landmarks=detect_landmarks, 
-        segment_videos=segment_videos, 
-        reconstruct_faces=reconstruct_faces,
-        recognize_emotions=recognize_emotions,
-    )
+    if shard_idx < 0: 
+        # no cluster, process all the videos on this machine (see inferno.utils.local_executor)
+        stages = [("extract_audio", extract_audio), ("restore_videos", restore_videos), 
+                  ("detect_landmarks", detect_landmarks), ("segment_videos", segment_videos), 
+                  ("reconstruct_faces", reconstruct_faces), ("recognize_emotions", recognize_emotions)]
+        dm._process_locally([stage for stage, enabled in stages if enabled])
+    else:
+        dm._process_shard(videos_per_shard, shard_idx, 
+            extract_audio=extract_audio,
+            restore_videos=restore_videos, 
+            detect_landmarks=detect_landmarks, 
+            segment_videos=segment_videos, 
+            reconstruct_faces=reconstruct_faces,
+            recognize_emotions=recognize_emotions,
+        )
 
     # dm._process_shard(videos_per_shard, shard_idx, 
     #     # extract_audio=True,
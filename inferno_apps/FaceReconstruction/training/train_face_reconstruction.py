@@ -87,6 +87,9 @@ def create_single_dm(cfg, data_class):
                 segmentation_type = cfg.data.segmentation_type,
                 inflate_by_video_size = cfg.data.inflate_by_video_size,
                 preload_videos = cfg.data.preload_videos,
+                video_clip_cache_size_mb = cfg.data.get('video_clip_cache_size_mb', None),
+                video_clip_cache_readahead = cfg.data.get('video_clip_cache_readahead', False),
+                video_clip_cache_log_every = cfg.data.get('video_clip_cache_log_every', None),
                 # test_condition_source=condition_source,
                 # test_condition_settings=condition_settings,
                 
@@ -139,6 +142,9 @@ def create_single_dm(cfg, data_class):
                 include_raw_audio = cfg.data.include_raw_audio,
                 inflate_by_video_size = cfg.data.inflate_by_video_size,
                 preload_videos = cfg.data.preload_videos,
+                video_clip_cache_size_mb = cfg.data.get('video_clip_cache_size_mb', None),
+                video_clip_cache_readahead = cfg.data.get('video_clip_cache_readahead', False),
+                video_clip_cache_log_every = cfg.data.get('video_clip_cache_log_every', None),
                 align_images = cfg.data.get('align_images', True),
                 # test_condition_source=condition_source,
                 # test_condition_settings=condition_settings,
@@ -187,6 +193,9 @@ def create_single_dm(cfg, data_class):
                 segmentation_type = cfg.data.segmentation_type,
                 inflate_by_video_size = cfg.data.inflate_by_video_size,
                 preload_videos = cfg.data.preload_videos,
+                video_clip_cache_size_mb = cfg.data.get('video_clip_cache_size_mb', None),
+                video_clip_cache_readahead = cfg.data.get('video_clip_cache_readahead', False),
+                video_clip_cache_log_every = cfg.data.get('video_clip_cache_log_every', None),
                 # test_condition_source=condition_source,
                 # test_condition_settings=condition_settings,
                 read_video=cfg.data.get('read_video', True),
@@ -0,0 +1,76 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2023, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emote@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+from pathlib import Path
+import os, sys
+os.environ["HDF5_USE_FILE_LOCKING"] = "FALSE"
+from tqdm import auto
+from inferno.datasets.IO import convert_landmark_list_to_v3, convert_aligned_landmark_list_to_v3
+from inferno.layers.losses.MediaPipeLandmarkLosses import MEDIAPIPE_LANDMARK_NUMBER
+
+
+def landmark_shape_for_type(landmark_type):
+    if landmark_type == "mediapipe":
+        return (MEDIAPIPE_LANDMARK_NUMBER, 3)
+    elif landmark_type in ["fan", "kpt68"]:
+        return (68, 2)
+    return None
+
+
+def main():
+    """
+    Converts the per-video landmark pickles of a processed dataset
+    (<processed_dir>/landmarks_<source>/<type>/**/landmarks_<source>.pkl)
+    into the memory-mappable landmarks_<source>.hdf5 files read by VideoDatasetBase, 
+    and the landmarks of the aligned videos (landmarks_aligned_video_smoothed.pkl) into the ones read by VideoDatasetBaseV2.
+    """
+    if len(sys.argv) < 2:
+        print("Usage: python convert_landmarks_to_hdf5.py <processed_dir> [landmark_source] [overwrite]")
+        sys.exit(0)
+
+    processed_dir = Path(sys.argv[1])
+    landmark_source = sys.argv[2] if len(sys.argv) > 2 else "original"
+    overwrite = len(sys.argv) > 3 and sys.argv[3].lower() in ["1", "true", "overwrite"]
+
+    print("Looking for files...")
+    landmarks_dir = processed_dir / f"landmarks_{landmark_source}"
+    landmark_files = sorted(landmarks_dir.rglob(f"landmarks_{landmark_source}.pkl"))
+    # the landmarks of the aligned videos (read by VideoDatasetBaseV2)
+    aligned_landmark_files = sorted(landmarks_dir.rglob("landmarks_aligned_video_smoothed.pkl"))
+    print(f"Found {len(landmark_files)} landmark files and {len(aligned_landmark_files)} aligned landmark files")
+
+    for landmark_file in auto.tqdm(aligned_landmark_files):
+        out_file = landmark_file.with_suffix(".hdf5")
+        used_frame_indices_file = landmark_file.parent / "landmarks_alignment_used_frame_indices.pkl"
+        if (out_file.is_file() and not overwrite) or not used_frame_indices_file.is_file():
+            continue
+        convert_aligned_landmark_list_to_v3(landmark_file, used_frame_indices_file, out_file, overwrite=overwrite)
+
+    for landmark_file in auto.tqdm(landmark_files):
+        out_file = landmark_file.with_suffix(".hdf5")
+        if out_file.is_file() and not overwrite:
+            continue
+        # the landmark type is the subfolder right below landmarks_<source>
+        landmark_type = landmark_file.relative_to(processed_dir / f"landmarks_{landmark_source}").parts[0]
+        convert_landmark_list_to_v3(landmark_file, out_file,
+            landmark_shape=landmark_shape_for_type(landmark_type), overwrite=overwrite)
+
+
+if __name__ == "__main__":
+    main()
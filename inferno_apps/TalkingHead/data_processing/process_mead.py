@@ -41,6 +41,12 @@ def main():
 
     processed_subfolder = "processed"
 
+    # the last argument: detect the faces in batches of this many frames (0 or missing - frame by frame)
+    if len(sys.argv) > 12:
+        detection_batch_size = int(sys.argv[12]) or None
+    else: 
+        detection_batch_size = None
+
     # Create the dataset
     dm = MEADDataModule(
             input_data_dir, 
@@ -50,6 +56,7 @@ def main():
             bb_center_shift_x=0., # in relative numbers
             bb_center_shift_y=-0.1, # in relative numbers (i.e. -0.1 for 10% shift upwards, ...)
             processed_video_size=384,
+            detection_batch_size=detection_batch_size,
     )
 
     print("Create the dataloader")
@@ -110,18 +117,26 @@ def main():
     #     # segmentations_to_hdf5 = True
     #     segmentations_to_hdf5 = False
 
-    dm._process_shard(
-        videos_per_shard, 
-        shard_idx, 
-        extract_audio=extract_audio,
-        restore_videos=restore_videos, 
-        detect_landmarks=detect_landmarks, 
-        segment_videos=segment_videos, 
-        detect_aligned_landmarks=detect_aligned_landmarks,
-        reconstruct_faces=reconstruct_faces,
-        recognize_emotions=recognize_emotions,
-        # segmentations_to_hdf5=segmentations_to_hdf5,
-    )
+    if shard_idx < 0: 
+        # no cluster, process all the videos on this machine (see inferno.utils.local_executor)
+        stages = [("extract_audio", extract_audio), ("restore_videos", restore_videos), 
+                  ("detect_landmarks", detect_landmarks), ("segment_videos", segment_videos), 
+                  ("detect_aligned_landmarks", detect_aligned_landmarks), ("reconstruct_faces", reconstruct_faces), 
+                  ("recognize_emotions", recognize_emotions)]
+        dm._process_locally([stage for stage, enabled in stages if enabled])
+    else:
+        dm._process_shard(
+            videos_per_shard, 
+            shard_idx, 
+            extract_audio=extract_audio,
+            restore_videos=restore_videos, 
+            detect_landmarks=detect_landmarks, 
+            segment_videos=segment_videos, 
+            detect_aligned_landmarks=detect_aligned_landmarks,
+            reconstruct_faces=reconstruct_faces,
+            recognize_emotions=recognize_emotions,
+            # segmentations_to_hdf5=segmentations_to_hdf5,
+        )
     
     dm.setup()
     print("Setup complete")
@@ -36,11 +36,16 @@ def eval_talking_head_on_audio(
     save_meshes=False,
     save_videos=False,
     neutral_mesh_path=None,
+    chunk_size=None,
+    chunk_overlap=50,
+    mesh_formats=("npz",),
     ):
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     talking_head = talking_head.to(device)
     # talking_head.talking_head_model.preprocessor.to(device) # weird hack
-    sample = create_base_sample(talking_head, audio_path, silent_frames_start=silent_frames_start, silent_frames_end=silent_frames_end)
+    # in the chunked mode the audio can be of any length
+    sample = create_base_sample(talking_head, audio_path, silent_frames_start=silent_frames_start, silent_frames_end=silent_frames_end, 
+                                max_audio_length=22 if chunk_size is None else None)
     # samples = create_id_emo_int_combinations(talking_head, sample)
     samples = create_high_intensity_emotions(talking_head, sample, 
                                              identity_idx=identity_idx,
@@ -85,6 +90,9 @@ def eval_talking_head_on_audio(
                     save_meshes=save_meshes,
                     pyrender_videos=save_videos,
                     neutral_mesh_path=neutral_mesh_path,
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                    mesh_formats=mesh_formats,
                     )
     print("Done")
 
@@ -117,6 +125,9 @@ def main():
     parser.add_argument('--neutral_mesh_path', type=str, default='', help="Path to the neutral mesh. If blank, the default FLAME mean face will be used")
     parser.add_argument('--emotion', type=str, default='all', help="The emotion to generate. One of: neutral, Happy, Sad, Surprise, Fear, Disgust, Anger, Contempt. If 'all', all emotions will be generated.")
     parser.add_argument('--intensity', type=str, default='2', help="The emotion intentsity. One of: 0, 1, 2. If 'all', all emotions will be generated.")
+    parser.add_argument('--mesh_format', type=str, default='npz', help="Comma separated list of mesh output formats: npz, hdf5 (whole sequence in one file), mdd (point cache), obj (one file per frame).")
+    parser.add_argument('--chunk_size', type=int, default=0, help="If > 0, the audio is processed in overlapping windows of this many frames, which lifts the audio length limit (22s).")
+    parser.add_argument('--chunk_overlap', type=int, default=50, help="Number of frames by which the windows overlap (and over which they are cross-faded) in the chunked mode.")
 
     args = parser.parse_args()
 
@@ -159,7 +170,10 @@ def main():
         save_videos=args.save_video,
         neutral_mesh_path = args.neutral_mesh_path if args.neutral_mesh_path != '' else None,
         emotion_index_list=emotion_index_list,
-        intensity_list=intensity_list
+        intensity_list=intensity_list,
+        chunk_size=args.chunk_size if args.chunk_size > 0 else None,
+        chunk_overlap=args.chunk_overlap,
+        mesh_formats=args.mesh_format.split(','),
     )
     
 
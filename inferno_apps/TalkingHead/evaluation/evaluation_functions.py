@@ -18,7 +18,7 @@ All rights reserved.
 """
 
 from inferno_apps.TalkingHead.evaluation.TalkingHeadWrapper import TalkingHeadWrapper
-from inferno_apps.TalkingHead.utils.video import save_video
+from inferno_apps.TalkingHead.utils.video import save_video, save_video_frames
 from inferno.datasets.FaceVideoDataModule import dict_to_device
 from pathlib import Path
 import librosa
@@ -27,6 +27,7 @@ from inferno.utils.collate import robust_collate
 import torch
 import os, sys
 from inferno.utils.PyRenderMeshSequenceRenderer import PyRenderMeshSequenceRenderer
+from inferno.utils.mesh_sequence import save_mesh_sequence, save_mdd
 from tqdm.auto import tqdm
 from inferno.datasets.AffectNetAutoDataModule import AffectNetExpressions
 import trimesh
@@ -139,8 +140,9 @@ def interpolate_condition(sample_1, sample_2, length, interpolation_type="linear
 #     print("Done")
 
 
-def create_base_sample(talking_head, audio_path, smallest_unit=1, silent_frames_start=0, silent_frames_end=0, silence_all=False):
-    wavdata, sampling_rate = read_audio(audio_path)
+def create_base_sample(talking_head, audio_path, smallest_unit=1, silent_frames_start=0, silent_frames_end=0, silence_all=False, 
+                       max_audio_length=22):
+    wavdata, sampling_rate = read_audio(audio_path, max_length=max_audio_length)
     sample = process_audio(wavdata, sampling_rate, video_fps=25)
     # pad the audio such that it is a multiple of the smallest unit
     sample["raw_audio"] = np.pad(sample["raw_audio"], (0, smallest_unit - sample["raw_audio"].shape[0] % smallest_unit))
@@ -283,11 +285,175 @@ def interpolate_predictions(first_expression, last_expression, first_jaw_pose, l
     ## add the static frames 
     weights = torch.cat([torch.zeros((1, static_frames_start, 1), dtype=weights.dtype, device=weights.device), weights], dim=1)
     weights = torch.cat([weights, torch.ones((1, static_frames_end, 1), dtype=weights.dtype, device=weights.device)], dim=1)
+    # [B, C] -> [B, 1, C] to interpolate each sample of the batch separately
+    first_expression, last_expression = first_expression[:, None], last_expression[:, None]
+    first_jaw_pose, last_jaw_pose = first_jaw_pose[:, None], last_jaw_pose[:, None]
     interpolated_jaw_pose = last_jaw_pose * weights + first_jaw_pose * (1 - weights)
     interpolated_expression = last_expression * weights.repeat(1,1, 50)  + first_expression * (1 - weights.repeat(1,1, 50))
     return interpolated_expression.float(), interpolated_jaw_pose.float()
 
 
+def _same_value(a, b):
+    if isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor):
+        return torch.equal(a, b)
+    return a == b
+
+
+def encode_shared_audio(talking_head, batch):
+    """
+    Runs the audio encoder once per distinct (audio, samplerate) pair in the batch and stacks the features. 
+    The audio feature does not depend on the conditions, so when the batch consists of a few audios repeated 
+    with different emotion/intensity/identity conditions (in any order), each audio is encoded only once.
+    """
+    B = batch["raw_audio"].shape[0]
+    encoded = [] # (raw_audio, samplerate, audio_feature) of the audios encoded so far
+    features = []
+    for b in range(B):
+        raw_audio = batch["raw_audio"][b]
+        samplerate = batch["samplerate"][b]
+        for seen_audio, seen_samplerate, seen_feature in encoded:
+            if _same_value(samplerate, seen_samplerate) and torch.equal(raw_audio, seen_audio):
+                features += [seen_feature]
+                break
+        else:
+            audio_sample = {"raw_audio": batch["raw_audio"][b:b+1], "samplerate": batch["samplerate"][b:b+1]}
+            with torch.no_grad():
+                audio_sample = talking_head.talking_head_model.forward_audio(audio_sample, train=False)
+            encoded += [(raw_audio, samplerate, audio_sample["audio_feature"])]
+            features += [audio_sample["audio_feature"]]
+    batch["audio_feature"] = torch.cat(features, dim=0)
+    return batch
+
+
+def _is_temporal(value, T):
+    # per-frame entries are [B, T, ...], global ones (shape, texture, non-temporal conditions, ...) are [B, ...]
+    return isinstance(value, (torch.Tensor, np.ndarray)) and value.ndim >= 3 and value.shape[1] == T
+
+
+def slice_sample_in_time(sample, start, end, T):
+    """
+    Cuts frames [start, end) out of every per-frame entry of a (batched) sample of length T,
+    the global entries are shared.
+    """
+    result = {}
+    for key, value in sample.items():
+        if isinstance(value, dict):
+            result[key] = slice_sample_in_time(value, start, end, T)
+        elif _is_temporal(value, T):
+            result[key] = value[:, start:end]
+        else:
+            result[key] = value
+    return result
+
+
+def _drop_temporal(sample, T, output_device):
+    result = {}
+    for key, value in sample.items():
+        if isinstance(value, dict):
+            result[key] = _drop_temporal(value, T, output_device)
+        elif _is_temporal(value, T):
+            continue
+        elif isinstance(value, torch.Tensor):
+            result[key] = value.detach().to(output_device)
+        else:
+            result[key] = value
+    return result
+
+
+def chunk_windows(T, chunk_size, overlap):
+    """
+    Splits T frames into windows of 'chunk_size' frames, consecutive windows overlap by (at least) 'overlap' frames.
+    The last window is aligned with the end of the sequence so that it is never shorter than the others.
+    """
+    assert 0 <= overlap < chunk_size, "The overlap must be smaller than the chunk size"
+    if T <= chunk_size:
+        return [(0, T)]
+    windows = []
+    start = 0
+    while start + chunk_size < T:
+        windows.append((start, start + chunk_size))
+        start += chunk_size - overlap
+    windows.append((T - chunk_size, T))
+    return windows
+
+
+def crossfade_weights(start, end, T, overlap):
+    """
+    Blending weights of the window [start, end): linear ramps over the first/last 'overlap' frames
+    (unless the window touches the sequence boundary), ones elsewhere. Never zero.
+    """
+    weights = torch.ones(end - start)
+    if overlap == 0:
+        return weights
+    ramp = torch.linspace(0, 1, overlap + 2)[1:-1]
+    n = min(overlap, end - start)
+    if start > 0:
+        weights[:n] = torch.minimum(weights[:n], ramp[:n])
+    if end < T:
+        weights[-n:] = torch.minimum(weights[-n:], ramp.flip(0)[-n:])
+    return weights
+
+
+def _accumulate_chunk(accumulator, chunk, weights, start, end, T, output_device):
+    for key, value in chunk.items():
+        if isinstance(value, dict):
+            _accumulate_chunk(accumulator.setdefault(key, {}), value, weights, start, end, T, output_device)
+            continue
+        if not isinstance(value, torch.Tensor) or value.ndim < 2 or value.shape[1] != end - start:
+            print(f"[WARNING] Output '{key}' is not per-frame, it cannot be stitched across chunks")
+            continue
+        value = value.detach().to(device=output_device, dtype=torch.float32)
+        if key not in accumulator:
+            accumulator[key] = torch.zeros((value.shape[0], T) + tuple(value.shape[2:]), dtype=torch.float32, device=output_device)
+        w = weights.to(output_device).view(1, -1, *([1] * (value.ndim - 2)))
+        accumulator[key][:, start:end] += value * w
+
+
+def _normalize_accumulated(accumulator, weight_sum):
+    for key, value in accumulator.items():
+        if isinstance(value, dict):
+            _normalize_accumulated(value, weight_sum)
+        else:
+            value /= weight_sum.view(1, -1, *([1] * (value.ndim - 2)))
+
+
+def run_talking_head_chunked(talking_head, batch, chunk_size=250, overlap=50,
+                             output_keys=("predicted_exp", "predicted_jaw", "predicted_vertices", "predicted_video"),
+                             output_device="cpu"):
+    """
+    Runs the talking head on an arbitrarily long (batched) sample. The sequence is processed in overlapping windows of
+    'chunk_size' frames, each one going through the audio encoder and the decoder on its own. The per-frame
+    outputs in 'output_keys' are cross-faded over the overlaps. The style carries over from window to window
+    because the conditions are sliced along with the audio (per-frame conditions) or passed to each window (global ones),
+    the overlap gives each window the context of the preceding one.
+    Only one window is on the GPU at a time, the stitched outputs are accumulated on 'output_device'.
+    """
+    T = batch["raw_audio"].shape[1]
+    windows = chunk_windows(T, chunk_size, overlap)
+    result = None
+    accumulator = {}
+    weight_sum = torch.zeros(T, dtype=torch.float32, device=output_device)
+    for start, end in tqdm(windows, desc="Chunks", disable=len(windows) == 1):
+        chunk = slice_sample_in_time(batch, start, end, T)
+        chunk = encode_shared_audio(talking_head, chunk)
+        with torch.no_grad():
+            chunk = talking_head(chunk)
+        weights = crossfade_weights(start, end, T, overlap)
+        _accumulate_chunk(accumulator, {key: chunk[key] for key in output_keys if key in chunk},
+                          weights, start, end, T, output_device)
+        weight_sum[start:end] += weights.to(output_device)
+        if result is None:
+            # the global outputs (shape, texture, ...) are the same for all windows, take them from the first one
+            result = _drop_temporal(chunk, end - start, output_device)
+        del chunk
+    _normalize_accumulated(accumulator, weight_sum)
+
+    # the inputs are returned in full length
+    result.update({key: value for key, value in batch.items() if key not in output_keys})
+    result.update(accumulator)
+    return result
+
+
 class TestDataset(torch.utils.data.Dataset):
     def __init__(self, samples):
         self.samples = samples
@@ -317,9 +483,26 @@ def run_evalutation(talking_head,
                     silent_intervals=None,
                     original_audios=None, 
                     neutral_mesh_path=None,
+                    chunk_size=None,
+                    chunk_overlap=50,
+                    batch_size=8,
+                    render_backend="pyrender",
+                    mesh_formats=("npz",),
+                    mesh_dtype=np.float32,
                     ):
+    """
+    The samples (typically the same audio with different conditions) are processed in batches of 'batch_size' 
+    (all at once if None, which may not fit into GPU memory for the larger condition grids), 
+    the audio encoder runs only once per distinct audio in a batch.
+    If 'chunk_size' is set, the samples are processed in overlapping windows of 'chunk_size' frames 
+    (see run_talking_head_chunked), which allows for audio of any length. 
+    render_backend: 'pyrender' or 'rasterizer' (see PyRenderMeshSequenceRenderer.render_sequence)
+    mesh_formats: which mesh outputs to save if 'save_meshes' is on, any of 'npz', 'hdf5' (whole sequence in one file), 
+        'mdd' (point cache for DCC tools) and 'obj' (one text OBJ per frame)
+    """
     silent_intervals = silent_intervals or []
-    batch_size = 1
+    if batch_size is None:
+        batch_size = len(samples)
 
     # pass the interpolated part through FLAME 
     flame = talking_head.talking_head_model.sequence_decoder.get_shape_model()
@@ -370,8 +553,12 @@ def run_evalutation(talking_head,
 
     for bi, batch in enumerate(tqdm(dl)):
         batch = dict_to_device(batch, device)
-        with torch.no_grad():
-            batch = talking_head(batch)
+        if chunk_size is None:
+            batch = encode_shared_audio(talking_head, batch)
+            with torch.no_grad():
+                batch = talking_head(batch)
+        else:
+            batch = run_talking_head_chunked(talking_head, batch, chunk_size=chunk_size, overlap=chunk_overlap)
 
         for mouth_opening_interval_start, mouth_opening_interval_end in mouth_opening_intervals: 
             T = batch["predicted_jaw"].shape[1]
@@ -421,11 +608,11 @@ def run_evalutation(talking_head,
                 pose = pose.view(B_ * T_, -1)
                 shape = batch["gt_shape"]
                 shape = shape[:,None, ...].repeat(1, T_, 1).contiguous().view(B_ * T_, -1)
-                predicted_verts, _, _ = flame(shape, exp, pose)
+                predicted_verts, _, _ = flame(shape.to(device), exp.to(device), pose.to(device))
                 predicted_verts = predicted_verts.reshape(B_, T_, -1) 
                 # batch["predicted_vertices"] = torch.cat([predicted_verts, batch["predicted_vertices"]], dim=1) 
                 # batch["predicted_vertices"][:, :predicted_verts.shape[1]] = predicted_verts
-                batch["predicted_vertices"][:, mouth_opening_interval_start:mouth_opening_interval_end] = predicted_verts
+                batch["predicted_vertices"][:, mouth_opening_interval_start:mouth_opening_interval_end] = predicted_verts.to(batch["predicted_vertices"].device)
 
         
         for mouth_closure_interval_start, mouth_closure_interval_end in mouth_closure_intervals:
@@ -476,11 +663,11 @@ def run_evalutation(talking_head,
                 pose = pose.view(B_ * T_, -1)
                 shape = batch["gt_shape"]
                 shape = shape[:,None, ...].repeat(1, T_, 1).contiguous().view(B_ * T_, -1)
-                predicted_verts, _, _ = flame(shape, exp, pose)
+                predicted_verts, _, _ = flame(shape.to(device), exp.to(device), pose.to(device))
                 predicted_verts = predicted_verts.reshape(B_, T_, -1)
                 # batch["predicted_vertices"] = torch.cat([batch["predicted_vertices"], predicted_verts], dim=1)
                 # batch["predicted_vertices"][:, -predicted_verts.shape[1]:] = predicted_verts
-                batch["predicted_vertices"][:, mouth_closure_interval_start:mouth_closure_interval_end] = predicted_verts
+                batch["predicted_vertices"][:, mouth_closure_interval_start:mouth_closure_interval_end] = predicted_verts.to(batch["predicted_vertices"].device)
 
 
         for silent_start, silent_end in silent_intervals:
@@ -497,9 +684,10 @@ def run_evalutation(talking_head,
             pose = pose.view(B_ * T_, -1)
             shape = batch["gt_shape"]
             shape = shape[:,None, ...].repeat(1, T_, 1).contiguous().view(B_ * T_, -1)
-            predicted_verts, _, _ = flame(shape, exp, pose)
+            # the chunked outputs are kept on the CPU
+            predicted_verts, _, _ = flame(shape.to(device), exp.to(device), pose.to(device))
             predicted_verts = predicted_verts.reshape(B_, T_, -1)
-            batch["predicted_vertices"][:, silent_start:silent_end] = predicted_verts
+            batch["predicted_vertices"][:, silent_start:silent_end] = predicted_verts.to(batch["predicted_vertices"].device)
 
         B = batch["predicted_vertices"].shape[0]
         for b in range(B):
@@ -568,27 +756,29 @@ def run_evalutation(talking_head,
             if save_meshes: 
                 mesh_folder = output_dir / f"{suffix[1:]}"  / f"meshes{mesh_suffix}"
                 mesh_folder.mkdir(exist_ok=True, parents=True)
-                for t in tqdm(range(T)):
-                    mesh_path = mesh_folder / (f"{t:05d}" + ".obj")
-                    # mesh_path = mesh_folder / (f"{t:05d}" + ".ply")
-                    if not (mesh_path.exists() and not overwrite):
-                        # continue
-                        pred_vertices = predicted_vertices[t].detach().cpu().view(-1,3).numpy()
-                        
-                        
+                mesh_vertices = predicted_vertices.detach().cpu().view(T, -1, 3).numpy()
+                if "npz" in mesh_formats or "hdf5" in mesh_formats:
+                    # the whole sequence in one file, the faces are stored once
+                    for mesh_format in ["npz", "hdf5"]:
+                        mesh_sequence_path = mesh_folder / f"mesh_sequence.{mesh_format}"
+                        if mesh_format in mesh_formats and not (mesh_sequence_path.exists() and not overwrite):
+                            save_mesh_sequence(mesh_sequence_path, mesh_vertices, template_obj_ps.f, fps=25, dtype=mesh_dtype)
+                if "mdd" in mesh_formats: 
+                    # point cache + an OBJ of the first frame (with UVs) to apply it to
+                    mdd_path = mesh_folder / "mesh_sequence.mdd"
+                    if not (mdd_path.exists() and not overwrite):
+                        save_mdd(mdd_path, mesh_vertices, fps=25)
                         mesh = copy.deepcopy(template_obj_ps)
-                        mesh.v = pred_vertices
-                        mesh.write_obj(str(mesh_path))
-
-                        # mesh = template.copy(deep=True)
-                        # mesh.points = pred_vertices
-                        # pl = pyvista.Plotter()
-                        # _ = pl.add_mesh(mesh)
-                        # pl.export_obj(str(mesh_path))  
-
-                        # # mesh = trimesh.base.Trimesh(pred_vertices, template.faces)
-                        # mesh.vertices = pred_vertices
-                        # mesh.export(mesh_path)
+                        mesh.v = mesh_vertices[0]
+                        mesh.write_obj(str(mesh_folder / "mesh_sequence_base.obj"))
+                if "obj" in mesh_formats:
+                    # one text OBJ per frame, slow and large, only on request
+                    mesh = copy.deepcopy(template_obj_ps)
+                    for t in tqdm(range(T)):
+                        mesh_path = mesh_folder / (f"{t:05d}" + ".obj")
+                        if not (mesh_path.exists() and not overwrite):
+                            mesh.v = mesh_vertices[t]
+                            mesh.write_obj(str(mesh_path))
 
             if save_flame:
                 flame_folder = output_dir / f"{suffix[1:]}"  / f"flame{mesh_suffix}"
@@ -615,15 +805,9 @@ def run_evalutation(talking_head,
                 if not(out_video_with_audio_path.exists() and not overwrite):
                     # continue
 
-                    pred_images = []
-                    for t in tqdm(range(T)):
-                        pred_vertices = predicted_vertices[t].detach().cpu().view(-1,3).numpy()
-                        pred_image = renderer.render(pred_vertices)
-                        pred_images.append(pred_image)
-
-                    pred_images = np.stack(pred_images, axis=0)
-
-                    save_video(out_video_path, pred_images, fourcc="mp4v", fps=25)
+                    # the frames are streamed into the video file as they are rendered
+                    pred_images = renderer.render_sequence(predicted_vertices.detach().view(T, -1, 3), backend=render_backend)
+                    save_video_frames(out_video_path, tqdm(pred_images, total=T), fourcc="mp4v", fps=25)
 
                     if not out_audio_path.exists(): 
                         # link the audio 
@@ -644,7 +828,12 @@ def run_evalutation(talking_head,
             os.system(chmod_cmd)
 
 
-def read_audio(audio_path):
+def read_audio(audio_path, max_length=22):
+    """
+    Reads the audio as 16kHz int16 mono. Audio longer than 'max_length' seconds is cut
+    (the whole sequence is processed in one forward pass), use max_length=None together
+    with the chunked mode of run_evalutation for long inputs.
+    """
     sampling_rate = 16000
     # try:
     wavdata, sampling_rate = librosa.load(audio_path, sr=sampling_rate)
@@ -655,10 +844,10 @@ def read_audio(audio_path):
     if wavdata.ndim > 1:
         wavdata = librosa.to_mono(wavdata)
     wavdata = (wavdata.astype(np.float64) * 32768.0).astype(np.int16)
-    # if longer than 30s cut it
-    if wavdata.shape[0] > 22 * sampling_rate:
-        wavdata = wavdata[:22 * sampling_rate]
-        print("Audio longer than 30s, cutting it to 30s")
+    # if longer than max_length cut it
+    if max_length is not None and wavdata.shape[0] > max_length * sampling_rate:
+        wavdata = wavdata[:max_length * sampling_rate]
+        print(f"[WARNING] Audio longer than {max_length}s, cutting it to {max_length}s")
     return wavdata, sampling_rate
 
 
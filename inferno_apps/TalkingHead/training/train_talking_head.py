@@ -227,6 +227,9 @@ def create_single_dm(cfg, data_class):
                 segmentation_source=cfg.data.segmentation_source,
                 inflate_by_video_size = cfg.data.inflate_by_video_size,
                 preload_videos = cfg.data.preload_videos,
+                video_clip_cache_size_mb = cfg.data.get('video_clip_cache_size_mb', None),
+                video_clip_cache_readahead = cfg.data.get('video_clip_cache_readahead', False),
+                video_clip_cache_log_every = cfg.data.get('video_clip_cache_log_every', None),
                 test_condition_source=condition_source,
                 test_condition_settings=condition_settings,
                 read_video=cfg.data.get('read_video', True),
@@ -237,6 +240,7 @@ def create_single_dm(cfg, data_class):
 
                 emotion_type=cfg.data.get('emotion_type', None),
                 return_emotion_feature=cfg.data.get('return_emotion_feature', None),
+                feature_cache_types=cfg.data.get('feature_cache_types', None),
                 shuffle_validation=cfg.model.get('disentangle_type', False) == 'condition_exchange',
         )
         dataset_name = "MEAD"
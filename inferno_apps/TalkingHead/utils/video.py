@@ -47,3 +47,26 @@ def save_video(video_path, video_tensor, fourcc='png ', fps=25):
     #     writer.write(frame)
     # writer.release()
     # return
+
+
+def save_video_frames(video_path, frames, fourcc='mp4v', fps=25):
+    """
+    Streams frames (an iterable of (H, W, 3) RGB uint8 arrays, such as the generator returned by 
+    PyRenderMeshSequenceRenderer.render_sequence) into a video file without keeping them in memory.
+    Returns the number of written frames.
+    """
+    writer = None
+    num_frames = 0
+    try:
+        for frame in frames:
+            if writer is None:
+                writer = cv2.VideoWriter(str(video_path), cv2.VideoWriter_fourcc(*fourcc), fps,
+                                        (frame.shape[1], frame.shape[0])
+                                        )
+            # rgb to bgr
+            writer.write(np.ascontiguousarray(frame[..., ::-1]))
+            num_frames += 1
+    finally:
+        if writer is not None:
+            writer.release()
+    return num_frames
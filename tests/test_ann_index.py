@@ -0,0 +1,19 @@
+import numpy as np
+
+from inferno.utils.ann_index import IVFIndex
+
+
+def test_saved_index_is_not_reused_for_recomputed_features(tmp_path):
+    rng = np.random.RandomState(0)
+    features = rng.randn(500, 16).astype(np.float32)
+    index = IVFIndex(16, num_lists=8)
+    index.add(features[:400])
+    index.save(tmp_path / "index.npz")
+
+    index = IVFIndex.load(tmp_path / "index.npz")
+    # the same features (more of them), the index can be topped up
+    assert index.matches(features)
+    # recomputed features of the same size
+    assert not index.matches(rng.randn(500, 16).astype(np.float32))
+    assert not index.matches(features[:300])
+    assert not index.matches(features[:, :8])
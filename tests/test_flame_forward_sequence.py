@@ -0,0 +1,57 @@
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from inferno.models.DecaFLAME import FLAME
+
+
+def _random_flame(tmp_path, num_verts=60, num_faces=100, n_shape=10, n_exp=8, seed=0):
+    # a random model with the layout of the FLAME assets (5 joints: global, neck, jaw, eyes)
+    rng = np.random.RandomState(seed)
+    J_regressor = rng.rand(5, num_verts)
+    model = {
+        "f": rng.randint(0, num_verts, (num_faces, 3)),
+        "v_template": rng.randn(num_verts, 3) * 0.1,
+        "shapedirs": rng.randn(num_verts, 3, 300 + n_exp) * 0.01,
+        "posedirs": rng.randn(num_verts, 3, 36) * 0.01,
+        "J_regressor": J_regressor / J_regressor.sum(axis=1, keepdims=True),
+        "kintree_table": np.array([[4294967295, 0, 1, 1, 1], [0, 1, 2, 3, 4]]),
+        "weights": rng.dirichlet(np.ones(5), num_verts),
+    }
+    embeddings = {
+        "static_lmk_faces_idx": rng.randint(0, num_faces, 51),
+        "static_lmk_bary_coords": rng.dirichlet(np.ones(3), 51),
+        "dynamic_lmk_faces_idx": rng.randint(0, num_faces, (79, 17)),
+        "dynamic_lmk_bary_coords": rng.dirichlet(np.ones(3), (79, 17)),
+        "full_lmk_faces_idx": rng.randint(0, num_faces, (1, 68)),
+        "full_lmk_bary_coords": rng.dirichlet(np.ones(3), (1, 68)),
+    }
+    with open(tmp_path / "flame.pkl", "wb") as f:
+        pickle.dump(model, f)
+    np.save(tmp_path / "landmark_embedding.npy", embeddings)
+    config = SimpleNamespace(flame_model_path=str(tmp_path / "flame.pkl"),
+        flame_lmk_embedding_path=str(tmp_path / "landmark_embedding.npy"), n_shape=n_shape, n_exp=n_exp)
+    return FLAME(config)
+
+
+def test_forward_sequence_matches_forward(tmp_path):
+    flame = _random_flame(tmp_path)
+    B, T = 3, 7
+    torch.manual_seed(0)
+    shape = torch.randn(B, flame.cfg.n_shape)
+    exp = torch.randn(B, T, flame.cfg.n_exp)
+    # large enough rotations to select different dynamic contour landmarks
+    pose = torch.randn(B, T, 6) * 0.4
+
+    with torch.no_grad():
+        reference = flame(shape[:, None].expand(B, T, -1).reshape(B * T, -1), exp.view(B * T, -1), pose.view(B * T, -1))
+        result = flame.forward_sequence(shape, exp, pose)
+
+    # vertices, 2D and 3D landmarks, [B, T, ...] instead of [B * T, ...]
+    for ref, res in zip(reference, result):
+        assert res.shape == (B, T, *ref.shape[1:])
+        assert torch.allclose(res.reshape(ref.shape), ref, atol=1e-5)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("skimage")
+pytest.importorskip("torch")
+
+from inferno.datasets.ImageDatasetHelpers import bbpoint_warp_images
+
+
+def _smooth_images(num_images=4, size=96):
+    # smooth colour gradients, like natural images the kernels agree on
+    ys, xs = np.mgrid[:size, :size].astype(np.float64)
+    channels = [np.sin(xs / 9.) * np.cos(ys / 11.), np.sin((xs + ys) / 13.), np.cos(xs / 7.) * np.sin(ys / 17.)]
+    image = np.stack([127.5 + 100. * c for c in channels], axis=2).astype(np.uint8)
+    return np.stack([image] * num_images, axis=0)
+
+
+def _high_contrast_images(num_images=4, size=96, square=6):
+    # black and white checkerboards, the cubic kernels overshoot the most at their edges
+    ys, xs = np.mgrid[:size, :size]
+    board = (((ys // square) + (xs // square)) % 2 * 255).astype(np.uint8)
+    return np.stack([np.repeat(board[..., None], 3, axis=2)] * num_images, axis=0)
+
+
+CENTERS = np.array([[48., 48.], [40., 52.], [55., 45.], [47.3, 49.1]])
+SIZES = np.array([60., 45., 70., 33.])
+
+
+@pytest.mark.parametrize("backend", ["cv2", "torch"])
+def test_warp_backends_match_skimage_on_smooth_images(backend):
+    images = _smooth_images()
+    reference = bbpoint_warp_images(images, CENTERS, SIZES, 64, backend="skimage")
+    warped = bbpoint_warp_images(images, CENTERS, SIZES, 64, backend=backend)
+
+    assert warped.shape == reference.shape
+    # the crops lie inside the images, only the interpolation kernels differ
+    assert np.abs(warped - reference)[:, 2:-2, 2:-2].max() < 3. / 255.
+
+
+@pytest.mark.parametrize("backend", ["cv2", "torch"])
+def test_warp_backends_stay_in_range_on_high_contrast_images(backend):
+    images = _high_contrast_images()
+    warped = bbpoint_warp_images(images, CENTERS, SIZES, 64, backend=backend)
+    # no overshoot, which would wrap around when the crops are converted to uint8 (as the callers do)
+    assert warped.min() >= 0. and warped.max() <= 1.
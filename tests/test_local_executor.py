@@ -0,0 +1,25 @@
+from inferno.utils.local_executor import _implicit_stages, _mark_stage_done, process_videos_locally
+
+
+class _FakeDataModule:
+    # the same switches as MEADDataModule, recognize_faces is not exposed by _process_shard
+    video_list = ["video_0.mp4"]
+
+    def _process_video(self, idx, extract_audio=True, restore_videos=True, detect_landmarks=True,
+            recognize_faces=True, segment_videos=True, reconstruct_faces=False):
+        pass
+
+    def _process_shard(self, videos_per_shard, shard_idx, extract_audio=True, restore_videos=True,
+            detect_landmarks=True, segment_videos=True, reconstruct_faces=False):
+        pass
+
+
+def test_stages_always_run_by_process_shard_are_added(tmp_path, capsys):
+    dm = _FakeDataModule()
+    assert _implicit_stages(dm) == ["recognize_faces"]
+
+    for stage in ["recognize_faces", "reconstruct_faces"]:
+        _mark_stage_done(tmp_path, stage, 0, "")
+    # everything is done, so no workers are started
+    assert process_videos_locally(dm, [0], ["reconstruct_faces"], tmp_path) == []
+    assert "stages: ['recognize_faces', 'reconstruct_faces']" in capsys.readouterr().out
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+# only needed to import the renderer module, the window math itself does not render anything
+pytest.importorskip("pytorch3d")
+
+from inferno.models.temporal.Renderers import (crop_with_grid, cut_mouth_vectorized, full_image_to_roi,
+    mouth_crop_grid, mouth_roi_window)
+
+IMAGE_SIZE = 64
+CROP_SIZE = 20
+ROI_SIZE = CROP_SIZE + 4
+MOUTH_ARGS = dict(mouth_window_margin=12, mouth_landmark_start_idx=48, mouth_landmark_stop_idx=68,
+    mouth_crop_height=CROP_SIZE, mouth_crop_width=CROP_SIZE)
+
+
+def _smooth_images(B, T, C=3, size=IMAGE_SIZE):
+    y, x = torch.meshgrid(torch.linspace(0, 1, size), torch.linspace(0, 1, size))
+    images = torch.stack([0.5 + 0.5 * torch.sin(2 * np.pi * (x * (1 + c) + y * (2 + b + t) / 3))
+        for b in range(B) for t in range(T) for c in range(C)])
+    return images.view(B, T, C, size, size)
+
+
+def _landmarks(centers, T, seed=0):
+    # mouth landmarks jittering around the given centers (in [-1, 1] image space)
+    rng = np.random.RandomState(seed)
+    landmarks = rng.uniform(-0.15, 0.15, (len(centers), T, 68, 2))
+    landmarks += rng.uniform(-0.05, 0.05, (len(centers), T, 1, 2))
+    landmarks += np.array(centers)[:, None, None, :]
+    return torch.tensor(landmarks, dtype=torch.float32)
+
+
+def test_roi_windows_reproduce_the_mouth_crop():
+    # one window inside the image, one clamped at the top left and one at the bottom right corner
+    landmarks = _landmarks([(0.1, -0.2), (-0.9, -0.95), (0.95, 0.9)], T=6)
+    B, T = landmarks.shape[:2]
+    images = _smooth_images(B, T)
+
+    grid = mouth_crop_grid(landmarks, IMAGE_SIZE, IMAGE_SIZE, **MOUTH_ARGS)
+    offsets, roi_grid = mouth_roi_window(grid, IMAGE_SIZE, ROI_SIZE)
+    assert offsets.shape == (B, T, 2)
+    assert torch.equal(offsets, offsets.round())
+    assert (offsets[0] > 0).all() and (offsets[0] < IMAGE_SIZE - ROI_SIZE).all()
+    assert (offsets[1] == 0).all()
+    assert (offsets[2] == IMAGE_SIZE - ROI_SIZE).all()
+
+    offsets = offsets.long()
+    windows = torch.stack([torch.stack([images[b, t, :, oy:oy + ROI_SIZE, ox:ox + ROI_SIZE]
+        for t, (ox, oy) in enumerate(offsets[b].tolist())]) for b in range(B)])
+
+    expected = cut_mouth_vectorized(images, landmarks, convert_grayscale=False, **MOUTH_ARGS)
+    result = crop_with_grid(windows, roi_grid, convert_grayscale=False)
+    assert result.shape == expected.shape == (B, T, 3, CROP_SIZE, CROP_SIZE)
+    assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_full_image_to_roi_keeps_the_pixel_centers():
+    offsets = torch.tensor([[0., 0.], [17., 5.], [IMAGE_SIZE - ROI_SIZE, IMAGE_SIZE - ROI_SIZE]])
+    pixels = torch.tensor([[0, 0], [3, 11], [ROI_SIZE - 1, ROI_SIZE - 1]], dtype=torch.float32)
+    # pixel centers (in [-1, 1] space) of the full image and of the windows
+    full = (2 * (pixels[None] + offsets[:, None]) + 1) / IMAGE_SIZE - 1
+    depth = torch.rand(3, 3, 1)
+    roi_verts = full_image_to_roi(torch.cat([full, depth], dim=-1), offsets, IMAGE_SIZE, ROI_SIZE)
+
+    expected = (2 * pixels[None] + 1) / ROI_SIZE - 1
+    assert torch.allclose(roi_verts[..., :2], expected.expand(3, -1, -1), atol=1e-6)
+    assert torch.allclose(roi_verts[..., 2:], depth * IMAGE_SIZE / ROI_SIZE)
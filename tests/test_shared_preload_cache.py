@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("imgaug")
+pytest.importorskip("decord")
+
+from inferno.datasets.FaceDataModuleBase import FaceDataModuleBase
+from inferno.datasets.SharedPreloadCache import SharedArray, SharedPreloadCache
+from inferno.datasets.VideoDatasetBase import VideoDatasetBaseV2
+
+
+def test_shared_array_arithmetic(tmp_path):
+    data = np.arange(12, dtype=np.float32).reshape(3, 4)
+    np.save(tmp_path / "a.npy", data)
+    shared = SharedArray(tmp_path / "a.npy")
+    assert np.array_equal(shared * 2., data * 2.)
+    assert np.array_equal(1. - shared, 1. - data)
+    assert np.array_equal(np.sqrt(shared), np.sqrt(data))
+    assert not shared[0].flags.writeable
+
+
+def test_v2_getitem_with_shared_preloading(tmp_path, monkeypatch):
+    # share every array, however small, so that the aligned landmarks are a SharedArray
+    init = SharedPreloadCache.__init__
+    monkeypatch.setattr(SharedPreloadCache, "__init__",
+        lambda self, cache_dir, **kwargs: init(self, cache_dir, min_shared_bytes=1))
+
+    num_frames, image_size = 40, 32
+    video_list = ["subject/video.mp4"]
+    (tmp_path / "subject").mkdir()
+    (tmp_path / "subject" / "video.mp4").touch()
+    landmarks = np.random.rand(num_frames, 478, 3).astype(np.float32)
+    landmarks_dir = tmp_path / "landmarks_aligned" / "mediapipe" / "subject" / "video"
+    landmarks_dir.mkdir(parents=True)
+    FaceDataModuleBase.save_landmark_list_v2(landmarks_dir / "landmarks.pkl", landmarks,
+        np.ones(num_frames, dtype=np.float32), ["mediapipe"] * num_frames)
+
+    dataset = VideoDatasetBaseV2(tmp_path, tmp_path, video_list, [{"num_frames": num_frames, "fps": "25/1"}], [0],
+        [None], 10, landmark_types="mediapipe", landmark_source="aligned", image_size=image_size,
+        preload_videos="shared", read_video=False, read_audio=False)
+    assert isinstance(dataset.lmk_cache[0]["mediapipe"]["aligned"][0], SharedArray)
+
+    sample = dataset[0]
+    start = sample["frame_indices"][0].item()
+    expected = landmarks[start:start + 10] * image_size
+    assert np.allclose(sample["landmarks"]["mediapipe"].numpy(), expected)
@@ -0,0 +1,59 @@
+import re
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pl = pytest.importorskip("pytorch_lightning")
+
+from omegaconf import OmegaConf
+from pytorch_lightning.callbacks import ModelCheckpoint
+from torch.utils.data import DataLoader
+
+from inferno.models.talkinghead.TalkingHeadBase import TalkingHeadBase
+
+
+class _EpochLossTalkingHead(TalkingHeadBase):
+    """
+    The loss of each epoch is the index of the epoch, so a checkpoint name tells from which epoch its loss was taken.
+    """
+
+    def __init__(self):
+        super().__init__(OmegaConf.create({"learning": {"optimizer": "SGD", "learning_rate": 0.}}))
+        self.weight = torch.nn.Parameter(torch.zeros(1))
+
+    def get_trainable_parameters(self):
+        return [self.weight]
+
+    def forward(self, sample, train=False, validation=False, **kwargs):
+        return sample
+
+    def compute_loss(self, sample, training, validation, **kwargs):
+        loss_total = self.weight.sum() * 0. + float(self.current_epoch)
+        return loss_total, {"loss_total": loss_total}, {}
+
+
+class _DataModule(pl.LightningDataModule):
+
+    def _loader(self):
+        return DataLoader([{"audio": torch.zeros(4)} for _ in range(8)], batch_size=2)
+
+    def train_dataloader(self):
+        return self._loader()
+
+    def val_dataloader(self):
+        return self._loader()
+
+
+def test_train_checkpoint_uses_the_loss_of_the_current_epoch(tmp_path):
+    checkpoint = ModelCheckpoint(dirpath=str(tmp_path / "checkpoints"), monitor="train/loss_total", 
+        filename="model-{epoch:04d}-{train/loss_total:.4f}", auto_insert_metric_name=False, save_top_k=-1)
+    trainer = pl.Trainer(default_root_dir=str(tmp_path), max_epochs=3, callbacks=[checkpoint], 
+        log_every_n_steps=1, num_sanity_val_steps=0, val_check_interval=1.0, weights_summary=None, 
+        progress_bar_refresh_rate=0)
+    trainer.fit(_EpochLossTalkingHead(), datamodule=_DataModule())
+
+    names = sorted(p.stem for p in (tmp_path / "checkpoints").glob("*.ckpt"))
+    assert len(names) == 3
+    for name in names:
+        epoch, loss = re.fullmatch(r"model-(\d+)-([\d.]+)", name).groups()
+        assert float(loss) == float(epoch)